@@ -0,0 +1,338 @@
+import json
+import os
+import sqlite3
+import sys
+import zlib
+
+# --- 定数 --- #
+# --- Constants --- #
+ARTIFACT_FORMATS = ['sqlite', 'json']
+DEFAULT_ARTIFACT_FORMAT = 'sqlite'
+DEFAULT_CHUNK_SIZE = 1000  # 読み込み時に1回で取り出すレコード数 / Number of records fetched at once when reading
+COMPRESSION_LEVEL = 1  # zlibの圧縮レベル（速度を優先） / zlib compression level (favours speed)
+SQLITE_SUFFIX = ".sqlite"
+
+# 中間成果物（レコードのリスト）は論理パス（例: output/step2a_cleaned_text.json）で指定し、
+# 実際のファイルは設定された形式に応じて決まる（sqlite: output/step2a_cleaned_text.sqlite）
+# Intermediate artifacts (lists of records) are named by a logical path (e.g. output/step2a_cleaned_text.json);
+# the actual file depends on the configured format (sqlite: output/step2a_cleaned_text.sqlite)
+_artifact_format = DEFAULT_ARTIFACT_FORMAT
+
+def configure_artifact_format(artifact_format=DEFAULT_ARTIFACT_FORMAT):
+    """
+    パイプライン全体で中間成果物の保存に使う形式（'sqlite' または 'json'）を設定します。
+    Configures the format the whole pipeline uses to store intermediate artifacts ('sqlite' or 'json').
+    """
+    global _artifact_format
+    if artifact_format not in ARTIFACT_FORMATS:
+        raise ValueError(f"Unknown artifact format: {artifact_format}")
+    _artifact_format = artifact_format
+    return _artifact_format
+
+def get_artifact_format():
+    """現在の中間成果物の形式を返す / Returns the current artifact format"""
+    return _artifact_format
+
+def artifact_path(path, artifact_format=None):
+    """論理パスに対応する、指定した形式（省略時は現在の形式）の実際のファイルのパスを返す / Returns the actual file path for a logical path in the given format (the current format if omitted)"""
+    if (artifact_format or _artifact_format) == 'sqlite':
+        return os.path.splitext(path)[0] + SQLITE_SUFFIX
+    return path
+
+def _readable_path(path):
+    """
+    読み込む実際のファイルと形式を返す。現在の形式のファイルがなければ、もう一方の形式のファイル（以前の実行の出力など）を使う。
+    Returns the actual file and format to read. Falls back to the other format's file (e.g. output of an earlier run) if the current one does not exist.
+    """
+    for artifact_format in [_artifact_format] + [f for f in ARTIFACT_FORMATS if f != _artifact_format]:
+        physical_path = artifact_path(path, artifact_format)
+        if os.path.exists(physical_path):
+            return physical_path, artifact_format
+    raise FileNotFoundError(2, "No such artifact", path)
+
+def artifact_exists(path):
+    try:
+        _readable_path(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+# --- SQLite --- #
+# レコードは最大 DEFAULT_CHUNK_SIZE 件ずつのチャンクに分け、チャンクの列ごとに値のJSON配列をzlibで圧縮して1行に保存する（列指向）。
+# 列の射影ではその列の行だけを読み、圧縮はチャンク内のレコードをまたいで効く。
+# Records are split into chunks of up to DEFAULT_CHUNK_SIZE, and each column of a chunk is stored as one row holding a zlib-compressed JSON array of its values (columnar).
+# Projecting columns reads only their rows, and compression works across the records of a chunk.
+
+_SQLITE_SCHEMA = [
+    # start: チャンクの最初のレコードの番号, keys: チャンクに現れたキー（最初に現れた順） / start: index of the chunk's first record, keys: keys in the chunk (in first-seen order)
+    "CREATE TABLE IF NOT EXISTS chunks (start INTEGER PRIMARY KEY, count INTEGER NOT NULL, keys TEXT NOT NULL)",
+    # missing: その列のキーがないレコードのチャンク内の位置（なければNULL） / missing: positions in the chunk of records without the column's key (NULL if none)
+    "CREATE TABLE IF NOT EXISTS columns (start INTEGER NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, missing TEXT, PRIMARY KEY (start, name))",
+]
+
+def _compress_json(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'), COMPRESSION_LEVEL)
+
+def _decompress_json(data):
+    return json.loads(zlib.decompress(data))
+
+class _SqliteWriter:
+    def __init__(self, physical_path, append):
+        self.path = physical_path
+        self._conn = sqlite3.connect(physical_path)
+        for statement in _SQLITE_SCHEMA:
+            self._conn.execute(statement)
+        if not append:
+            # 一時ファイルは完成後に置き換えるため、ジャーナルと同期を省いて書き込みを速くする
+            # The temporary file replaces the artifact only when complete, so journaling and syncing are skipped for speed
+            self._conn.execute("PRAGMA journal_mode=OFF")
+            self._conn.execute("PRAGMA synchronous=OFF")
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM columns")
+        self._count = self._conn.execute("SELECT COALESCE(SUM(count), 0) FROM chunks").fetchone()[0]
+        self._conn.commit()
+
+    def write(self, records):
+        for i in range(0, len(records), DEFAULT_CHUNK_SIZE):
+            chunk = records[i:i + DEFAULT_CHUNK_SIZE]
+            keys = list(dict.fromkeys(key for record in chunk for key in record))
+            self._conn.execute("INSERT INTO chunks (start, count, keys) VALUES (?, ?, ?)", (self._count, len(chunk), json.dumps(keys, ensure_ascii=False)))
+            rows = []
+            for key in keys:
+                missing = [position for position, record in enumerate(chunk) if key not in record]
+                values = [record.get(key) for record in chunk]
+                rows.append((self._count, key, _compress_json(values), json.dumps(missing) if missing else None))
+            self._conn.executemany("INSERT INTO columns (start, name, data, missing) VALUES (?, ?, ?, ?)", rows)
+            self._count += len(chunk)
+        self._conn.commit()
+        return self._count
+
+    def close(self):
+        self._conn.close()
+
+def _iter_sqlite_chunks(physical_path, columns):
+    conn = sqlite3.connect(physical_path)
+    try:
+        wanted = None if columns is None else set(columns)
+        for start, count, keys in conn.execute("SELECT start, count, keys FROM chunks ORDER BY start").fetchall():
+            selected = [key for key in json.loads(keys) if wanted is None or key in wanted]
+            records = [{} for _ in range(count)]
+            if selected:
+                placeholders = ", ".join("?" for _ in selected)
+                stored = {
+                    name: (data, missing) for name, data, missing in
+                    conn.execute(f"SELECT name, data, missing FROM columns WHERE start = ? AND name IN ({placeholders})", (start, *selected))
+                }
+                for key in selected:
+                    data, missing = stored[key]
+                    missing = set(json.loads(missing)) if missing else ()
+                    for position, value in enumerate(_decompress_json(data)):
+                        if position not in missing:
+                            records[position][key] = value
+            yield records
+    finally:
+        conn.close()
+
+# --- JSON --- #
+
+class _JsonWriter:
+    """
+    .json はインデント付きのJSON配列（デバッグ用に読みやすい形式）、.jsonl は1行1レコードで書き出す。
+    Writes .json as an indented JSON array (readable for debugging) and .jsonl as one record per line.
+    """
+
+    def __init__(self, physical_path, append, lines):
+        self.path = physical_path
+        self._lines = lines
+        if append and not self._lines:
+            raise ValueError(f"Appending is only supported for JSONL artifacts: {physical_path}")
+        self._file = open(physical_path, 'a' if append else 'w', encoding='utf-8')
+        self._count = 0
+        if not self._lines:
+            self._file.write("[")
+
+    def write(self, records):
+        if self._lines:
+            self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+        else:
+            for record in records:
+                # json.dump(records, indent=2) と同じ形式で1件ずつ書き出す
+                # Write records one at a time in the same layout as json.dump(records, indent=2)
+                separator = ",\n  " if self._count else "\n  "
+                self._file.write(separator + json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n  "))
+                self._count += 1
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        if not self._lines:
+            self._file.write("\n]" if self._count else "]")
+        self._file.close()
+
+def _iter_json_chunks(physical_path, columns, chunk_size):
+    def project(record):
+        return record if columns is None else {column: record[column] for column in columns if column in record}
+
+    with open(physical_path, 'r', encoding='utf-8') as f:
+        if physical_path.endswith(".jsonl"):
+            records = (json.loads(line) for line in f if line.strip())
+        else:
+            records = iter(json.load(f))
+        chunk = []
+        for record in records:
+            chunk.append(project(record))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+# --- 公開API / Public API --- #
+
+class ArtifactWriter:
+    """
+    中間成果物にレコードを書き込むライター。write() は書き込んだレコードを確定させ、再開時の切り詰め位置（オフセット）を返す。
+    追記しない場合は一時ファイルに書き込み、close() で原子的に置き換える。
+    A writer appending records to an intermediate artifact. write() commits the records and returns the offset used as the truncation point on resume.
+    Without append, records go to a temporary file that atomically replaces the artifact on close().
+    """
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.physical_path = artifact_path(path)
+        os.makedirs(os.path.dirname(self.physical_path) or ".", exist_ok=True)
+        self._append = append
+        target = self.physical_path if append else self.physical_path + ".tmp"
+        if not append and os.path.exists(target):
+            os.remove(target)
+        if _artifact_format == 'sqlite':
+            self._writer = _SqliteWriter(target, append)
+        else:
+            self._writer = _JsonWriter(target, append, lines=path.endswith(".jsonl"))
+        self.count = 0
+
+    def write(self, records):
+        records = list(records)
+        self.count += len(records)
+        return self._writer.write(records)
+
+    def close(self):
+        self._writer.close()
+        if not self._append:
+            os.replace(self.physical_path + ".tmp", self.physical_path)
+
+    def abort(self):
+        """書き込みを破棄する（追記でない場合、元の成果物は変更されない） / Discards the writes (without append, the original artifact is left unchanged)"""
+        self._writer.close()
+        if not self._append and os.path.exists(self.physical_path + ".tmp"):
+            os.remove(self.physical_path + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def write_records(path, records, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    レコードのイテラブルを中間成果物として書き出し、書き出したレコード数を返す。レコードは chunk_size 件ずつ書き込まれる。
+    Writes an iterable of records as an intermediate artifact and returns the number written. Records are written chunk_size at a time.
+    """
+    with ArtifactWriter(path) as writer:
+        chunk = []
+        for record in records:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                writer.write(chunk)
+                chunk = []
+        writer.write(chunk)
+    return writer.count
+
+def iter_record_chunks(path, columns=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    中間成果物のレコードを chunk_size 件ずつのリストで返す。columns を指定すると、そのキーだけを読み込む（SQLiteでは他の列を読まない）。
+    Yields an artifact's records as lists of chunk_size records. With columns, only those keys are read (SQLite does not read the other columns).
+    """
+    physical_path, artifact_format = _readable_path(path)
+    if artifact_format == 'sqlite':
+        stored_chunks = _iter_sqlite_chunks(physical_path, columns)
+    else:
+        stored_chunks = _iter_json_chunks(physical_path, columns, chunk_size)
+    pending = []
+    for stored_chunk in stored_chunks:
+        pending.extend(stored_chunk)
+        while len(pending) >= chunk_size:
+            yield pending[:chunk_size]
+            pending = pending[chunk_size:]
+    if pending:
+        yield pending
+
+def iter_records(path, columns=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """中間成果物のレコードを1件ずつ返す / Yields an artifact's records one at a time"""
+    for chunk in iter_record_chunks(path, columns=columns, chunk_size=chunk_size):
+        yield from chunk
+
+def load_records(path, columns=None):
+    """中間成果物の全てのレコードをリストで返す / Returns all of an artifact's records as a list"""
+    return list(iter_records(path, columns=columns))
+
+def artifact_offset(path):
+    """現在の形式の中間成果物の末尾のオフセット（JSONLはバイト数、SQLiteはレコード数）を返す。なければNone / Returns the end offset of the artifact in the current format (bytes for JSONL, records for SQLite), or None if missing"""
+    physical_path = artifact_path(path)
+    if not os.path.exists(physical_path):
+        return None
+    if _artifact_format == 'sqlite':
+        conn = sqlite3.connect(physical_path)
+        try:
+            return conn.execute("SELECT COALESCE(SUM(count), 0) FROM chunks").fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+    return os.path.getsize(physical_path)
+
+def truncate_artifact(path, offset):
+    """中間成果物を ArtifactWriter.write() が返したオフセットまで切り詰める / Truncates an artifact to an offset returned by ArtifactWriter.write()"""
+    physical_path = artifact_path(path)
+    if not os.path.exists(physical_path):
+        return
+    if _artifact_format == 'sqlite':
+        conn = sqlite3.connect(physical_path)
+        try:
+            # write() が返すオフセットは常にチャンクの境界にある / Offsets returned by write() always fall on chunk boundaries
+            conn.execute("DELETE FROM chunks WHERE start >= ?", (offset,))
+            conn.execute("DELETE FROM columns WHERE start >= ?", (offset,))
+            conn.commit()
+        finally:
+            conn.close()
+    else:
+        with open(physical_path, 'r+b') as f:
+            f.truncate(offset)
+
+def export_json(path, output_path=None):
+    """
+    中間成果物をデバッグ用のJSON（.json はインデント付きの配列、.jsonl は1行1レコード）として書き出し、書き出したパスを返す。
+    Exports an artifact as JSON for debugging (.json as an indented array, .jsonl as one record per line) and returns the written path.
+    """
+    output_path = output_path or path
+    if _readable_path(path)[0] == output_path:
+        return output_path
+    writer = _JsonWriter(output_path + ".tmp", append=False, lines=output_path.endswith(".jsonl"))
+    try:
+        for chunk in iter_record_chunks(path):
+            writer.write(chunk)
+    finally:
+        writer.close()
+    os.replace(output_path + ".tmp", output_path)
+    return output_path
+
+if __name__ == "__main__":
+    # 使い方: python -m src.artifact_store <論理パス>... （例: output/step2a_cleaned_text.json）
+    # Usage: python -m src.artifact_store <logical path>... (e.g. output/step2a_cleaned_text.json)
+    for logical_path in sys.argv[1:]:
+        exported_path = export_json(logical_path)
+        print(f"{exported_path} に書き出しました / Exported to {exported_path}")
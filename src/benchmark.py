@@ -0,0 +1,339 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import time
+from datetime import datetime, timezone
+from . import artifact_store
+from . import llm_utils
+from .main import STEP_MODULES, load_module
+
+# --- 定数 --- #
+# --- Constants --- #
+DEMO_PDF_PATH = "input/demo.pdf"
+BASELINE_PATH = "benchmarks/baseline.json"
+RESULTS_PATH = "output/benchmark/results.json"
+WORK_DIR = "output/benchmark"
+DEFAULT_CORPORA = ["demo", "synthetic-10x", "synthetic-100x"]
+BENCHMARK_STEPS = ["step1", "step2a", "step2b", "step3b", "step4", "step5"]
+LLM_STEPS = ["step2a", "step2b", "step3b", "step4"]
+PROMPT_FILES = ["paragraph_cleaning_prompt.md", "entity_extraction_prompt.md", "relation_extraction_batch_prompt.md", "entity_normalization_prompt.md"]
+DEFAULT_MODEL = "gemini-2.5-flash-lite"
+DEFAULT_SEED = 0
+DEFAULT_TIME_TOLERANCE = 0.25  # 基準より25%以上遅ければ劣化とみなす / Slower than the baseline by 25% or more counts as a regression
+DEFAULT_MEMORY_TOLERANCE = 0.20  # 基準より20%以上メモリを使えば劣化とみなす / Using 20% or more memory than the baseline counts as a regression
+MIN_TIME_DIFFERENCE_SECONDS = 0.5  # これより小さい時間の差は測定の揺らぎとして無視する / Time differences below this are ignored as measurement noise
+SYNTHETIC_CORPUS_PATTERN = re.compile(r"synthetic-(\d+)x")
+
+# 各ステップの処理件数を数える成果物と列（step5はエッジのCSVの行数） / Artifact and column used to count each step's items (step5 counts edge CSV rows)
+STEP_ITEMS = {
+    "step1": ("output/step1_structured_text.json", "page_number"),
+    "step2a": ("output/step2a_cleaned_text.json", "paragraph"),
+    "step2b": ("output/step2b_entities.json", "term"),
+    "step3b": ("output/step3b_relations.jsonl", "source"),
+    "step4": ("output/step4_normalized_relations.jsonl", "source"),
+    "step5": ("output/step5_edges.csv", None),
+}
+
+# 合成コーパスの語彙。部品を組み合わせて、ページが増えるほど多くの用語が現れるようにする
+# Vocabulary of the synthetic corpus. Parts are combined so that more pages bring more distinct terms
+SYNTHETIC_VOCABULARY = {
+    "disease": (["三叉", "舌咽", "顎関節", "筋筋膜", "非定型", "持続性", "特発性", "末梢性", "中枢性", "神経障害性", "上顎洞", "帯状疱疹後"], ["神経痛", "歯痛", "顔面痛", "症", "炎", "障害"]),
+    "symptom": (["拍動性", "持続性", "発作性", "灼熱性", "放散性", "夜間"], ["疼痛", "しびれ", "腫脹", "違和感", "圧痛"]),
+    "drug": (["カルバ", "プレガ", "アミト", "ガバペ", "デュロ", "ミロガ", "リドカ", "トラマ"], ["マゼピン", "バリン", "リプチリン", "ンチン", "キセチン", "ドール"]),
+    "treatment": (["星状神経節", "三叉神経", "局所", "認知", "理学", "咬合"], ["ブロック", "療法", "麻酔", "調整"]),
+    "anatomy": (["上顎", "下顎", "側頭", "咬筋", "舌"], ["部", "領域", "周囲"]),
+    "test": (["画像", "触診", "電気", "血液", "咬合"], ["検査", "診断", "評価"]),
+}
+SYNTHETIC_SENTENCES = [
+    "{disease}は{symptom}を主な症状とする。",
+    "{drug}は{disease}に有効である。",
+    "{disease}の治療には{treatment}が用いられる。",
+    "{symptom}は{disease}の症状として知られている。",
+    "{disease}では{anatomy}に{symptom}を伴うことが多い。",
+    "{drug}は{disease}には有効ではない。",
+    "{disease}の診断には{test}が用いられる。",
+    "症例{number}では{drug}の投与後に{symptom}が改善した。",
+]
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4（ポイント） / A4 in points
+PAGE_MARGIN = 56
+FONT_SIZE = 10.5
+LINE_HEIGHT = 1.5
+CHARS_PER_LINE = 44
+PARAGRAPHS_PER_PAGE = 6
+CITATION_RATE = 0.3  # 引用マーカーを付けてLLMによるクレンジングに回す段落の割合 / Fraction of paragraphs given a citation marker so that they go through LLM cleaning
+
+def synthetic_term(rng, kind):
+    prefixes, suffixes = SYNTHETIC_VOCABULARY[kind]
+    return rng.choice(prefixes) + rng.choice(suffixes)
+
+def synthetic_paragraph(rng):
+    """語彙から文を組み合わせて段落を作る / Builds a paragraph by combining sentences from the vocabulary"""
+    sentences = []
+    for _ in range(rng.randint(3, 5)):
+        values = {kind: synthetic_term(rng, kind) for kind in SYNTHETIC_VOCABULARY}
+        sentences.append(rng.choice(SYNTHETIC_SENTENCES).format(number=rng.randint(1, 999), **values))
+    paragraph = "".join(sentences)
+    if rng.random() < CITATION_RATE:
+        paragraph += f"[{rng.randint(1, 60)}]"
+    return paragraph
+
+def write_synthetic_pdf(path, page_count, seed=DEFAULT_SEED):
+    """
+    合成した医学風の日本語の段落で page_count ページのPDFを書き出す。各ページにはページ番号のフッターが付く。
+    Writes a page_count-page PDF of synthesized medical-style Japanese paragraphs. Every page has a page-number footer.
+    """
+    import fitz  # PyMuPDF
+    rng = random.Random(seed)
+    line_step = FONT_SIZE * LINE_HEIGHT
+    document = fitz.open()
+    for page_number in range(1, page_count + 1):
+        page = document.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        y = PAGE_MARGIN
+        for _ in range(PARAGRAPHS_PER_PAGE):
+            paragraph = synthetic_paragraph(rng)
+            lines = [paragraph[i:i + CHARS_PER_LINE] for i in range(0, len(paragraph), CHARS_PER_LINE)]
+            page.insert_text((PAGE_MARGIN, y), "\n".join(lines), fontname="japan", fontsize=FONT_SIZE, lineheight=LINE_HEIGHT)
+            y += (len(lines) + 1) * line_step
+        page.insert_text((PAGE_WIDTH / 2 - 10, PAGE_HEIGHT - PAGE_MARGIN / 2), f"- {page_number} -", fontname="japan", fontsize=9)
+    document.save(path)
+    document.close()
+
+def pdf_page_count(path):
+    import fitz  # PyMuPDF
+    with fitz.open(path) as document:
+        return document.page_count
+
+def prepare_corpus(corpus, work_dir, seed=DEFAULT_SEED):
+    """
+    コーパスの作業ディレクトリ（入力PDFとプロンプト）を作り直し、入力PDFのパスとページ数を返す。
+    "demo" は input/demo.pdf、"synthetic-<N>x" は demo.pdf のN倍のページ数の合成PDFを使う。
+    Recreates a corpus's working directory (input PDF and prompts) and returns the input PDF path and page count.
+    "demo" uses input/demo.pdf and "synthetic-<N>x" a synthetic PDF with N times as many pages as demo.pdf.
+    """
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(os.path.join(work_dir, "input"))
+    os.makedirs(os.path.join(work_dir, "logs"))
+    for prompt_file in PROMPT_FILES:
+        shutil.copy(prompt_file, os.path.join(work_dir, prompt_file))
+    input_path = os.path.join("input", f"{corpus}.pdf")
+    if corpus == "demo":
+        shutil.copy(DEMO_PDF_PATH, os.path.join(work_dir, input_path))
+    else:
+        match = SYNTHETIC_CORPUS_PATTERN.fullmatch(corpus)
+        if not match:
+            raise ValueError(f"不明なコーパスです: {corpus} / Unknown corpus: {corpus}")
+        write_synthetic_pdf(os.path.join(work_dir, input_path), pdf_page_count(DEMO_PDF_PATH) * int(match.group(1)), seed=seed)
+    return input_path, pdf_page_count(os.path.join(work_dir, input_path))
+
+def count_items(step_name):
+    """ステップの出力の件数を数える / Counts the items in a step's output"""
+    path, column = STEP_ITEMS[step_name]
+    if column is None:
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+            return sum(1 for _ in csv.DictReader(f))
+    if not artifact_store.artifact_exists(path):
+        return 0
+    return sum(len(chunk) for chunk in artifact_store.iter_record_chunks(path, columns=[column]))
+
+def step_kwargs(step_name, input_path, options):
+    if step_name == "step1":
+        return {"input_path": input_path, "workers": options["workers"]}
+    if step_name in LLM_STEPS:
+        return {"model_name": options["model"]}
+    return {}
+
+def peak_memory_mb():
+    """
+    このプロセスと終了した子プロセスの最大常駐メモリ（MB）。Linuxでは ru_maxrss が親プロセスの値を引き継ぐため、/proc の VmHWM を優先する。
+    Peak resident memory of this process and its finished children in MB. On Linux ru_maxrss carries over the parent's value, so VmHWM from /proc is preferred.
+    """
+    own_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open("/proc/self/status", 'r') as f:
+            own_kb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        pass
+    peak_kb = max(own_kb, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak_kb / 1024, 1)
+
+def run_step_process(step_name, work_dir, input_path, options, connection):
+    """
+    新しいプロセスで1つのステップを実行し、計測結果を connection に送る。ステップの出力はログファイルに書き出す。
+    Runs one step in a fresh process and sends its measurements to connection. The step's output goes to a log file.
+    """
+    os.chdir(work_dir)
+    with open(os.path.join("logs", f"{step_name}.log"), 'w', encoding='utf-8') as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), sys.stdout.fileno())
+        os.dup2(log.fileno(), sys.stderr.fileno())
+        artifact_store.configure_artifact_format(options["artifact_format"])
+        llm_utils.configure_model_backend("fake", latency=options["latency"], error_rate=options["error_rate"], seed=options["seed"])
+        llm_utils.configure_cache(enabled=False)
+        llm_utils.configure_concurrency(options["concurrency"])
+        llm_utils.reset_llm_stats()
+
+        started = time.perf_counter()
+        module = load_module(STEP_MODULES[step_name])
+        import_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        module.main(**step_kwargs(step_name, input_path, options))
+        wall_seconds = time.perf_counter() - started
+        sys.stdout.flush()
+
+    items = count_items(step_name)
+    stats = llm_utils.get_llm_stats()
+    connection.send({
+        "wall_seconds": round(wall_seconds, 3),
+        "import_seconds": round(import_seconds, 3),
+        "peak_memory_mb": peak_memory_mb(),
+        "items": items,
+        "items_per_second": round(items / wall_seconds, 1) if wall_seconds > 0 else None,
+        "llm_calls": stats["calls"],
+        "llm_failures": stats["failures"],
+        "prompt_tokens": stats["prompt_tokens"],
+        "output_tokens": stats["output_tokens"],
+    })
+    connection.close()
+
+def run_step(step_name, work_dir, input_path, options):
+    """ステップを別のプロセスで実行し、計測結果を返す（失敗した場合はNone） / Runs a step in a separate process and returns its measurements (None on failure)"""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_step_process, args=(step_name, work_dir, input_path, options, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    return result if process.exitcode == 0 else None
+
+def run_benchmarks(corpora, options, work_root=WORK_DIR):
+    """
+    各コーパスについて step1〜step5 を1ステップずつ新しいプロセスで実行し、結果の辞書を返す。
+    Runs step1-step5 for each corpus, each step in a fresh process, and returns a dict of results.
+    """
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "options": options,
+        "corpora": {},
+    }
+    for corpus in corpora:
+        work_dir = os.path.abspath(os.path.join(work_root, corpus))
+        input_path, pages = prepare_corpus(corpus, work_dir, seed=options["seed"])
+        print(f"\n--- コーパス {corpus} ({pages}ページ) / Corpus {corpus} ({pages} pages) ---")
+        steps = {}
+        for step_name in BENCHMARK_STEPS:
+            result = run_step(step_name, work_dir, input_path, options)
+            if result is None:
+                print(f"  {step_name}: 失敗しました。ログを確認してください: {os.path.join(work_dir, 'logs', step_name + '.log')} / {step_name}: failed, see the log")
+                break
+            steps[step_name] = result
+            print(f"  {step_name}: {result['wall_seconds']:.2f}s, {result['items']}件 ({result['items_per_second']}/s), LLM {result['llm_calls']}回 / calls, {result['prompt_tokens'] + result['output_tokens']}トークン / tokens, {result['peak_memory_mb']}MB")
+        results["corpora"][corpus] = {"pages": pages, "steps": steps}
+    return results
+
+def compare_results(results, baseline, time_tolerance=DEFAULT_TIME_TOLERANCE, memory_tolerance=DEFAULT_MEMORY_TOLERANCE):
+    """
+    結果を基準と比較し、(コーパス, ステップ, 指標, 基準値, 今回の値, 劣化かどうか) のリストを返す。
+    偽のモデルは決定的なため、LLM呼び出し数とトークン数は増えただけで劣化とみなす。
+    Compares results with the baseline and returns a list of (corpus, step, metric, baseline value, current value, is regression).
+    The fake model is deterministic, so any increase in LLM calls or tokens counts as a regression.
+    """
+    rows = []
+    for corpus, corpus_results in results["corpora"].items():
+        baseline_steps = baseline.get("corpora", {}).get(corpus, {}).get("steps", {})
+        for step_name, current in corpus_results["steps"].items():
+            previous = baseline_steps.get(step_name)
+            if previous is None:
+                continue
+            checks = {
+                "wall_seconds": current["wall_seconds"] > previous["wall_seconds"] * (1 + time_tolerance)
+                                and current["wall_seconds"] - previous["wall_seconds"] > MIN_TIME_DIFFERENCE_SECONDS,
+                "peak_memory_mb": current["peak_memory_mb"] > previous["peak_memory_mb"] * (1 + memory_tolerance),
+                "llm_calls": current["llm_calls"] > previous["llm_calls"],
+                "prompt_tokens": current["prompt_tokens"] > previous["prompt_tokens"],
+                "output_tokens": current["output_tokens"] > previous["output_tokens"],
+                "items": False,
+            }
+            for metric, regressed in checks.items():
+                rows.append((corpus, step_name, metric, previous.get(metric), current.get(metric), regressed))
+    return rows
+
+def print_comparison(rows):
+    """基準との比較を表示し、劣化の件数を返す / Prints the comparison with the baseline and returns the number of regressions"""
+    print("\n--- 基準との比較 / Comparison with the baseline ---")
+    print(f"{'corpus':<16} {'step':<7} {'metric':<15} {'baseline':>10} {'current':>10} {'change':>8}")
+    for corpus, step_name, metric, previous, current, regressed in rows:
+        change = f"{(current - previous) / previous:+.0%}" if previous else "-"
+        mark = "  <- 劣化 / regression" if regressed else ""
+        print(f"{corpus:<16} {step_name:<7} {metric:<15} {previous:>10} {current:>10} {change:>8}{mark}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"劣化: {regressions}件 / Regressions: {regressions}")
+    return regressions
+
+def save_json(data, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="偽のLLMを使ったオフラインのベンチマーク / Offline benchmarks with a fake LLM")
+    parser.add_argument('--corpora', nargs='+', default=DEFAULT_CORPORA, help='実行するコーパス（demo または synthetic-<N>x） / Corpora to run (demo or synthetic-<N>x)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='比較する基準の結果 / Baseline results to compare against')
+    parser.add_argument('--output', default=RESULTS_PATH, help='今回の結果の保存先 / Where to save the results of this run')
+    parser.add_argument('--update-baseline', action='store_true', help='今回の結果を基準として保存します / Save this run as the baseline')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='偽装するモデル名 / Model name to fake')
+    parser.add_argument('--latency', type=float, default=0.0, help='偽のLLMの1回の呼び出しの平均遅延（秒） / Mean latency of one fake LLM call in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='偽のLLMが一時的なエラーを返す割合 / Fraction of fake LLM calls failing with a transient error')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='合成コーパスと偽のLLMのシード / Seed of the synthetic corpora and the fake LLM')
+    parser.add_argument('--concurrency', type=int, default=1, help='同時に実行するLLM呼び出し数 / Number of concurrent LLM calls')
+    parser.add_argument('--workers', type=int, default=1, help='step1のプロセス数 / Number of step1 processes')
+    parser.add_argument('--artifact-format', default=artifact_store.DEFAULT_ARTIFACT_FORMAT, choices=artifact_store.ARTIFACT_FORMATS, help='中間成果物の保存形式 / Storage format for intermediate artifacts')
+    parser.add_argument('--time-tolerance', type=float, default=DEFAULT_TIME_TOLERANCE, help='劣化とみなす実行時間の増加率 / Increase in wall time counted as a regression')
+    parser.add_argument('--memory-tolerance', type=float, default=DEFAULT_MEMORY_TOLERANCE, help='劣化とみなすメモリ使用量の増加率 / Increase in peak memory counted as a regression')
+    args = parser.parse_args(argv)
+
+    options = {
+        "model": args.model,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "workers": args.workers,
+        "artifact_format": args.artifact_format,
+    }
+    results = run_benchmarks(args.corpora, options)
+    save_json(results, args.output)
+    print(f"\n結果を {args.output} に保存しました。 / Saved the results to {args.output}.")
+
+    if args.update_baseline:
+        save_json(results, args.baseline)
+        print(f"基準を {args.baseline} に保存しました。 / Saved the baseline to {args.baseline}.")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"基準 {args.baseline} がないため比較しません。 / No baseline at {args.baseline}; skipping the comparison.")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    if baseline.get("options") != options:
+        print("警告: 基準とは異なる設定で実行しました。 / Warning: this run used different options from the baseline.")
+    regressions = print_comparison(compare_results(results, baseline, args.time_tolerance, args.memory_tolerance))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
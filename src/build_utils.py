@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import time
+
+# --- 定数 --- #
+# --- Constants --- #
+BUILD_STATE_PATH = "output/build_state.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path):
+    """ファイル内容のSHA-256ハッシュを返す（ファイルがなければNone） / Returns the SHA-256 hash of a file's content (None if the file does not exist)"""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def step_signature(spec, params):
+    """
+    ステップの入力ファイル・プロンプトファイルのハッシュと、出力に影響するパラメータ（モデル名など）からシグネチャを作る。
+    Builds a step's signature from the hashes of its input and prompt files and the parameters that affect its output (model name etc.).
+
+    Args:
+        spec: "inputs"、"prompts"、"outputs"（パスのリスト）を持つステップ定義。 / A step definition with "inputs", "prompts" and "outputs" (lists of paths).
+        params: 出力に影響するパラメータの辞書。 / A dict of the parameters that affect the output.
+    """
+    return {
+        "inputs": {path: hash_file(path) for path in spec.get("inputs", [])},
+        "prompts": {path: hash_file(path) for path in spec.get("prompts", [])},
+        "params": params,
+    }
+
+class BuildState:
+    """
+    各ステップが最後に成功したときのシグネチャを記録するビルド状態ファイル。
+    A build state file recording each step's signature from its last successful run.
+    """
+
+    def __init__(self, path=BUILD_STATE_PATH):
+        self.path = path
+        self.steps = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.steps = json.load(f)
+            except json.JSONDecodeError:
+                print(f"警告: ビルド状態ファイルを読み込めないため、全てのステップを再実行します: {path} / Warning: Could not read the build state file, all steps will run: {path}")
+
+    def stale_reason(self, step_name, spec, signature):
+        """ステップを再実行する理由を返す（最新ならNone） / Returns why a step must run (None if it is up to date)"""
+        previous = self.steps.get(step_name)
+        if previous is None:
+            return "前回の実行記録なし / no previous run"
+        missing = [path for path in spec.get("outputs", []) if not os.path.exists(path)]
+        if missing:
+            return f"出力なし / output missing: {missing[0]}"
+        for kind, label in (("inputs", "入力の変更 / input changed"), ("prompts", "プロンプトの変更 / prompt changed")):
+            for path, digest in signature[kind].items():
+                if previous.get(kind, {}).get(path) != digest:
+                    return f"{label}: {path}"
+        if previous.get("params") != signature["params"]:
+            changed = sorted(key for key in set(previous.get("params", {})) | set(signature["params"])
+                             if previous.get("params", {}).get(key) != signature["params"].get(key))
+            return f"パラメータの変更 / parameters changed: {', '.join(changed)}"
+        return None
+
+    def record(self, step_name, signature):
+        """ステップの成功を記録し、状態ファイルを原子的に書き換える / Records a successful step and atomically rewrites the state file"""
+        self.steps[step_name] = dict(signature, completed_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        self._save()
+
+    def invalidate(self, step_name):
+        """
+        ステップの記録を削除する。ステップの開始前に呼び、途中で中断された実行が最新として扱われないようにする。
+        Removes a step's record. Called before a step starts, so that a run interrupted partway is not treated as up to date.
+        """
+        if self.steps.pop(step_name, None) is not None:
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(self.steps, f, ensure_ascii=False, indent=2)
+        os.replace(temporary_path, self.path)
+
+def decide_step(state, step_name, spec, signature, forced=False, upstream_rerun=False, always_run_reason=None):
+    """
+    ステップを実行するかを決め、(実行するか, 理由) を返す。
+    強制指定、常時実行の理由、上流ステップの再実行、シグネチャの変更の順に判定する。
+    Decides whether to run a step and returns (run, reason).
+    Checks, in order: forced, an always-run reason, an upstream rerun, and a changed signature.
+    """
+    if forced:
+        return True, "--force"
+    if always_run_reason:
+        return True, always_run_reason
+    if upstream_rerun:
+        return True, "上流ステップの再実行 / upstream step reran"
+    reason = state.stale_reason(step_name, spec, signature)
+    if reason is not None:
+        return True, reason
+    return False, "最新 / up to date"
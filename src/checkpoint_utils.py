@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import threading
+from .llm_utils import map_concurrently
+
+# --- 定数 --- #
+# --- Constants --- #
+CHECKPOINT_DIR = "output/checkpoints"
+
+def compute_fingerprint(data):
+    """
+    処理単位の入力からフィンガープリントを計算する。入力が変わった単位は再実行される。
+    Computes a fingerprint from the input of a unit. Units whose input changed are processed again.
+    """
+    payload = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def append_lines_atomic(f, lines):
+    """
+    複数行を1回の書き込みでファイルに追記し、ディスクに同期する。
+    戻り値は書き込み後のファイルサイズ（オフセット）で、再開時の切り詰め位置として使う。
+    Appends several lines to a file in a single write and syncs it to disk.
+    Returns the file size (offset) after the write, used as the truncation point on resume.
+    """
+    if lines:
+        f.write("".join(line + "\n" for line in lines))
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+
+def truncate_file(path, offset):
+    """ファイルを指定オフセットまで切り詰める（書き込み途中で中断された行を除去） / Truncates a file to the given offset (removes lines torn by an interruption)"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'r+b') as f:
+        f.truncate(offset)
+
+class UnitJournal:
+    """
+    完了した処理単位（バッチ）を記録する追記専用のチェックポイントマニフェスト。
+    各行は {"unit": キー, "fingerprint": ..., "result": ..., ...} で、1行ずつ原子的に追記されます。
+    再開モードでは、フィンガープリントが一致する完了済み単位をスキップし、保存済みの結果を再利用します。
+    An append-only checkpoint manifest recording completed units (batches).
+    Each line is {"unit": key, "fingerprint": ..., "result": ..., ...} and is appended atomically.
+    In resume mode, completed units with a matching fingerprint are skipped and their stored results reused.
+    """
+
+    def __init__(self, name, resume=False, checkpoint_dir=CHECKPOINT_DIR):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.path = os.path.join(checkpoint_dir, f"{name}.jsonl")
+        self._lock = threading.Lock()
+        self.completed = {}
+        if resume:
+            self._load()
+        else:
+            # 新規実行ではマニフェストをリセットする
+            # A fresh run resets the manifest
+            open(self.path, 'w', encoding='utf-8').close()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        valid_offset = 0
+        with open(self.path, 'rb') as f:
+            for raw_line in f:
+                try:
+                    entry = json.loads(raw_line.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    # 中断で壊れた末尾の行以降は無視する
+                    # Ignore the torn trailing line left by an interruption
+                    break
+                if not raw_line.endswith(b"\n"):
+                    break
+                self.completed[entry['unit']] = entry
+                valid_offset += len(raw_line)
+        truncate_file(self.path, valid_offset)
+        print(f"チェックポイントから{len(self.completed)}件の完了済み単位を読み込みました: {self.path} / Loaded {len(self.completed)} completed units from checkpoint: {self.path}")
+
+    @staticmethod
+    def unit_key(*parts):
+        """処理単位のキーを作成する（例: 段落番号とバッチ番号） / Builds a unit key (e.g. paragraph index and batch index)"""
+        return ":".join(str(part) for part in parts)
+
+    def get(self, key, fingerprint):
+        """フィンガープリントが一致する完了済み単位の記録を返す（なければNone） / Returns the record of a completed unit with a matching fingerprint (None otherwise)"""
+        entry = self.completed.get(key)
+        if entry is not None and entry.get('fingerprint') == fingerprint:
+            return entry
+        return None
+
+    def is_done(self, key, fingerprint):
+        return self.get(key, fingerprint) is not None
+
+    def record(self, key, fingerprint, result=None, **extra):
+        """処理単位の完了を記録する / Records the completion of a unit"""
+        entry = {"unit": key, "fingerprint": fingerprint, "result": result}
+        entry.update(extra)
+        with self._lock:
+            append_lines_atomic(self._file, [json.dumps(entry, ensure_ascii=False)])
+            self.completed[key] = entry
+
+    def close(self):
+        self._file.close()
+
+def iter_resumable(journal, units, process, record=True):
+    """
+    処理単位のリストを入力順に処理し、(unit, result, from_checkpoint) をyieldする。
+    完了済みの単位はチェックポイントの結果を返し、未完了の単位だけを並行処理する。
+    record=Trueの場合、成功した（Noneでない）結果をジャーナルに記録する。
+    Processes a list of units in input order and yields (unit, result, from_checkpoint).
+    Completed units return their checkpointed result; only pending units are processed concurrently.
+    With record=True, successful (non-None) results are recorded in the journal.
+
+    Args:
+        journal: UnitJournal（Noneの場合はチェックポイントなし）。 / The UnitJournal (None disables checkpointing).
+        units: "key"と"fingerprint"を持つ辞書のリスト。 / A list of dicts with "key" and "fingerprint".
+        process: 未完了の単位を処理する関数（失敗時はNoneを返す）。 / Function processing a pending unit (returns None on failure).
+    """
+    if journal is None:
+        for unit, result in zip(units, map_concurrently(process, units)):
+            yield unit, result, False
+        return
+
+    pending = [unit for unit in units if not journal.is_done(unit['key'], unit['fingerprint'])]
+    skipped = len(units) - len(pending)
+    if skipped:
+        print(f"チェックポイントにより{skipped}/{len(units)}単位をスキップします。 / Skipping {skipped}/{len(units)} units from checkpoint.")
+
+    pending_results = map_concurrently(process, pending)
+    for unit in units:
+        entry = journal.get(unit['key'], unit['fingerprint'])
+        if entry is not None:
+            yield unit, entry['result'], True
+            continue
+        result = next(pending_results)
+        if record and result is not None:
+            journal.record(unit['key'], unit['fingerprint'], result)
+        yield unit, result, False
@@ -0,0 +1,176 @@
+import re
+import zlib
+import numpy as np
+from collections import defaultdict
+
+# --- 定数 --- #
+# --- Constants --- #
+SHINGLE_SIZE = 5  # 文字単位のシングルの長さ / Length of character shingles
+NUM_PERMUTATIONS = 128  # MinHash署名の長さ / Length of MinHash signatures
+LSH_BANDS = 32  # LSHのバンド数（1バンドあたり NUM_PERMUTATIONS / LSH_BANDS 行） / Number of LSH bands (NUM_PERMUTATIONS / LSH_BANDS rows per band)
+DUPLICATE_JACCARD_THRESHOLD = 0.8  # 同一クラスタとみなすシングル集合のJaccard係数 / Jaccard similarity of shingle sets for paragraphs to be clustered together
+MIN_DUPLICATE_CHARS = 30  # これより短い段落は重複検出の対象外 / Paragraphs shorter than this are not checked for duplicates
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_SEED = 42
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def shingles(text, size=SHINGLE_SIZE):
+    """空白を除いて小文字化したテキストの文字シングルの集合を返す / Returns the set of character shingles of the text, with whitespace removed and lowercased"""
+    normalized = WHITESPACE_PATTERN.sub("", text).lower()
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+def jaccard(set1, set2):
+    if not set1 or not set2:
+        return 0.0
+    return len(set1 & set2) / len(set1 | set2)
+
+class MinHasher:
+    """
+    シングル集合のMinHash署名を計算する。ハッシュ関数 (a*x + b) mod p をnumpyでまとめて適用する。
+    Computes MinHash signatures of shingle sets, applying the hash functions (a*x + b) mod p together with numpy.
+    """
+
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, seed=MINHASH_SEED):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MINHASH_PRIME, size=(num_permutations, 1)).astype(np.uint64)
+        self.b = rng.randint(0, MINHASH_PRIME, size=(num_permutations, 1)).astype(np.uint64)
+
+    def signature(self, shingle_set):
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingle_set), dtype=np.uint64, count=len(shingle_set))
+        return ((self.a * hashes[np.newaxis, :] + self.b) % np.uint64(MINHASH_PRIME)).min(axis=1)
+
+class DuplicateClusters:
+    """
+    近似重複する段落のクラスタ。各段落は代表段落（クラスタ内で最初の段落）に対応付けられる。
+    Clusters of near-duplicate paragraphs. Each paragraph maps to its representative (the first paragraph in its cluster).
+    """
+
+    def __init__(self, representative_of):
+        self.representative_of = representative_of
+        self.members = defaultdict(list)
+        for index, representative in enumerate(representative_of):
+            self.members[representative].append(index)
+
+    @classmethod
+    def singletons(cls, count):
+        """重複のないクラスタ（重複検出を無効にした場合） / Clusters without duplicates (when duplicate detection is disabled)"""
+        return cls(list(range(count)))
+
+    def is_representative(self, index):
+        return self.representative_of[index] == index
+
+    @property
+    def representatives(self):
+        return [index for index in range(len(self.representative_of)) if self.is_representative(index)]
+
+    def duplicates_of(self, representative):
+        """代表段落以外のクラスタのメンバー / Members of a cluster other than its representative"""
+        return [index for index in self.members[representative] if index != representative]
+
+    @property
+    def duplicate_count(self):
+        return len(self.representative_of) - len(self.members)
+
+    def report(self, step_name, calls_without=None, calls_with=None):
+        clusters = [members for members in self.members.values() if len(members) > 1]
+        largest = max((len(members) for members in clusters), default=0)
+        print(f"[{step_name}] 近似重複: {len(self.representative_of)}段落中 {len(clusters)}クラスタ, 重複 {self.duplicate_count}段落 (最大クラスタ {largest}段落) / Near duplicates: {len(clusters)} clusters, {self.duplicate_count} duplicate paragraphs out of {len(self.representative_of)} (largest cluster {largest})")
+        if calls_without is not None and calls_with is not None:
+            print(f"[{step_name}] LLM呼び出し: {calls_without}回 → {calls_with}回 ({calls_without - calls_with}回削減) / LLM calls: {calls_without} -> {calls_with} ({calls_without - calls_with} saved)")
+
+def find_near_duplicates(texts, threshold=DUPLICATE_JACCARD_THRESHOLD, num_permutations=NUM_PERMUTATIONS,
+                         bands=LSH_BANDS, min_chars=MIN_DUPLICATE_CHARS):
+    """
+    シングリングとMinHash/LSHで近似重複するテキストをクラスタにまとめる。
+    LSHで同じバケットに入った候補ペアだけを実際のJaccard係数で検証するため、全ペア比較を行わずにコーパス規模へ拡張できる。
+    Clusters near-duplicate texts using shingling with MinHash/LSH.
+    Only candidate pairs sharing an LSH bucket are verified with the exact Jaccard similarity, so it scales to corpora without all-pairs comparison.
+
+    Returns:
+        DuplicateClusters
+    """
+    rows = num_permutations // bands
+    hasher = MinHasher(num_permutations)
+    shingle_sets = [shingles(text) if len(text) >= min_chars else set() for text in texts]
+
+    buckets = defaultdict(list)
+    for index, shingle_set in enumerate(shingle_sets):
+        if not shingle_set:
+            continue
+        signature = hasher.signature(shingle_set)
+        for band in range(bands):
+            buckets[(band, signature[band * rows:(band + 1) * rows].tobytes())].append(index)
+
+    # Union-Findでクラスタを作り、最小の番号を代表とする
+    # Build clusters with union-find, using the smallest index as the representative
+    parent = list(range(len(texts)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    verified = set()
+    for candidates in buckets.values():
+        for i, first in enumerate(candidates):
+            for second in candidates[i + 1:]:
+                if (first, second) in verified:
+                    continue
+                verified.add((first, second))
+                root1, root2 = find(first), find(second)
+                if root1 == root2:
+                    continue
+                if jaccard(shingle_sets[first], shingle_sets[second]) >= threshold:
+                    parent[max(root1, root2)] = min(root1, root2)
+
+    return DuplicateClusters([find(index) for index in range(len(texts))])
+
+class NearDuplicateIndex:
+    """
+    段落を1つずつ追加しながら近似重複を検出する増分版のLSHインデックス（ストリーミング実行用）。
+    追加した段落は、LSHバケットを共有しJaccard係数がしきい値以上の既存の代表段落のうち最も早いものに対応付けられる。
+    全体を見てから結合する find_near_duplicates と異なり、後から到着した段落によってクラスタが統合されることはない。
+    An incremental LSH index that detects near duplicates as paragraphs are added one at a time (for streaming execution).
+    Each added paragraph maps to the earliest existing representative that shares an LSH bucket and reaches the Jaccard threshold.
+    Unlike find_near_duplicates, which sees everything before merging, clusters are never merged by paragraphs arriving later.
+    """
+
+    def __init__(self, threshold=DUPLICATE_JACCARD_THRESHOLD, num_permutations=NUM_PERMUTATIONS,
+                 bands=LSH_BANDS, min_chars=MIN_DUPLICATE_CHARS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_permutations // bands
+        self.min_chars = min_chars
+        self.hasher = MinHasher(num_permutations)
+        self.buckets = defaultdict(list)
+        self.shingle_sets = {}
+        self.representative_of = []
+
+    def add(self, text):
+        """段落を追加し、その代表段落の番号を返す（重複がなければ自身の番号） / Adds a paragraph and returns the index of its representative (its own index if it has no duplicate)"""
+        index = len(self.representative_of)
+        shingle_set = shingles(text) if len(text) >= self.min_chars else set()
+        if not shingle_set:
+            self.representative_of.append(index)
+            return index
+
+        signature = self.hasher.signature(shingle_set)
+        keys = [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+        candidates = sorted({candidate for key in keys for candidate in self.buckets.get(key, [])})
+        representative = next((candidate for candidate in candidates
+                               if jaccard(self.shingle_sets[candidate], shingle_set) >= self.threshold), index)
+        self.representative_of.append(representative)
+        if representative == index:
+            # 代表段落だけをバケットに登録し、比較対象を代表段落に限る
+            # Only representatives are added to buckets, so comparisons are limited to representatives
+            self.shingle_sets[index] = shingle_set
+            for key in keys:
+                self.buckets[key].append(index)
+        return representative
+
+    @property
+    def clusters(self):
+        return DuplicateClusters(self.representative_of)
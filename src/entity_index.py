@@ -0,0 +1,85 @@
+from collections import deque
+
+class EntityIndex:
+    """
+    エンティティ用語の多パターン検索インデックス（Aho-Corasick法）。
+    実行ごとに一度だけ構築し、段落を1回走査するだけで全ての用語の出現位置（文字オフセット）を返します。
+    重なり合う出現や、他の用語に含まれる用語もすべて報告されるため、`term in paragraph` と同じ判定結果になります。
+    A multi-pattern search index over entity terms (Aho-Corasick).
+    Built once per run, it returns every term occurrence (with character offsets) in a single pass over a paragraph.
+    Overlapping occurrences and terms contained in other terms are all reported, matching the result of `term in paragraph`.
+    """
+
+    def __init__(self, terms):
+        self.terms = []
+        self._term_ids = {}
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+
+        for term in terms:
+            if not term or term in self._term_ids:
+                continue
+            self._term_ids[term] = len(self.terms)
+            self.terms.append(term)
+            self._add(term)
+        self._build_failure_links()
+
+    def _add(self, term):
+        state = 0
+        for ch in term:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(self._term_ids[term])
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and ch not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                self._fail[next_state] = self._goto[fail_state].get(ch, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def find_all(self, text):
+        """
+        テキスト中の全ての用語の出現を (開始位置, 終了位置, 用語) のリストとして、終了位置順に返す。
+        Returns all term occurrences in the text as a list of (start, end, term), ordered by end position.
+        """
+        hits = []
+        state = 0
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        for position, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                end = position + 1
+                for term_id in output[state]:
+                    term = self.terms[term_id]
+                    hits.append((end - len(term), end, term))
+        return hits
+
+    def find_mentions(self, text):
+        """
+        テキスト中に出現する用語ごとの出現位置のリストを、初出順の辞書として返す。
+        Returns a dict mapping each term found in the text to its list of (start, end) offsets, in order of first occurrence.
+        """
+        mentions = {}
+        for start, end, term in self.find_all(text):
+            mentions.setdefault(term, []).append((start, end))
+        return mentions
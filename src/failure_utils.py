@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+from .checkpoint_utils import append_lines_atomic, compute_fingerprint
+
+# --- 定数 --- #
+# --- Constants --- #
+DEAD_LETTER_DIR = "output/dead_letter"
+REPLAY_UNIT_PREFIX = "replay"
+
+def combine_results(results):
+    """
+    分割して処理した結果を結合する。リストは連結し、辞書は統合する。
+    Combines the results of split processing. Lists are concatenated and dicts are merged.
+    """
+    results = [result for result in results if result is not None]
+    if not results:
+        return None
+    if isinstance(results[0], dict):
+        combined = {}
+        for result in results:
+            combined.update(result)
+        return combined
+    combined = []
+    for result in results:
+        combined.extend(result)
+    return combined
+
+def bisect_process(items, process_items, combine=combine_results):
+    """
+    アイテムのリストをまとめて処理し、失敗した場合（process_itemsがNoneを返した場合）はリストを半分に分けて再帰的に再試行する。
+    1件まで分割しても失敗したアイテムは失敗リストとして返す。
+    Processes a list of items together; on failure (process_items returns None), splits the list in half and retries each half recursively.
+    Items that still fail on their own are returned in the failed list.
+
+    Returns:
+        (成功した部分の結合結果（全て失敗した場合はNone）, 失敗したアイテムのリスト)。
+        (the combined result of the successful parts (None if everything failed), the list of failed items).
+    """
+    if not items:
+        return None, []
+    result = process_items(items)
+    if result is not None:
+        return result, []
+    if len(items) == 1:
+        return None, list(items)
+
+    middle = len(items) // 2
+    print(f"    -> バッチを分割して再試行します ({len(items)}件 → {middle}件 + {len(items) - middle}件) / Splitting the batch and retrying ({len(items)} -> {middle} + {len(items) - middle} items)")
+    first_result, first_failed = bisect_process(items[:middle], process_items, combine)
+    second_result, second_failed = bisect_process(items[middle:], process_items, combine)
+    return combine([first_result, second_result]), first_failed + second_failed
+
+class DeadLetterQueue:
+    """
+    分割しても処理できなかったアイテムを保存する永続的なデッドレターファイル。
+    通常の実行ではリセットされ、再開モードでは追記され、再処理モードでは読み込んだ後にリセットされます（再度失敗したアイテムは再び追加されます）。
+    A persistent dead-letter file holding items that could not be processed even after splitting.
+    It is reset on a normal run, appended to in resume mode, and loaded then reset in replay mode (items that fail again are added back).
+    """
+
+    def __init__(self, name, resume=False, replay=False, dead_letter_dir=DEAD_LETTER_DIR):
+        os.makedirs(dead_letter_dir, exist_ok=True)
+        self.path = os.path.join(dead_letter_dir, f"{name}.jsonl")
+        self._lock = threading.Lock()
+        self.replay_items = []
+        self.added = 0
+        if replay:
+            self.replay_items = self._load()
+            print(f"デッドレターから{len(self.replay_items)}件を再処理します: {self.path} / Replaying {len(self.replay_items)} items from dead letters: {self.path}")
+        if replay or not resume:
+            open(self.path, 'w', encoding='utf-8').close()
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self):
+        items = []
+        if not os.path.exists(self.path):
+            return items
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    items.append(json.loads(line)['item'])
+                except (json.JSONDecodeError, KeyError):
+                    # 中断で壊れた行は無視する
+                    # Ignore lines torn by an interruption
+                    continue
+        return items
+
+    def add(self, unit_key, items):
+        """失敗したアイテムを記録する / Records failed items"""
+        if not items:
+            return
+        lines = [json.dumps({"unit": unit_key, "item": item}, ensure_ascii=False) for item in items]
+        with self._lock:
+            append_lines_atomic(self._file, lines)
+            self.added += len(items)
+
+    def report(self):
+        if self.added:
+            print(f"警告: {self.added}件のアイテムを処理できず、{self.path} に保存しました。--replay-failed で再処理できます。 / Warning: {self.added} items could not be processed and were saved to {self.path}. Re-process them with --replay-failed.")
+
+    def close(self):
+        self._file.close()
+
+def is_replay_unit_key(key):
+    return key.startswith(REPLAY_UNIT_PREFIX + ":")
+
+def collect_replay_units(journal, dead_letters, make_units):
+    """
+    再処理の対象となる処理単位を集める。
+    1. 以前の再処理で完了した単位（チェックポイントから結果を再利用し、出力から失われないようにする）
+    2. 今回デッドレターから読み込んだアイテムを make_units でバッチ化した新しい単位
+    Collects the units to replay.
+    1. Units completed by an earlier replay (their results are reused from the checkpoint so they are not lost from the output)
+    2. New units built by make_units from the items loaded from the dead letters in this run
+
+    Args:
+        journal: UnitJournal（Noneも可）。 / The UnitJournal (may be None).
+        dead_letters: DeadLetterQueue（Noneも可）。 / The DeadLetterQueue (may be None).
+        make_units: アイテムのリストから処理単位（"items"を含む辞書）のリストを作る関数。 / Function building units (dicts including "items") from a list of items.
+    """
+    units = []
+    if journal is not None:
+        for key, entry in journal.completed.items():
+            if is_replay_unit_key(key):
+                units.append({"key": key, "fingerprint": entry['fingerprint'], "items": []})
+    if dead_letters is not None and dead_letters.replay_items:
+        # 再処理ごとに異なるキーを使い、以前に失敗した同じ内容の単位も再実行されるようにする
+        # Use distinct keys per replay so that a unit with the same content that failed before is run again
+        replay_run = len(journal.completed) if journal is not None else 0
+        for n, unit in enumerate(make_units(dead_letters.replay_items)):
+            unit["key"] = f"{REPLAY_UNIT_PREFIX}:{replay_run}:{n}"
+            unit["fingerprint"] = compute_fingerprint(unit["items"])
+            units.append(unit)
+    return units
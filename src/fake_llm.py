@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from .llm_utils import estimate_tokens
+
+# --- 定数 --- #
+# --- Constants --- #
+FAKE_MODEL_PREFIX = "fake/"  # キャッシュで実際のモデルの応答と混ざらないよう、モデル名に付ける / Prefixed to the model name so cached responses never mix with a real model's
+DEFAULT_LATENCY_SECONDS = 0.0  # 1回の呼び出しの平均遅延（±50%でばらつく） / Mean latency of one call (varies by +-50%)
+DEFAULT_ERROR_RATE = 0.0  # 一時的なエラー（503）を返す割合 / Fraction of calls failing with a transient error (503)
+DEFAULT_RATE_LIMIT_RATE = 0.0  # クォータ超過（429）を返す割合 / Fraction of calls failing with a quota error (429)
+DEFAULT_RELATION_RATE = 0.3  # 関係があると答えるペアの割合 / Fraction of pairs answered with a relation
+DEFAULT_SEED = 0
+MAX_ENTITIES_PER_RESPONSE = 30
+
+# プロンプトのテンプレート: (タスク, ファイル, 差し込み箇所, 書式)。書式はテンプレートのエスケープの扱いを決める
+# Prompt templates: (task, file, placeholders, style). The style decides how the template's escapes are read
+PROMPT_TEMPLATES = [
+    ("clean", "paragraph_cleaning_prompt.md", ["{{JSON_INPUT}}"], "replace"),
+    ("entities", "entity_extraction_prompt.md", ["{{JSON_INPUT}}"], "replace"),
+    ("relations", "relation_extraction_batch_prompt.md", ["$context_paragraph", "$entity_pairs"], "template"),
+    ("normalize", "entity_normalization_prompt.md", ["{entities_json}", "{canonical_json}"], "format"),
+]
+ENTITY_CATEGORIES = ["Disease", "Symptom", "Drug", "Treatment", "Anatomy", "Test/Diagnosis"]
+RELATION_LABELS = ["causes", "is_symptom_of", "is_treatment_for", "is_effective_for", "is_not_effective_for", "is_diagnosed_by", "is_associated_with"]
+# 用語とみなす文字列: カタカナ3文字以上、漢字2〜6文字、英字で始まる4文字以上の語
+# Strings taken as terms: 3+ katakana, 2-6 kanji, or words of 4+ characters starting with a letter
+TERM_PATTERN = re.compile(r"[ァ-ヴー]{3,}|[一-龥]{2,6}|[A-Za-z][A-Za-z0-9\-]{3,}")
+CITATION_PATTERN = re.compile(r"\[\d+(?:\s*[,，\-–]\s*\d+)*\]")
+
+class FakeLLMError(Exception):
+    """偽のモデルが意図的に返すエラー / An error raised on purpose by the fake model"""
+
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+class FakeResponse:
+    """偽のモデルの応答。Geminiの応答と同じく text と usage_metadata を持つ / A fake model response; like a Gemini response it has text and usage_metadata"""
+
+    def __init__(self, text, prompt):
+        self.text = text
+        self.usage_metadata = FakeUsage(estimate_tokens(prompt), estimate_tokens(text))
+
+def fenced_json(data):
+    """モデルと同じく ```json で囲んだJSONを返す / Returns JSON fenced with ```json, as the model does"""
+    return "```json\n" + json.dumps(data, ensure_ascii=False, indent=2) + "\n```"
+
+def compile_template(template, placeholders, style):
+    """
+    テンプレートから、差し込まれた値を取り出す正規表現を作る。
+    Builds a regular expression that captures the values substituted into a template.
+    """
+    parts = re.split("|".join(re.escape(placeholder) for placeholder in placeholders), template)
+    if len(parts) != len(placeholders) + 1:
+        return None
+    if style == "format":
+        parts = [part.replace("{{", "{").replace("}}", "}") for part in parts]
+    elif style == "template":
+        parts = [part.replace("$$", "$") for part in parts]
+    groups = ["(.*?)"] * (len(placeholders) - 1) + ["(.*)"]
+    pattern = re.escape(parts[0]) + "".join(group + re.escape(part) for group, part in zip(groups, parts[1:]))
+    return re.compile(pattern + r"\Z", re.DOTALL)
+
+def clean_paragraphs(fields, rng, model):
+    paragraphs = json.loads(fields[0])
+    cleaned = [" ".join(CITATION_PATTERN.sub("", paragraph).split()) for paragraph in paragraphs]
+    return fenced_json({"cleaned_paragraphs": cleaned})
+
+def extract_entities(fields, rng, model):
+    text = json.loads(fields[0])
+    terms = list(dict.fromkeys(match.group(0) for match in TERM_PATTERN.finditer(text)))[:MAX_ENTITIES_PER_RESPONSE]
+    entities = [{"term": term, "category": ENTITY_CATEGORIES[zlib.crc32(term.encode('utf-8')) % len(ENTITY_CATEGORIES)]} for term in terms]
+    return fenced_json({"entities": entities})
+
+def extract_relations(fields, rng, model):
+    pairs = json.loads(fields[1])
+    relations = [
+        {"source": pair["source"], "target": pair["target"], "relation": rng.choice(RELATION_LABELS), "reason": "fake"}
+        for pair in pairs if rng.random() < model.relation_rate
+    ]
+    return fenced_json(relations)
+
+def normalize_terms(fields, rng, model):
+    # 用語を、それを含む最も短い別の用語（既存の正規化名を含む）にまとめる
+    # Map each term to the shortest other term it contains (existing canonical names included)
+    terms = json.loads(fields[0])
+    candidates = sorted(set(terms) | set(json.loads(fields[1])), key=lambda term: (len(term), term))
+    normalization_map = {}
+    for term in terms:
+        for candidate in candidates:
+            if len(candidate) >= len(term):
+                break
+            if len(candidate) >= 2 and candidate in term:
+                normalization_map[term] = candidate
+                break
+    return fenced_json({"normalization_map": normalization_map})
+
+TASK_HANDLERS = {
+    "clean": clean_paragraphs,
+    "entities": extract_entities,
+    "relations": extract_relations,
+    "normalize": normalize_terms,
+}
+
+class FakeModel:
+    """
+    APIを呼び出さない決定的な偽のモデル。プロンプトをパイプラインのテンプレートと照合して差し込まれた入力を取り出し、
+    各ステップが解析できる形式の応答を合成する（responses に用意された応答があればそれを返す）。
+    応答・遅延・エラーはシードとプロンプトのハッシュから決まるため、同時実行数によらず同じ結果になる。
+    A deterministic fake model that never calls an API. It matches prompts against the pipeline's templates to recover the substituted input,
+    and synthesizes a response in the format each step parses (or returns a canned response from responses, if one is given).
+    Responses, latency and errors are derived from the seed and the prompt hash, so results do not depend on concurrency.
+    """
+
+    def __init__(self, model_name, latency=DEFAULT_LATENCY_SECONDS, error_rate=DEFAULT_ERROR_RATE, rate_limit_rate=DEFAULT_RATE_LIMIT_RATE,
+                 relation_rate=DEFAULT_RELATION_RATE, seed=DEFAULT_SEED, responses=None, prompt_dir="."):
+        """
+        Args:
+            model_name: 偽装するモデル名。 / The model name being faked.
+            latency: 1回の呼び出しの平均遅延（秒）。 / Mean latency of one call in seconds.
+            error_rate: 一時的なエラーを返す割合。 / Fraction of calls failing with a transient error.
+            rate_limit_rate: クォータ超過エラーを返す割合。 / Fraction of calls failing with a quota error.
+            relation_rate: 関係があると答えるペアの割合。 / Fraction of pairs answered with a relation.
+            seed: 応答・遅延・エラーを決めるシード。 / Seed deciding responses, latency and errors.
+            responses: プロンプトのSHA-256 → 応答テキストのJSONファイルのパス（用意された応答を返す場合）。 / Path of a JSON file mapping prompt SHA-256 -> response text (for canned responses).
+            prompt_dir: プロンプトのテンプレートがあるディレクトリ。 / Directory holding the prompt templates.
+        """
+        self.model_name = FAKE_MODEL_PREFIX + model_name
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.relation_rate = relation_rate
+        self.seed = seed
+        self.prompt_dir = prompt_dir
+        # 応答を変える設定だけをキャッシュのキーに含める / Only settings that change responses are part of the cache key
+        self._generation_config = {"seed": seed, "relation_rate": relation_rate, "responses": responses}
+        self._canned = {}
+        if responses:
+            with open(responses, 'r', encoding='utf-8') as f:
+                self._canned = json.load(f)
+        self._templates = None
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _load_templates(self):
+        with self._lock:
+            if self._templates is None:
+                templates = []
+                for task, file_name, placeholders, style in PROMPT_TEMPLATES:
+                    path = os.path.join(self.prompt_dir, file_name)
+                    if not os.path.exists(path):
+                        continue
+                    with open(path, 'r', encoding='utf-8') as f:
+                        pattern = compile_template(f.read(), placeholders, style)
+                    if pattern is not None:
+                        templates.append((task, pattern))
+                self._templates = templates
+        return self._templates
+
+    def respond(self, prompt):
+        """プロンプトに対する応答テキストを返す（遅延やエラーなし） / Returns the response text for a prompt (no latency or errors)"""
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        if digest in self._canned:
+            return self._canned[digest]
+        rng = random.Random(f"{self.seed}:{digest}")
+        for task, pattern in self._load_templates():
+            match = pattern.match(prompt)
+            if match:
+                return TASK_HANDLERS[task](match.groups(), rng, self)
+        return fenced_json({})
+
+    def generate_content(self, prompt):
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        # 同じプロンプトの再試行ごとに別の乱数を使い、エラーの後の再試行が成功しうるようにする
+        # Each retry of the same prompt uses a different random stream, so a retry after an error can succeed
+        with self._lock:
+            attempt = self._attempts[digest] = self._attempts.get(digest, 0) + 1
+        rng = random.Random(f"{self.seed}:{digest}:{attempt}")
+        if self.latency:
+            time.sleep(self.latency * rng.uniform(0.5, 1.5))
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            raise FakeLLMError("429 Resource exhausted (fake backend)", 429)
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise FakeLLMError("503 Service unavailable (fake backend)", 503)
+        return FakeResponse(self.respond(prompt), prompt)
@@ -0,0 +1,86 @@
+import re
+from collections import Counter
+
+# --- 定数 --- #
+# --- Constants --- #
+DEFAULT_REPORT_LIMIT = 20  # 表示するクエリの数 / Number of queries shown in the report
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+class RecordedResult:
+    """記録用ドライバーの結果。行は返さない / Result of the recording driver; it returns no rows"""
+
+    def __iter__(self):
+        return iter(())
+
+    def consume(self):
+        return None
+
+class RecordingTransaction:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def run(self, query, parameters=None, **kwargs):
+        return self._driver._record(query, dict(parameters or {}, **kwargs))
+
+class RecordingSession:
+    def __init__(self, driver):
+        self._driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        pass
+
+    def run(self, query, parameters=None, **kwargs):
+        return self._driver._record(query, dict(parameters or {}, **kwargs))
+
+    def execute_write(self, work, *args, **kwargs):
+        self._driver.transactions += 1
+        return work(RecordingTransaction(self._driver), *args, **kwargs)
+
+    def execute_read(self, work, *args, **kwargs):
+        return work(RecordingTransaction(self._driver), *args, **kwargs)
+
+class RecordingDriver:
+    """
+    Neo4jに接続せず、送られたクエリとパラメータを記録する代替ドライバー。step6の main(driver=...) に渡すと、
+    UNWINDでまとめたバッチの数と行数をデータベースなしで確認できる。読み取りクエリには空の結果を返す。
+    A stand-in driver that records the queries and parameters it is sent instead of connecting to Neo4j. Passed to step6's main(driver=...),
+    it shows the number of UNWIND batches and their rows without a database. Read queries get an empty result.
+    """
+
+    def __init__(self):
+        self.calls = []  # (クエリ, パラメータ) のリスト / list of (query, parameters)
+        self.transactions = 0
+        self.closed = False
+
+    def session(self, **kwargs):
+        return RecordingSession(self)
+
+    def close(self):
+        self.closed = True
+
+    def _record(self, query, parameters):
+        self.calls.append((WHITESPACE_PATTERN.sub(" ", query).strip(), parameters))
+        return RecordedResult()
+
+    def batches(self):
+        """UNWIND $rows で送られた (クエリ, 行のリスト) を順に返す / Returns the (query, list of rows) sent with UNWIND $rows, in order"""
+        return [(query, parameters["rows"]) for query, parameters in self.calls if "rows" in parameters]
+
+    def report(self, limit=DEFAULT_REPORT_LIMIT):
+        """クエリごとのバッチ数と行数を表示する / Prints the number of batches and rows per query"""
+        batches = self.batches()
+        batch_counts = Counter(query for query, _ in batches)
+        row_counts = Counter()
+        for query, rows in batches:
+            row_counts[query] += len(rows)
+        print(f"\n--- 記録されたNeo4jへの呼び出し / Recorded Neo4j calls ---")
+        print(f"クエリ: {len(self.calls)}件, UNWINDのバッチ: {len(batches)}件, 行: {sum(row_counts.values())}行, 書き込みトランザクション: {self.transactions}件 / Queries: {len(self.calls)}, UNWIND batches: {len(batches)}, rows: {sum(row_counts.values())}, write transactions: {self.transactions}")
+        for query, count in batch_counts.most_common(limit):
+            print(f"  {count:>5}バッチ / batches {row_counts[query]:>7}行 / rows  {query}")
@@ -0,0 +1,129 @@
+import csv
+import json
+import os
+
+# --- 定数 --- #
+# --- Constants --- #
+GRAPH_SNAPSHOT_PATH = "output/step6_graph_snapshot.json"
+
+def read_csv_rows(path):
+    """step5のCSVの行を辞書として1行ずつ返す / Yields the rows of a step5 CSV as dicts, one at a time"""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from csv.DictReader(f)
+
+class GraphSnapshot:
+    """
+    エクスポートされたグラフの内容。ノードはラベルごとに ID → プロパティ、エッジはラベルごとに (始点, 型, 終点, プロパティの値...) の集合で持つ。
+    エッジはプロパティも含めて同一性を判定するため、エッジには「変更」はなく追加と削除だけがある。
+    The content of an exported graph. Nodes are held per label as ID -> properties, and edges per label as a set of (start, type, end, property values...).
+    Edges are identified including their properties, so an edge is never "changed", only added or removed.
+    """
+
+    def __init__(self, nodes=None, edges=None):
+        self.nodes = nodes or {}
+        self.edges = edges or {}
+
+    @classmethod
+    def from_csvs(cls, node_sources, edge_sources):
+        """
+        step5のCSVからスナップショットを作る。
+        Builds a snapshot from the step5 CSVs.
+
+        Args:
+            node_sources: (CSVのパス, ラベル, ID列, プロパティ列のリスト) のリスト。 / A list of (CSV path, label, ID field, list of property fields).
+            edge_sources: (CSVのパス, ノードのラベル, プロパティ列のリスト) のリスト。 / A list of (CSV path, node label, list of property fields).
+        """
+        snapshot = cls()
+        for path, label, id_field, properties_fields in node_sources:
+            nodes = snapshot.nodes.setdefault(label, {})
+            for row in read_csv_rows(path):
+                nodes[row[id_field]] = {field: row[field] for field in properties_fields}
+        for path, label, properties_fields in edge_sources:
+            edges = snapshot.edges.setdefault(label, set())
+            for row in read_csv_rows(path):
+                edges.add((row['SourceID'], row['Relation'], row['TargetID'], *(row[field] for field in properties_fields)))
+        return snapshot
+
+    @classmethod
+    def load(cls, path=GRAPH_SNAPSHOT_PATH):
+        """保存されたスナップショットを読み込む（なければNone） / Loads a saved snapshot (None if there is none)"""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except json.JSONDecodeError:
+            print(f"警告: グラフのスナップショットを読み込めないため、全体をインポートします: {path} / Warning: Could not read the graph snapshot, importing the whole graph: {path}")
+            return None
+        return cls(
+            nodes=stored.get("nodes", {}),
+            edges={label: {tuple(edge) for edge in edges} for label, edges in stored.get("edges", {}).items()},
+        )
+
+    def save(self, path=GRAPH_SNAPSHOT_PATH):
+        """スナップショットを原子的に書き換える / Atomically rewrites the snapshot"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "nodes": self.nodes,
+                "edges": {label: sorted(edges) for label, edges in self.edges.items()},
+            }, f, ensure_ascii=False)
+        os.replace(temporary_path, path)
+
+class GraphDelta:
+    """
+    2つのスナップショットの差分。ラベルごとに、追加・変更・削除されたノードと、追加・削除されたエッジを持つ。
+    The difference between two snapshots. For each label it holds the added, changed and removed nodes and the added and removed edges.
+    """
+
+    def __init__(self):
+        self.upserted_nodes = {}  # ラベル → 追加・変更されたノードの {ID: プロパティ} / label -> {ID: properties} of added or changed nodes
+        self.removed_nodes = {}  # ラベル → 削除されたノードのIDのリスト / label -> list of removed node IDs
+        self.added_edges = {}  # ラベル → 追加されたエッジのリスト / label -> list of added edges
+        self.removed_edges = {}  # ラベル → 削除されたエッジのリスト / label -> list of removed edges
+        self.counts = {"added_nodes": 0, "changed_nodes": 0, "removed_nodes": 0, "added_edges": 0, "removed_edges": 0}
+
+    def is_empty(self):
+        return not any(self.counts.values())
+
+    def report(self):
+        print(f"グラフの差分: ノード 追加{self.counts['added_nodes']} / 変更{self.counts['changed_nodes']} / 削除{self.counts['removed_nodes']}, エッジ 追加{self.counts['added_edges']} / 削除{self.counts['removed_edges']} / Graph delta: nodes +{self.counts['added_nodes']} ~{self.counts['changed_nodes']} -{self.counts['removed_nodes']}, edges +{self.counts['added_edges']} -{self.counts['removed_edges']}")
+
+def diff_graphs(previous, current):
+    """
+    前回のスナップショットから今回のスナップショットへの差分を返す。IDが内容から決まるため、同じノードは同じIDで比較される。
+    Returns the delta from the previous snapshot to the current one. IDs are derived from content, so the same node is compared under the same ID.
+    """
+    delta = GraphDelta()
+    for label in sorted(set(previous.nodes) | set(current.nodes)):
+        old_nodes = previous.nodes.get(label, {})
+        new_nodes = current.nodes.get(label, {})
+        upserted = {}
+        for node_id, properties in new_nodes.items():
+            old_properties = old_nodes.get(node_id)
+            if old_properties is None:
+                delta.counts["added_nodes"] += 1
+                upserted[node_id] = properties
+            elif old_properties != properties:
+                delta.counts["changed_nodes"] += 1
+                upserted[node_id] = properties
+        removed = [node_id for node_id in old_nodes if node_id not in new_nodes]
+        delta.counts["removed_nodes"] += len(removed)
+        if upserted:
+            delta.upserted_nodes[label] = upserted
+        if removed:
+            delta.removed_nodes[label] = removed
+
+    for label in sorted(set(previous.edges) | set(current.edges)):
+        old_edges = previous.edges.get(label, set())
+        new_edges = current.edges.get(label, set())
+        added = sorted(new_edges - old_edges)
+        removed = sorted(old_edges - new_edges)
+        delta.counts["added_edges"] += len(added)
+        delta.counts["removed_edges"] += len(removed)
+        if added:
+            delta.added_edges[label] = added
+        if removed:
+            delta.removed_edges[label] = removed
+    return delta
@@ -0,0 +1,100 @@
+import sys
+import threading
+import time
+
+# --- 定数 --- #
+# --- Constants --- #
+DEFAULT_REPORT_LIMIT = 25  # 表示するモジュール数 / Number of modules shown in the report
+
+class _TimedLoader:
+    """モジュールの実行時間を計測するローダーのラッパー / Loader wrapper that times the execution of a module"""
+
+    def __init__(self, loader, profiler, name):
+        self._loader = loader
+        self._profiler = profiler
+        self._name = name
+
+    def create_module(self, spec):
+        create_module = getattr(self._loader, 'create_module', None)
+        return create_module(spec) if create_module else None
+
+    def exec_module(self, module):
+        self._profiler._enter(self._name)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._profiler._exit(self._name)
+            # 読み込み後は本来のローダーに戻し、get_data などがそのまま使えるようにする
+            # Restore the original loader after loading so that get_data and friends keep working
+            module.__loader__ = self._loader
+            if getattr(module, '__spec__', None) is not None:
+                module.__spec__.loader = self._loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+class ImportProfiler:
+    """
+    sys.meta_path に入り、この後に読み込まれるモジュールごとの読み込み時間（累積と自身のみ）を記録する。
+    累積は依存するモジュールの読み込みを含み、自身のみはそれを除いた時間。python -X importtime と同じ考え方。
+    Sits on sys.meta_path and records the import time (cumulative and self) of every module imported afterwards.
+    Cumulative includes the imports of its dependencies and self excludes them, as in python -X importtime.
+    """
+
+    def __init__(self):
+        self.timings = {}  # モジュール名 → (累積秒, 自身のみの秒) / module name -> (cumulative seconds, self seconds)
+        self.top_level = []  # 他のモジュールの読み込み中ではなく直接読み込まれたモジュール / Modules imported directly, not while importing another module
+        self._local = threading.local()
+        self._preloaded = 0
+
+    def install(self):
+        self._preloaded = len(sys.modules)
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(spec.loader, self, fullname)
+        return spec
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name):
+        # [開始時刻, 依存するモジュールの読み込みにかかった秒] / [start time, seconds spent importing dependencies]
+        self._stack().append([time.perf_counter(), 0.0])
+
+    def _exit(self, name):
+        stack = self._stack()
+        started, children = stack.pop()
+        elapsed = time.perf_counter() - started
+        self.timings[name] = (elapsed, elapsed - children)
+        if stack:
+            stack[-1][1] += elapsed
+        else:
+            self.top_level.append(name)
+
+    def report(self, limit=DEFAULT_REPORT_LIMIT):
+        """累積時間の長い順にモジュールの読み込み時間を表示する / Prints module import times, longest cumulative time first"""
+        total = sum(self.timings[name][0] for name in self.top_level)
+        print(f"\n--- インポート時間 / Import profile ---")
+        print(f"起動時に読み込み済みのモジュール: {self._preloaded}個 / Modules already loaded at startup: {self._preloaded}")
+        print(f"その後に読み込んだモジュール: {len(self.timings)}個、合計 {total * 1000:.1f}ms / Modules imported afterwards: {len(self.timings)}, {total * 1000:.1f}ms in total")
+        print(f"{'累積 / cumulative':>20} {'自身 / self':>14}  モジュール / module")
+        ranked = sorted(self.timings.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (cumulative, own) in ranked[:limit]:
+            print(f"{cumulative * 1000:>18.1f}ms {own * 1000:>12.1f}ms  {name}")
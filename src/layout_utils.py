@@ -0,0 +1,258 @@
+import re
+from collections import defaultdict
+from .llm_utils import estimate_tokens
+
+# --- 定数 --- #
+# --- Constants --- #
+MARGIN_RATIO = 0.08  # ページ上下のこの割合の領域をヘッダー・フッター候補とする / Fraction of the page height at the top and bottom treated as header/footer candidates
+BOILERPLATE_MIN_PAGE_RATIO = 0.5  # 文書のこの割合以上のページに繰り返し現れるテキストを定型文とみなす / Text repeated on at least this fraction of a document's pages is treated as boilerplate
+BOILERPLATE_MIN_PAGES = 3  # 定型文とみなすために必要な最小ページ数 / Minimum number of pages a text must repeat on to be treated as boilerplate
+BOILERPLATE_MAX_CHARS = 120  # 本文領域で定型文とみなすブロックの最大文字数 / Maximum length of a block in the body area that can be treated as boilerplate
+# ローマ数字は xxxix までの、すべて小文字かすべて大文字のものに限る（"DM" や "Mild" のような略語・単語をページ番号とみなさないため）
+# Roman numerals are limited to all-lowercase or all-uppercase numerals up to xxxix (so abbreviations and words such as "DM" or "Mild" are not taken as page numbers)
+ROMAN_PAGE_NUMBER = r"(?=[ivx])x{0,3}(?:ix|iv|v?i{0,3})|(?=[IVX])X{0,3}(?:IX|IV|V?I{0,3})"
+PAGE_NUMBER_PATTERN = re.compile(rf"^(?:[-–—]\s*)?(?i:p\.?\s*|page\s*)?(?:\d+|{ROMAN_PAGE_NUMBER})(?:\s*(?i:/|of)\s*\d+)?(?:\s*[-–—])?$")
+DIGIT_PATTERN = re.compile(r"\d+")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+class BoilerplateStats:
+    """定型文除去の集計 / Counters for boilerplate stripping"""
+
+    def __init__(self):
+        self.pages = 0
+        self.removed_blocks = 0
+        self.removed_chars = 0
+        self.removed_tokens = 0
+        self.total_chars = 0
+
+    def report(self):
+        ratio = self.removed_chars / self.total_chars if self.total_chars else 0.0
+        print(f"ヘッダー・フッター除去: {self.pages}ページから{self.removed_blocks}ブロック, {self.removed_chars}文字 ({ratio:.1%}), 推定{self.removed_tokens}トークンを除去 / Header/footer stripping: removed {self.removed_blocks} blocks, {self.removed_chars} characters ({ratio:.1%}), ~{self.removed_tokens} estimated tokens from {self.pages} pages")
+
+def normalize_block_text(text, mask_digits=True):
+    """
+    ページ間で比較するためにブロックのテキストを正規化する。空白を1つにまとめ、mask_digits=Trueなら数字（ページ番号など）を "#" に置き換える。
+    Normalizes block text for comparison across pages. Collapses whitespace and, with mask_digits=True, replaces digits (page numbers etc.) with "#".
+    """
+    normalized = WHITESPACE_PATTERN.sub(" ", text).strip()
+    return DIGIT_PATTERN.sub("#", normalized) if mask_digits else normalized
+
+def is_page_number(text):
+    """ブロックがページ番号だけかを判定する / Determines whether a block holds only a page number"""
+    return bool(PAGE_NUMBER_PATTERN.match(WHITESPACE_PATTERN.sub(" ", text).strip()))
+
+def in_margin(bbox, page_height, margin_ratio=MARGIN_RATIO):
+    """ブロックがページ上下の余白領域にあるかを判定する / Determines whether a block lies in the top or bottom margin of the page"""
+    margin = page_height * margin_ratio
+    return bbox[3] <= margin or bbox[1] >= page_height - margin
+
+def boilerplate_key(block, page_height, margin_ratio=MARGIN_RATIO, max_chars=BOILERPLATE_MAX_CHARS):
+    """
+    定型文候補のブロックについて、ページ間で比較するキーを返す（候補でなければNone）。
+    余白領域のブロックは数字を伏せて比較し（"第3章 - 12" のような変化するヘッダー）、本文領域の短いブロックは完全一致で比較する。
+    Returns the key used to compare a boilerplate candidate block across pages (None if the block is not a candidate).
+    Margin blocks are compared with digits masked (headers like "Chapter 3 - 12" that vary), short body blocks by exact text.
+    """
+    if in_margin(block['bbox'], page_height, margin_ratio):
+        normalized = normalize_block_text(block['text'])
+        return ("margin", normalized) if normalized else None
+    normalized = normalize_block_text(block['text'], mask_digits=False)
+    if not normalized or len(normalized) > max_chars:
+        return None
+    return ("body", normalized)
+
+def find_boilerplate(pages, margin_ratio=MARGIN_RATIO, min_page_ratio=BOILERPLATE_MIN_PAGE_RATIO,
+                     min_pages=BOILERPLATE_MIN_PAGES, max_chars=BOILERPLATE_MAX_CHARS):
+    """
+    1文書のページ群から、繰り返し現れる定型文のキー（boilerplate_key を参照）の集合を求める。
+    余白領域のブロックと、本文領域の短いブロックが候補となり、十分な数のページに現れるものが定型文となる。
+    Finds the set of keys (see boilerplate_key) of repeated boilerplate across the pages of one document.
+    Blocks in the margins and short blocks in the body are candidates; those appearing on enough pages are boilerplate.
+    """
+    pages_by_key = defaultdict(set)
+    for page_index, page in enumerate(pages):
+        for block in page['blocks']:
+            key = boilerplate_key(block, page['height'], margin_ratio, max_chars)
+            if key is not None:
+                pages_by_key[key].add(page_index)
+
+    threshold = max(min_pages, len(pages) * min_page_ratio)
+    return {key for key, page_indices in pages_by_key.items() if len(page_indices) >= threshold}
+
+def strip_boilerplate(pages, stats=None, margin_ratio=MARGIN_RATIO):
+    """
+    ページのブロックからヘッダー・フッター・ページ番号・繰り返される定型文を除去し、各ページの "text" を残ったブロックから作り直す。
+    繰り返しの統計は文書（document_id）ごとに取る。
+    Removes headers, footers, page numbers and repeated boilerplate from the blocks of each page, rebuilding each page's "text" from the remaining blocks.
+    Repetition statistics are computed per document (document_id).
+
+    Args:
+        pages: "blocks"（"bbox"と"text"を持つ辞書のリスト）と "height" を持つページのリスト。 / Pages carrying "blocks" (dicts with "bbox" and "text") and "height".
+        stats: 集計を加算するBoilerplateStats（任意）。 / Optional BoilerplateStats to accumulate into.
+    """
+    if stats is None:
+        stats = BoilerplateStats()
+
+    pages_by_document = defaultdict(list)
+    for page in pages:
+        pages_by_document[page.get('document_id')].append(page)
+
+    for document_pages in pages_by_document.values():
+        boilerplate = find_boilerplate(document_pages, margin_ratio=margin_ratio)
+        for page in document_pages:
+            kept = []
+            for block in page['blocks']:
+                stats.total_chars += len(block['text'])
+                key = boilerplate_key(block, page['height'], margin_ratio)
+                margin_page_number = in_margin(block['bbox'], page['height'], margin_ratio) and is_page_number(block['text'])
+                if key in boilerplate or margin_page_number:
+                    stats.removed_blocks += 1
+                    stats.removed_chars += len(block['text'])
+                    stats.removed_tokens += estimate_tokens(block['text'])
+                    continue
+                kept.append(block)
+            page['blocks'] = kept
+            page['text'] = "".join(block['text'] for block in kept)
+            stats.pages += 1
+    return stats
+
+# --- 段落の構築 --- #
+# --- Paragraph building --- #
+PARAGRAPH_GAP_RATIO = 0.5  # ブロック間の縦の空きが行の高さのこの倍数を超えると段落を区切る / A vertical gap between blocks above this multiple of the line height starts a new paragraph
+BROKEN_LINE_RATIO = 0.6  # ブロック内の最長行に対してこの割合より短い途中の行を改行崩れとみなす / A non-final line shorter than this fraction of the block's longest line is treated as a broken line
+LIST_MARKER_PATTERN = re.compile(r"^(?:[●•・◆◇■□○◦▪▫※\-\*]|\d{1,3}[\.．\)）]|[\(（]\d{1,3}[\)）]|[①-⑳])")
+SENTENCE_END_CHARS = "。．.!?！？:：」）)"
+HYPHENATION_PATTERN = re.compile(r"[A-Za-z]-$")
+
+# LLMによるクレンジングが必要なテキストの特徴（引用マーカー、図表のキャプション、参考文献、文字化けなど）
+# Text features that need LLM cleaning (citation markers, figure/table captions, references, garbled characters, etc.)
+NOISE_PATTERNS = {
+    "citation": re.compile(r"\[\d+(?:\s*[,，\-–]\s*\d+)*\]"),
+    "caption": re.compile(r"^(?:図|表|Fig\.?|Figure|Table)\s*\d", re.IGNORECASE),
+    "reference": re.compile(r"et al\.|doi:|https?://|ISBN", re.IGNORECASE),
+    "garbled": re.compile(r"[�ﬀ-ﬆ\u0000-\u0008]"),
+}
+
+def is_cjk(ch):
+    """日本語・中国語などの全角文字かを判定する（これらの間の改行には空白を入れない） / Determines whether a character is CJK/full-width (no space is inserted at line breaks next to them)"""
+    return ord(ch) >= 0x2E80
+
+def join_lines(lines):
+    """
+    行をリストに集めて一度に連結し、段落のテキストを作る。日本語の文字の前後では空白を入れず、それ以外は空白1つで連結する。
+    Builds paragraph text by collecting lines in a list and joining once. No space is inserted next to CJK characters; otherwise lines are joined with one space.
+    """
+    pieces = []
+    for line in lines:
+        if pieces and not is_cjk(pieces[-1][-1]) and not is_cjk(line[0]):
+            pieces.append(" ")
+        pieces.append(line)
+    return "".join(pieces)
+
+class ParagraphBuilder:
+    """
+    ページのテキストブロックから段落を組み立てる。行はリストに集め、段落の確定時に一度だけ連結する。
+    空行、箇条書きの記号、ブロック間の縦の空き、文書の境界で段落を区切り、ページをまたぐ段落は連結する。
+    Assembles paragraphs from the text blocks of pages. Lines are collected in a list and joined once when a paragraph is finalized.
+    Paragraphs break at blank lines, list markers, vertical gaps between blocks and document boundaries; paragraphs continuing across pages are joined.
+    """
+
+    def __init__(self):
+        self.paragraphs = []
+        self._lines = []
+        self._pages = set()
+        self._issues = set()
+        self._document_id = None
+
+    def finalize(self):
+        """現在の段落を確定する / Finalizes the current paragraph"""
+        if self._lines:
+            record = {
+                "paragraph": join_lines(self._lines),
+                "source_pages": sorted(self._pages),
+            }
+            if self._document_id is not None:
+                record["document_id"] = self._document_id
+            record["layout_issues"] = sorted(self._issues)
+            self.paragraphs.append(record)
+        self._lines = []
+        self._pages = set()
+        self._issues = set()
+
+    def add_line(self, line, page_number, broken=False):
+        if self._lines and HYPHENATION_PATTERN.search(self._lines[-1]) and line[:1].islower():
+            self._issues.add("hyphenation")
+        if broken:
+            self._issues.add("broken_line")
+        self._lines.append(line)
+        self._pages.add(page_number)
+
+    def add_page(self, page):
+        document_id = page.get('document_id')
+        if document_id != self._document_id:
+            # 段落は文書をまたがない
+            # Paragraphs never span documents
+            self.finalize()
+            self._document_id = document_id
+
+        # step1がブロックを出力していない場合は、ページ全体を1つのブロックとして扱う
+        # If step1 did not output blocks, treat the whole page as one block
+        blocks = page.get('blocks') or [{"bbox": None, "text": page['text']}]
+        previous_bbox = None
+        previous_line_count = 1
+        for block in blocks:
+            # 末尾の改行の後の空文字列は空行ではないため除く
+            # The empty string after the trailing newline is not a blank line, so drop it
+            raw_lines = block['text'].split('\n')
+            if raw_lines and raw_lines[-1] == "":
+                raw_lines.pop()
+            lines = [line.strip() for line in raw_lines]
+            content_lines = [line for line in lines if line]
+            if not content_lines:
+                # 空のブロックは段落の区切り
+                # An empty block is a paragraph break
+                self.finalize()
+                continue
+
+            bbox = block.get('bbox')
+            if bbox is not None and previous_bbox is not None:
+                line_height = (previous_bbox[3] - previous_bbox[1]) / previous_line_count
+                if bbox[1] - previous_bbox[3] > PARAGRAPH_GAP_RATIO * line_height:
+                    self.finalize()
+            previous_bbox = bbox
+            previous_line_count = len(content_lines)
+
+            longest = max(len(line) for line in content_lines)
+            for index, line in enumerate(lines):
+                if not line:
+                    # 空行は段落の区切り
+                    # A blank line is a paragraph break
+                    self.finalize()
+                    continue
+                if LIST_MARKER_PATTERN.match(line):
+                    self.finalize()
+                is_last = all(not rest for rest in lines[index + 1:])
+                broken = not is_last and len(line) < BROKEN_LINE_RATIO * longest and line[-1] not in SENTENCE_END_CHARS
+                self.add_line(line, page['page_number'], broken=broken)
+
+def build_paragraphs(pages):
+    """
+    ページのリストから、出典情報とレイアウト上の問題（"layout_issues"）付きの段落リストを作成する。
+    Creates a list of paragraphs with source information and layout issues ("layout_issues") from a list of pages.
+    """
+    builder = ParagraphBuilder()
+    for page in pages:
+        builder.add_page(page)
+    builder.finalize()
+    return builder.paragraphs
+
+def classify_paragraph(record):
+    """
+    段落がLLMによるクレンジングを必要とする理由のリストを返す。空のリストなら段落は既にクリーンで、LLMを経由せずに出力できる。
+    Returns the list of reasons why a paragraph needs LLM cleaning. An empty list means the paragraph is already clean and can skip the LLM.
+    """
+    reasons = list(record.get('layout_issues', []))
+    for name, pattern in NOISE_PATTERNS.items():
+        if pattern.search(record['paragraph']):
+            reasons.append(name)
+    return reasons
@@ -1,6 +1,32 @@
-import os 
-import google.generativeai as genai
+import os
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# --- レート制限のデフォルト値 ---
+# --- Rate limiting defaults ---
+BACKOFF_BASE_SECONDS = 2.0  # 指数バックオフの初期待機時間 / Initial wait for exponential backoff
+BACKOFF_MAX_SECONDS = 120.0  # 指数バックオフの上限 / Upper bound for exponential backoff
+RATE_LIMIT_WINDOW_SECONDS = 60.0  # RPM/TPMの集計ウィンドウ / Window over which RPM/TPM are counted
+DEFAULT_CONCURRENCY = 1  # 同時に実行するLLM呼び出し数 / Number of LLM calls executed concurrently
+DEFAULT_BATCH_TOKEN_BUDGET = 6000  # 1リクエストあたりの入力＋予想出力トークン数の上限 / Budget of input plus expected output tokens per request
+TEXT_SPLIT_PATTERN = re.compile(r"(?<=[。．！？!?\n])|(?<=\.)(?=\s)")
+
+# --- レスポンスキャッシュのデフォルト値 ---
+# --- Response cache defaults ---
+DEFAULT_CACHE_DIR = "output/llm_cache"
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # 1GBを超えると古いエントリから削除 / Evict least recently used entries above 1GB
+CACHE_DB_FILENAME = "responses.sqlite3"
+
+# --- モデルのバックエンド ---
+# --- Model backends ---
+DEFAULT_MODEL_BACKEND = "gemini"
 
 def get_gemini_model(model_name):
     """
@@ -10,19 +36,444 @@ def get_gemini_model(model_name):
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise ValueError("環境変数 'GEMINI_API_KEY' が設定されていません。 / Environment variable 'GEMINI_API_KEY' is not set.")
+    # google.generativeai（とgrpc）は読み込みに時間がかかるため、モデルを作るときに初めて読み込む
+    # google.generativeai (and grpc) are slow to import, so they are imported only when a model is created
+    import google.generativeai as genai
     genai.configure(api_key=api_key)
     return genai.GenerativeModel(model_name)
 
-def llm_generate_with_retry(model, prompt, retries=3, wait_seconds_on_retry=5):
+def get_fake_model(model_name, **options):
+    """
+    APIを呼び出さず、プロンプトから決定的に応答を作る偽のモデルを返します（ベンチマークやオフラインでの確認用）。
+    options は FakeModel に渡されます（遅延、エラー率、シードなど）。
+    Returns a fake model that answers deterministically from the prompt without calling any API (for benchmarks and offline checks).
+    options are passed to FakeModel (latency, error rate, seed, etc.).
+    """
+    from .fake_llm import FakeModel
+    return FakeModel(model_name, **options)
+
+# バックエンド名 → モデルを作る関数 (model_name, **options) / Backend name -> function creating a model (model_name, **options)
+MODEL_BACKENDS = {
+    "gemini": get_gemini_model,
+    "fake": get_fake_model,
+}
+
+_model_backend = DEFAULT_MODEL_BACKEND
+_model_backend_options = {}
+
+def register_model_backend(name, factory):
+    """
+    モデルのバックエンドを登録します。factory は (model_name, **options) を受け取り、generate_content(prompt) を持つモデルを返します。
+    Registers a model backend. factory takes (model_name, **options) and returns a model with generate_content(prompt).
+    """
+    MODEL_BACKENDS[name] = factory
+
+def configure_model_backend(backend=DEFAULT_MODEL_BACKEND, **options):
+    """
+    パイプライン全体で使用するモデルのバックエンドとその設定を指定します。
+    Configures the model backend used by the whole pipeline and its options.
+    """
+    global _model_backend, _model_backend_options
+    if backend not in MODEL_BACKENDS:
+        raise ValueError(f"不明なモデルのバックエンドです: {backend} / Unknown model backend: {backend}")
+    _model_backend = backend
+    _model_backend_options = dict(options)
+    return _model_backend
+
+def get_model_backend():
+    """現在のモデルのバックエンド名を返す / Returns the name of the current model backend"""
+    return _model_backend
+
+def get_model(model_name):
+    """
+    設定されたバックエンドでモデルを初期化して返します。
+    Initializes and returns a model with the configured backend.
+    """
+    return MODEL_BACKENDS[_model_backend](model_name, **_model_backend_options)
+
+def estimate_tokens(text):
+    """
+    テキストのトークン数を概算します。ASCII文字は約4文字で1トークン、それ以外（日本語など）は1文字1トークンとして数えます。
+    Estimates the token count of a text. ASCII characters count as roughly 4 characters per token, others (e.g. Japanese) as 1 token each.
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+def split_text(text, max_tokens):
+    """
+    予算を超える長いテキストを、文の区切りで max_tokens 以下の断片に分割します。
+    1文だけで予算を超える場合は、文字数で強制的に分割します。断片を連結すると元のテキストに戻ります。
+    Splits a text that exceeds the budget into pieces of at most max_tokens at sentence boundaries.
+    A single sentence over budget is split by characters. Concatenating the pieces restores the original text.
+    """
+    max_tokens = max(1, max_tokens)
+    pieces = []
+    current = []
+    current_tokens = 0
+    for sentence in TEXT_SPLIT_PATTERN.split(text):
+        if not sentence:
+            continue
+        sentence_tokens = estimate_tokens(sentence)
+        if sentence_tokens > max_tokens:
+            # 1文が予算を超える場合は、文字数で強制的に分割する
+            # A single sentence over budget is split by characters
+            if current:
+                pieces.append("".join(current))
+                current, current_tokens = [], 0
+            step = max(1, len(sentence) * max_tokens // sentence_tokens)
+            pieces.extend(sentence[i:i + step] for i in range(0, len(sentence), step))
+            continue
+        if current and current_tokens + sentence_tokens > max_tokens:
+            pieces.append("".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += sentence_tokens
+    if current:
+        pieces.append("".join(current))
+    return pieces
+
+def pack_batches(items, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, output_ratio=1.0, text_key='paragraph', max_items=None):
     """
-    リトライ機能付きでLLMのAPIを呼び出します。
-    Calls the LLM API with retry functionality.
+    各アイテムのプロンプトトークン数と予想出力トークン数（入力×output_ratio）を見積もり、
+    1リクエストが token_budget を超えないようにアイテムをバッチに詰めます。
+    予算を超える単独のアイテムは文の区切りで分割され、各断片は元のアイテムの番号を "origin" として持ちます。
+    Estimates the prompt tokens and expected output tokens (input x output_ratio) of each item and packs
+    items into batches so that no request exceeds token_budget.
+    An item over budget on its own is split at sentence boundaries; each piece keeps its original index as "origin".
+
+    Args:
+        items: テキストを持つ辞書のリスト。 / A list of dicts holding text.
+        token_budget: 1バッチあたりのトークン予算。 / Token budget per batch.
+        output_ratio: 入力トークンに対する予想出力トークンの比率。 / Expected output tokens relative to input tokens.
+        text_key: テキストが格納されているキー。 / The key holding the text.
+        max_items: 1バッチあたりの最大アイテム数（Noneで無制限）。 / Maximum items per batch (None for unlimited).
+
+    Returns:
+        (バッチのリスト, 集計情報の辞書)。 / (a list of batches, a dict of statistics).
+    """
+    cost_factor = 1.0 + output_ratio
+    max_input_tokens = max(1, int(token_budget / cost_factor))
+
+    batches = []
+    batch_costs = []
+    current = []
+    current_cost = 0
+    split_items = 0
+    for origin, item in enumerate(items):
+        text = item[text_key]
+        if estimate_tokens(text) > max_input_tokens:
+            split_items += 1
+            pieces = split_text(text, max_input_tokens)
+        else:
+            pieces = [text]
+        for piece_index, piece in enumerate(pieces):
+            cost = int(estimate_tokens(piece) * cost_factor)
+            if current and (current_cost + cost > token_budget or (max_items and len(current) >= max_items)):
+                batches.append(current)
+                batch_costs.append(current_cost)
+                current, current_cost = [], 0
+            current.append(dict(item, **{text_key: piece, "origin": origin, "piece": piece_index}))
+            current_cost += cost
+    if current:
+        batches.append(current)
+        batch_costs.append(current_cost)
+
+    stats = {
+        "items": len(items),
+        "split_items": split_items,
+        "batches": len(batches),
+        "min_batch_size": min((len(batch) for batch in batches), default=0),
+        "max_batch_size": max((len(batch) for batch in batches), default=0),
+        "mean_batch_size": sum(len(batch) for batch in batches) / len(batches) if batches else 0.0,
+        "mean_utilisation": sum(batch_costs) / (len(batches) * token_budget) if batches else 0.0,
+    }
+    return batches, stats
+
+def print_packing_stats(step_name, stats, token_budget):
+    """バッチ詰め込みの集計を表示する / Prints batch packing statistics"""
+    print(f"[{step_name}] {stats['items']}件を{stats['batches']}バッチに詰め込みました (1バッチ {stats['min_batch_size']}〜{stats['max_batch_size']}件, 平均 {stats['mean_batch_size']:.1f}件, 分割 {stats['split_items']}件, 予算 {token_budget}トークンの平均使用率 {stats['mean_utilisation']:.0%}) / Packed {stats['items']} items into {stats['batches']} batches ({stats['min_batch_size']}-{stats['max_batch_size']} per batch, mean {stats['mean_batch_size']:.1f}, {stats['split_items']} split, mean utilisation {stats['mean_utilisation']:.0%} of {token_budget} tokens)")
+
+class RateLimiter:
+    """
+    1分あたりのリクエスト数（RPM）とトークン数（TPM）の予算を管理するレートリミッター。
+    予算を超える場合にのみ、ウィンドウ内の古い記録が期限切れになるまで待機します。
+    A rate limiter that tracks requests-per-minute (RPM) and tokens-per-minute (TPM) budgets.
+    It only blocks when a call would exceed a budget, until old records in the window expire.
+    min_interval（秒）を指定すると、リクエストの開始間隔をその秒数以上空けます（1分に1件未満のレートにも使える）。
+    With min_interval (seconds), request starts are spaced at least that many seconds apart (this also covers rates below one per minute).
+    """
+
+    def __init__(self, rpm=None, tpm=None, window_seconds=RATE_LIMIT_WINDOW_SECONDS, min_interval=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window_seconds = window_seconds
+        self.min_interval = min_interval
+        self._events = deque()  # [timestamp, tokens]
+        self._last_start = None
+        self._tokens_in_window = 0
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._events and now - self._events[0][0] >= self.window_seconds:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def _wait_time(self, now, tokens):
+        """予算内で実行できるまでの待機時間を返す / Returns the wait time until the call fits the budget"""
+        wait = max(0.0, self._blocked_until - now)
+        if self.min_interval and self._last_start is not None:
+            wait = max(wait, self._last_start + self.min_interval - now)
+        if self.rpm and len(self._events) >= self.rpm:
+            oldest_index = len(self._events) - self.rpm
+            wait = max(wait, self._events[oldest_index][0] + self.window_seconds - now)
+        if self.tpm and self._events and self._tokens_in_window + tokens > self.tpm:
+            # 予算に収まるまで古い記録から順に期限切れを待つ
+            # Wait for the oldest records to expire until the call fits the budget
+            remaining = self._tokens_in_window + tokens
+            for timestamp, event_tokens in self._events:
+                remaining -= event_tokens
+                if remaining <= self.tpm:
+                    wait = max(wait, timestamp + self.window_seconds - now)
+                    break
+            else:
+                # 1件だけで予算を超える呼び出しは、ウィンドウが空になるまで待ってから単独で実行する
+                # A call that alone exceeds the budget waits until the window is empty and then runs on its own
+                wait = max(wait, self._events[-1][0] + self.window_seconds - now)
+        return wait
+
+    def acquire(self, tokens=0):
+        """
+        リクエスト1件と指定トークン数を予算から確保します。必要な場合のみ待機します。
+        Reserves one request and the given number of tokens from the budget, waiting only if necessary.
+
+        Returns:
+            確保したトークン数の記録（後で実測値に補正するため）。 / The reservation record (to be corrected with actual usage later).
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    event = [now, tokens]
+                    self._events.append(event)
+                    self._tokens_in_window += tokens
+                    self._last_start = now
+                    return event
+            print(f"レート制限のため {wait:.1f}秒待機します... / Waiting {wait:.1f} seconds for rate limit...")
+            time.sleep(wait)
+
+    def record_usage(self, event, actual_tokens):
+        """確保時の概算トークン数を実測値で補正する / Corrects the estimated tokens of a reservation with actual usage"""
+        if actual_tokens is None:
+            return
+        with self._lock:
+            delta = actual_tokens - event[1]
+            event[1] = actual_tokens
+            if any(e is event for e in self._events):
+                self._tokens_in_window += delta
+
+    def block_for(self, seconds):
+        """クォータエラー時、全ての呼び出しを指定秒数止める / Pauses all callers for the given seconds after a quota error"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+_rate_limiter = RateLimiter()
+
+def configure_rate_limiter(rpm=None, tpm=None, min_interval=None):
+    """
+    パイプライン全体で共有されるレートリミッターを設定します。Noneは無制限を意味します。
+    Configures the rate limiter shared by the whole pipeline. None means unlimited.
+    """
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rpm=rpm, tpm=tpm, min_interval=min_interval)
+    return _rate_limiter
+
+def get_rate_limiter():
+    """共有レートリミッターを返す / Returns the shared rate limiter"""
+    return _rate_limiter
+
+def is_rate_limit_error(error):
+    """例外が429/クォータ超過エラーかどうかを判定する / Determines whether an exception is a 429/quota error"""
+    if getattr(error, 'code', None) == 429 or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests'):
+        return True
+    message = str(error).lower()
+    return '429' in message or 'quota' in message or 'rate limit' in message or 'resource exhausted' in message
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """ジッター付き指数バックオフの待機時間を返す (full jitter) / Returns an exponential backoff delay with full jitter"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def get_usage_tokens(response):
+    """レスポンスから実際の使用トークン数を取得する（取得できない場合はNone） / Gets actual token usage from a response (None if unavailable)"""
+    usage = getattr(response, 'usage_metadata', None)
+    total = getattr(usage, 'total_token_count', None)
+    return total if total else None
+
+def count_response_tokens(response, prompt):
+    """
+    レスポンスの入力・出力トークン数を返す。使用量が取得できない場合はテキストから概算する。
+    Returns the input and output tokens of a response, estimated from the text when usage is unavailable.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    output_tokens = getattr(usage, 'candidates_token_count', None)
+    if prompt_tokens is None:
+        prompt_tokens = estimate_tokens(prompt)
+    if output_tokens is None:
+        try:
+            output_tokens = estimate_tokens(response.text)
+        except Exception:
+            output_tokens = 0
+    return prompt_tokens, output_tokens
+
+_llm_stats_lock = threading.Lock()
+_llm_stats = {}
+
+def reset_llm_stats():
+    """LLM呼び出しの集計を0に戻す / Resets the LLM call counters"""
+    global _llm_stats
+    with _llm_stats_lock:
+        _llm_stats = {"calls": 0, "failures": 0, "cache_hits": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+reset_llm_stats()
+
+def _count_llm_stats(**counts):
+    with _llm_stats_lock:
+        for name, value in counts.items():
+            _llm_stats[name] += value
+
+def get_llm_stats():
+    """
+    LLM呼び出しの集計（API呼び出し数、失敗数、キャッシュヒット数、入力・出力トークン数）を返す
+    Returns the LLM call counters (API calls, failures, cache hits, input and output tokens)
+    """
+    with _llm_stats_lock:
+        return dict(_llm_stats)
+
+def print_llm_stats():
+    """LLM呼び出しの集計を表示する / Prints the LLM call counters"""
+    stats = get_llm_stats()
+    print(f"LLM呼び出し: {stats['calls']}回 (失敗 {stats['failures']}回, キャッシュヒット {stats['cache_hits']}件), 入力 {stats['prompt_tokens']}トークン, 出力 {stats['output_tokens']}トークン / LLM calls: {stats['calls']} ({stats['failures']} failed, {stats['cache_hits']} cache hits), {stats['prompt_tokens']} input tokens, {stats['output_tokens']} output tokens")
+
+class CachedResponse:
+    """キャッシュから復元されたLLMレスポンス / An LLM response restored from the cache"""
+
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+class ResponseCache:
+    """
+    (モデル名, プロンプト, 生成設定) のハッシュをキーとする、SQLiteベースの永続LLMレスポンスキャッシュ。
+    合計サイズが上限を超えると、最後に使用された時刻が古いエントリから削除します（LRU）。
+    A persistent, SQLite-backed LLM response cache keyed by a hash of (model name, prompt, generation config).
+    When the total size exceeds the limit, the least recently used entries are evicted (LRU).
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_DB_FILENAME)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model, prompt):
+        """モデル名・プロンプト・生成設定からキャッシュキーを計算する / Computes the cache key from model name, prompt and generation config"""
+        model_name = getattr(model, 'model_name', type(model).__name__)
+        generation_config = getattr(model, '_generation_config', None)
+        payload = json.dumps([model_name, prompt, generation_config], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest(), model_name
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, key, model_name, response_text):
+        size = len(response_text.encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, response_text, size, time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def stats(self):
+        """ヒット数・ミス数・エントリ数・合計サイズを返す / Returns hits, misses, entry count and total size"""
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total}
+
+_response_cache = None
+
+def configure_cache(cache_dir=DEFAULT_CACHE_DIR, enabled=True, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+    """
+    パイプライン全体で共有されるレスポンスキャッシュを設定します。enabled=Falseでキャッシュを無効化します。
+    Configures the response cache shared by the whole pipeline. enabled=False disables caching.
+    """
+    global _response_cache
+    _response_cache = ResponseCache(cache_dir, max_bytes=max_bytes) if enabled else None
+    return _response_cache
+
+def get_cache():
+    """共有レスポンスキャッシュを返す（無効時はNone） / Returns the shared response cache (None if disabled)"""
+    return _response_cache
+
+def print_cache_stats():
+    """キャッシュの統計情報を表示する / Prints cache statistics"""
+    if _response_cache is None:
+        return
+    stats = _response_cache.stats()
+    print(f"LLMキャッシュ: ヒット {stats['hits']}件, ミス {stats['misses']}件, {stats['entries']}エントリ ({stats['bytes'] / 1024 / 1024:.1f}MB) / LLM cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries ({stats['bytes'] / 1024 / 1024:.1f}MB)")
+
+def llm_generate_with_retry(model, prompt, retries=3, wait_seconds_on_retry=BACKOFF_BASE_SECONDS):
+    """
+    リトライ機能付きでLLMのAPIを呼び出します。呼び出し前に共有レートリミッターで予算を確保し、
+    失敗時はジッター付き指数バックオフで再試行します。
+    Calls the LLM API with retry functionality. Reserves budget from the shared rate limiter before each call,
+    and retries with exponential backoff plus jitter on failure.
+    共有キャッシュが有効な場合、同一のプロンプトにはAPIを呼び出さずキャッシュ済みのレスポンスを返します。
+    When the shared cache is enabled, identical prompts are answered from the cache without calling the API.
 
     Args:
         model: 使用する生成AIモデル。 / The generative AI model to use.
         prompt: LLMに送信するプロンプト。 / The prompt to send to the LLM.
         retries: 最大リトライ回数。 / Maximum number of retries.
-        wait_seconds_on_retry: リトライ時の待機時間（秒）。 / Wait time in seconds before retrying.
+        wait_seconds_on_retry: バックオフの初期待機時間（秒）。 / Initial backoff wait time in seconds.
 
     Returns:
         APIからの正常なレスポンス。 / A successful response from the API.
@@ -30,18 +481,89 @@ def llm_generate_with_retry(model, prompt, retries=3, wait_seconds_on_retry=5):
     Raises:
         Exception: 全てのリトライが失敗した場合の最終的な例外。 / Final exception if all retries fail.
     """
+    cache = _response_cache
+    if cache is not None:
+        cache_key, model_name = cache.make_key(model, prompt)
+        cached_text = cache.get(cache_key)
+        if cached_text is not None:
+            _count_llm_stats(cache_hits=1)
+            return CachedResponse(cached_text)
+
     last_exception = None
+    estimated_tokens = estimate_tokens(prompt)
     for attempt in range(retries):
+        event = _rate_limiter.acquire(estimated_tokens)
         try:
             response = model.generate_content(prompt)
+            _rate_limiter.record_usage(event, get_usage_tokens(response))
+            prompt_tokens, output_tokens = count_response_tokens(response, prompt)
+            _count_llm_stats(calls=1, prompt_tokens=prompt_tokens, output_tokens=output_tokens)
+            if cache is not None:
+                try:
+                    response_text = response.text
+                except Exception:
+                    # ブロックされた応答などテキストを持たないレスポンスはキャッシュしない
+                    # Responses without text (e.g. blocked ones) are not cached
+                    response_text = None
+                if response_text is not None:
+                    cache.put(cache_key, model_name, response_text)
             return response
         except Exception as e:
+            _count_llm_stats(calls=1, failures=1)
             print(f"LLM APIの呼び出しに失敗しました (試行 {attempt + 1}/{retries})。エラー: {e} / LLM API call failed (attempt {attempt + 1}/{retries}). Error: {e}")
             last_exception = e
             if attempt < retries - 1:
-                print(f"{wait_seconds_on_retry}秒後に再試行します... / Retrying in {wait_seconds_on_retry} seconds...")
-                time.sleep(wait_seconds_on_retry)
-    
+                if is_rate_limit_error(e):
+                    # クォータ超過時は全スレッドの呼び出しを止めて、より長く待機する
+                    # On quota errors, pause all callers and back off longer
+                    delay = backoff_delay(attempt + 1, base=max(wait_seconds_on_retry, BACKOFF_BASE_SECONDS) * 2)
+                    _rate_limiter.block_for(delay)
+                else:
+                    delay = backoff_delay(attempt, base=wait_seconds_on_retry)
+                print(f"{delay:.1f}秒後に再試行します... / Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+
     print("全てのリトライに失敗しました。 / All retries failed.")
     raise last_exception
 
+_concurrency = DEFAULT_CONCURRENCY
+
+def configure_concurrency(concurrency):
+    """
+    パイプライン全体で使用するLLM呼び出しの同時実行数を設定します。
+    Configures the number of concurrent LLM calls used by the whole pipeline.
+    """
+    global _concurrency
+    _concurrency = max(1, int(concurrency or DEFAULT_CONCURRENCY))
+    return _concurrency
+
+def get_concurrency():
+    """現在の同時実行数を返す / Returns the current concurrency"""
+    return _concurrency
+
+def map_concurrently(func, items, concurrency=None):
+    """
+    有界スレッドプールで各アイテムに関数を適用し、入力と同じ順序で結果をyieldします。
+    同時に実行中のタスク数は同時実行数の2倍までに制限され、結果は完了次第順番に返されます。
+    Applies a function to each item on a bounded thread pool and yields the results in input order.
+    At most twice the concurrency tasks are in flight, and results are yielded in order as they complete.
+
+    Args:
+        func: 各アイテムに適用する関数。 / The function applied to each item.
+        items: 処理対象のアイテムのイテラブル。 / An iterable of items to process.
+        concurrency: 同時実行数（Noneで共有設定を使用）。 / The concurrency (None uses the shared setting).
+    """
+    concurrency = concurrency or _concurrency
+    if concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,27 +1,95 @@
 import argparse
+import os
+import time
+from importlib import import_module
+from . import llm_utils
+from . import artifact_store
+from .build_utils import BuildState, decide_step, step_signature
+from .import_profile import ImportProfiler
+# step1とstep6は既定値と出力ファイルの定義に使うため最初に読み込む（PyMuPDFとneo4jはステップの実行時に読み込まれる）
+# step1 and step6 are imported up front for their defaults and output definitions (PyMuPDF and neo4j are imported when the step runs)
 from . import step1_extract
-from . import step2a_clean_text
-from . import step2b_extract_entities
-# from . import step3a_rule_based_relations
-from . import step3b_llm_based_relations
-from . import step4_normalize
-from . import step5_export
 from . import step6_import_to_neo4j
+from . import graph_delta
 
-def main():
-    # 利用可能なステップとそれに対応する関数をマッピング
-    # Map available steps to their corresponding functions
-    steps = {
-        'step1': step1_extract.main,
-        'step2a': step2a_clean_text.main,
-        'step2b': step2b_extract_entities.main,
-        # 'step3a': step3a_rule_based_relations.main,
-        'step3b': step3b_llm_based_relations.main,
-        'step4': step4_normalize.main,
-        'step5': step5_export.main,
-        'step6': step6_import_to_neo4j.main,
+# 利用可能なステップとそれに対応するモジュール。ステップのモジュール（とLLMクライアントやspaCyなどの重い依存）は、そのステップを実行するときに初めて読み込む
+# Map available steps to their modules. A step's module (and heavy dependencies such as the LLM client or spaCy) is imported only when that step runs
+STEP_MODULES = {
+    'step1': 'step1_extract',
+    'step2a': 'step2a_clean_text',
+    'step2b': 'step2b_extract_entities',
+    # 'step3a': 'step3a_rule_based_relations',
+    'step3b': 'step3b_llm_based_relations',
+    'step4': 'step4_normalize',
+    'step5': 'step5_export',
+    'step6': 'step6_import_to_neo4j',
+}
+
+def load_module(name):
+    """パッケージ内のモジュールを必要になった時点で読み込む / Imports a module of this package when it is first needed"""
+    return import_module(f".{name}", __package__)
+
+def build_step_specs(args):
+    """
+    各ステップの入力・プロンプト・出力ファイルと、出力に影響するパラメータを定義する。
+    実行時のパラメータ（リトライ回数、同時実行数、レート制限など）は出力に影響しないため含めない。
+    Defines each step's input, prompt and output files and the parameters that affect its output.
+    Runtime parameters (retries, concurrency, rate limits, etc.) do not affect the output and are not included.
+    """
+    try:
+        pdf_paths = step1_extract.resolve_pdf_paths(args.input)
+    except FileNotFoundError:
+        pdf_paths = [args.input]
+    # 中間成果物のファイルは設定された形式（--artifact-format）によって決まる
+    # Intermediate artifact files depend on the configured format (--artifact-format)
+    artifact = artifact_store.artifact_path
+    # 既定のバックエンド以外では、出力が変わるためモデル名にバックエンドを付ける
+    # Other than the default backend, the backend is prefixed to the model name since it changes the outputs
+    model = args.model if args.model_backend == llm_utils.DEFAULT_MODEL_BACKEND else f"{args.model_backend}/{args.model}"
+    return {
+        'step1': {
+            "inputs": pdf_paths,
+            "outputs": [artifact("output/step1_structured_text.json")],
+            "params": {"start_page": args.start_page, "end_page": args.end_page, "strip_headers": not args.keep_boilerplate},
+        },
+        'step2a': {
+            "inputs": [artifact("output/step1_structured_text.json")],
+            "prompts": ["paragraph_cleaning_prompt.md"],
+            "outputs": [artifact("output/step2a_cleaned_text.json")],
+            "params": {"model": model, "token_budget": args.batch_token_budget, "fast_path": not args.no_fast_path, "dedup": not args.no_dedup},
+        },
+        'step2b': {
+            "inputs": [artifact("output/step2a_cleaned_text.json")],
+            "prompts": ["entity_extraction_prompt.md"],
+            "outputs": [artifact("output/step2b_entities.json")],
+            "params": {"model": model, "token_budget": args.batch_token_budget, "dedup": not args.no_dedup, "stream": args.stream},
+        },
+        'step3b': {
+            "inputs": [artifact("output/step2a_cleaned_text.json"), artifact("output/step2b_entities.json")],
+            "prompts": ["relation_extraction_batch_prompt.md"],
+            "outputs": [artifact("output/step3b_relations.jsonl")],
+            "params": {"model": model, "dedup": not args.no_dedup, "stream": args.stream},
+        },
+        'step4': {
+            "inputs": [artifact("output/step2b_entities.json"), artifact("output/step3b_relations.jsonl")],
+            "prompts": ["entity_normalization_prompt.md"],
+            "outputs": [artifact("output/step4_normalized_entities.json"), artifact("output/step4_normalized_relations.jsonl"), "output/step4_normalization_map.json", "output/step4_normalization_store.json"],
+            "params": {"model": model},
+        },
+        'step5': {
+            "inputs": [artifact("output/step4_normalized_entities.json"), artifact("output/step4_normalized_relations.jsonl"), "output/step4_normalization_map.json"],
+            "outputs": ["output/step5_nodes.csv", "output/step5_edges.csv", "output/step5_normalization_nodes.csv", "output/step5_normalization_edges.csv"],
+            "params": {},
+        },
+        'step6': {
+            "inputs": ["output/step5_nodes.csv", "output/step5_edges.csv", "output/step5_normalization_nodes.csv", "output/step5_normalization_edges.csv"],
+            "outputs": [os.path.join(step6_import_to_neo4j.BULK_IMPORT_DIR, name) for name, _, _, _ in step6_import_to_neo4j.BULK_NODE_FILES + step6_import_to_neo4j.BULK_RELATIONSHIP_FILES] if args.neo4j_bulk_export else [graph_delta.GRAPH_SNAPSHOT_PATH],
+            "params": {"neo4j_uri": os.getenv("NEO4J_URI"), "bulk_export": args.neo4j_bulk_export},
+        },
     }
-    step_order = list(steps.keys())
+
+def main():
+    step_order = list(STEP_MODULES.keys())
 
     parser = argparse.ArgumentParser(description="ナレッジグラフ生成パイプライン / Knowledge Graph Generation Pipeline")
     parser.add_argument(
@@ -44,11 +112,71 @@ def main():
         default='gemini-2.5-flash-lite',
         help='使用するLLMモデルを指定します / Specify the LLM model to use'
     )
+    parser.add_argument(
+        '--model-backend',
+        type=str,
+        default=llm_utils.DEFAULT_MODEL_BACKEND,
+        choices=sorted(llm_utils.MODEL_BACKENDS),
+        help='LLMのバックエンド。fakeはAPIを呼び出さず、決定的な応答を合成します（オフラインでの確認やベンチマーク用） / LLM backend; fake synthesizes deterministic responses without calling any API (for offline checks and benchmarks)'
+    )
+    parser.add_argument(
+        '--fake-latency',
+        type=float,
+        default=0.0,
+        help='fakeバックエンドの1回の呼び出しの平均遅延（秒） / Mean latency of one call of the fake backend in seconds'
+    )
+    parser.add_argument(
+        '--fake-error-rate',
+        type=float,
+        default=0.0,
+        help='fakeバックエンドが一時的なエラーを返す割合 / Fraction of calls of the fake backend failing with a transient error'
+    )
+    parser.add_argument(
+        '--rpm',
+        type=int,
+        default=None,
+        help='1分あたりの最大リクエスト数（未指定で無制限） / Maximum requests per minute (unlimited if omitted)'
+    )
+    parser.add_argument(
+        '--tpm',
+        type=int,
+        default=None,
+        help='1分あたりの最大トークン数（未指定で無制限） / Maximum tokens per minute (unlimited if omitted)'
+    )
     parser.add_argument(
         '--wait',
         type=int,
-        default=60,
-        help='APIレート制限のための待機時間（秒） / Wait time in seconds for API rate limiting'
+        default=None,
+        help='旧オプション: API呼び出しの最小間隔（秒）。--rpm未指定時にリクエストの開始間隔の下限として使います / Legacy option: minimum interval between API calls in seconds. Used as the minimum spacing between request starts when --rpm is omitted'
+    )
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=1,
+        help='同時に実行するLLM呼び出し数 / Number of LLM calls to run concurrently'
+    )
+    parser.add_argument(
+        '--batch-token-budget',
+        type=int,
+        default=llm_utils.DEFAULT_BATCH_TOKEN_BUDGET,
+        help='step2a/2bで1リクエストに詰め込む入力＋予想出力トークン数の上限 / Budget of input plus expected output tokens packed into one request in step2a/2b'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=llm_utils.DEFAULT_CACHE_DIR,
+        help='LLMレスポンスキャッシュの保存先ディレクトリ / Directory for the LLM response cache'
+    )
+    parser.add_argument(
+        '--cache-max-mb',
+        type=int,
+        default=llm_utils.DEFAULT_CACHE_MAX_BYTES // (1024 * 1024),
+        help='LLMレスポンスキャッシュの最大サイズ（MB）。超過時は古いものから削除 / Maximum size of the LLM response cache in MB; least recently used entries are evicted'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='LLMレスポンスキャッシュを無効化します / Disable the LLM response cache'
     )
     parser.add_argument(
         '--retries',
@@ -56,6 +184,93 @@ def main():
         default=3,
         help='API呼び出しの最大リトライ回数 / Maximum number of retries for API calls'
     )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='チェックポイントから再開し、完了済みのバッチをスキップします / Resume from checkpoints, skipping completed batches'
+    )
+    parser.add_argument(
+        '--replay-failed',
+        action='store_true',
+        help='デッドレターに保存された失敗アイテムだけを再処理し、結果を既存の出力に統合します / Re-process only the failed items saved in the dead letters and merge the results into the existing output'
+    )
+    parser.add_argument(
+        '--input',
+        type=str,
+        default=step1_extract.DEFAULT_INPUT_PATH,
+        help='step1で処理するPDFファイル、ディレクトリ、またはglobパターン / PDF file, directory or glob pattern processed by step1'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='step1でPDFを並列抽出するプロセス数（未指定でCPUコア数） / Number of processes extracting PDFs in parallel in step1 (CPU core count if omitted)'
+    )
+    parser.add_argument(
+        '--keep-boilerplate',
+        action='store_true',
+        help='step1でヘッダー・フッター・ページ番号などの定型文を除去しません / Do not strip headers, footers, page numbers and other boilerplate in step1'
+    )
+    parser.add_argument(
+        '--no-fast-path',
+        action='store_true',
+        help='step2aで全ての段落をLLMでクレンジングします（クリーンな段落の高速パスを無効化） / Clean every paragraph with the LLM in step2a (disables the fast path for clean paragraphs)'
+    )
+    parser.add_argument(
+        '--no-dedup',
+        action='store_true',
+        help='step2a/2b/3bで近似重複する段落の検出を無効化し、全ての段落を個別に処理します / Disable near-duplicate paragraph detection in step2a/2b/3b and process every paragraph separately'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='step2a→step2b→step3bをストリーミングで実行し、上流の完了を待たずに下流の処理を始めます / Run step2a -> step2b -> step3b as a stream, starting downstream work before the upstream finishes'
+    )
+    parser.add_argument(
+        '--force',
+        action='append',
+        default=[],
+        choices=step_order + ['all'],
+        help='入力が変わっていなくても指定したステップ（とその下流）を再実行します。複数指定可 / Rerun the given step (and its downstream steps) even if nothing changed; can be repeated'
+    )
+    parser.add_argument(
+        '--neo4j-batch-size',
+        type=int,
+        default=step6_import_to_neo4j.DEFAULT_IMPORT_BATCH_SIZE,
+        help='step6で1つのトランザクションにまとめてインポートする行数 / Number of rows imported in one transaction in step6'
+    )
+    parser.add_argument(
+        '--neo4j-bulk-export',
+        action='store_true',
+        help='step6でNeo4jに接続せず、neo4j-admin database import 用のCSVとコマンドを出力します / In step6, write CSVs and a command for neo4j-admin database import instead of connecting to Neo4j'
+    )
+    parser.add_argument(
+        '--neo4j-full-sync',
+        action='store_true',
+        help='step6で前回同期したグラフとの差分ではなく、全てのノードとエッジをインポートし、CSVにないノードとエッジをデータベースから削除します / In step6, import every node and edge instead of the delta from the previously synced graph, and delete the nodes and edges missing from the CSVs'
+    )
+    parser.add_argument(
+        '--neo4j-dry-run',
+        action='store_true',
+        help='step6でNeo4jに接続せず、記録用の代替ドライバーに送ったUNWINDのバッチを表示します / In step6, send the import to a recording stand-in driver instead of Neo4j and print its UNWIND batches'
+    )
+    parser.add_argument(
+        '--artifact-format',
+        type=str,
+        default=artifact_store.DEFAULT_ARTIFACT_FORMAT,
+        choices=artifact_store.ARTIFACT_FORMATS,
+        help='中間成果物の保存形式。sqliteは列ごとに圧縮して保存し、jsonは従来のJSON/JSONLで保存します / Storage format for intermediate artifacts: sqlite stores compressed columns, json keeps the previous JSON/JSONL files'
+    )
+    parser.add_argument(
+        '--import-profile',
+        action='store_true',
+        help='ステップの実行時に読み込んだモジュールごとのインポート時間を最後に表示します / Print the import time of each module imported while running the steps at the end'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='各ステップを実行するかスキップするかの計画を表示して終了します / Print which steps would run or be skipped, then exit'
+    )
     parser.add_argument(
         '--start_page',
         type=int,
@@ -70,6 +285,20 @@ def main():
     )
     args = parser.parse_args()
 
+    profiler = None
+    if args.import_profile:
+        profiler = ImportProfiler()
+        profiler.install()
+    try:
+        run_pipeline(parser, args, step_order)
+    finally:
+        if profiler:
+            profiler.uninstall()
+            profiler.report()
+
+def run_pipeline(parser, args, step_order):
+    """指定された範囲のステップを計画どおりに実行する / Runs the selected range of steps according to the plan"""
+
     # LLMを必要とするステップのリスト
     # List of steps that require an LLM
     llm_steps = ['step2a', 'step2b', 'step3b', 'step4']
@@ -82,23 +311,158 @@ def main():
     if start_index > end_index:
         parser.error("--start-step は --end-step より前のステップでなければなりません。 / --start-step must be a step before --end-step.")
 
-    for i in range(start_index, end_index + 1):
-        current_step = step_order[i]
-        print(f"\n--- ステップ: {current_step} を開始します / Starting step: {current_step} ---")
+    # 入力・プロンプト・パラメータのハッシュが前回の成功時と同じステップはスキップし、再実行したステップの下流は全て再実行する
+    # Skip steps whose input, prompt and parameter hashes match their last successful run, and rerun everything downstream of a step that reran
+    artifact_store.configure_artifact_format(args.artifact_format)
+    specs = build_step_specs(args)
+    build_state = BuildState()
+    selected_steps = step_order[start_index:end_index + 1]
+
+    if args.stream:
+        # ストリーミングでは step2a/2b/3b をまとめて1つの単位として実行する。このモジュールは step2a/2b/3b とその依存を読み込むため、--stream のときだけ読み込む
+        # In streaming, step2a/2b/3b run together as a single unit. The module imports step2a/2b/3b and their dependencies, so it is imported only with --stream
+        streaming = load_module("streaming")
+        if not all(step_name in selected_steps for step_name in streaming.STREAM_STEPS):
+            parser.error("--stream は step2a から step3b までの全てのステップを含む範囲で指定してください。 / --stream requires a step range covering step2a through step3b.")
+        if args.resume or args.replay_failed:
+            parser.error("--stream は --resume / --replay-failed と同時に指定できません。 / --stream cannot be combined with --resume / --replay-failed.")
+    else:
+        streaming = None
+
+    def always_run_reason(step_name):
+        if args.replay_failed and step_name in llm_steps:
+            return "--replay-failed"
+        if args.resume and step_name in llm_steps:
+            # 中断されたステップの続きを処理する。完了済みの単位はチェックポイントでスキップされる
+            # Continue an interrupted step; completed units are skipped through the checkpoint
+            return "--resume"
+        if args.neo4j_full_sync and step_name == 'step6':
+            return "--neo4j-full-sync"
+        if args.neo4j_dry_run and step_name == 'step6':
+            return "--neo4j-dry-run"
+        return None
+
+    def decide(step_name, upstream_rerun):
+        signature = step_signature(specs[step_name], specs[step_name]["params"])
+        run, reason = decide_step(build_state, step_name, specs[step_name], signature,
+                                  forced=step_name in args.force or 'all' in args.force,
+                                  upstream_rerun=upstream_rerun, always_run_reason=always_run_reason(step_name))
+        return run, reason, signature
+
+    def decide_stream(upstream_rerun):
+        # いずれかのステップが古ければストリーム全体を実行する
+        # The whole stream runs if any of its steps is out of date
+        for step_name in streaming.STREAM_STEPS:
+            run, reason, _ = decide(step_name, upstream_rerun)
+            if run:
+                return True, f"{step_name}: {reason}"
+        return False, "最新 / up to date"
+
+    if args.dry_run:
+        print("実行計画 / Execution plan:")
+        upstream_rerun = False
+        for step_name in selected_steps:
+            if args.stream and step_name in streaming.STREAM_STEPS:
+                if step_name != streaming.STREAM_STEPS[0]:
+                    continue
+                run, reason = decide_stream(upstream_rerun)
+                step_name = "+".join(streaming.STREAM_STEPS) + " (stream)"
+            else:
+                run, reason, _ = decide(step_name, upstream_rerun)
+            upstream_rerun = upstream_rerun or run
+            print(f"  {step_name}: {'実行 / run' if run else 'スキップ / skip'} ({reason})")
+        return
+
+    # レートリミッターを設定（全LLMステップで共有）
+    # Configure the rate limiter (shared by all LLM steps)
+    # --wait は1分に1件未満のレート（例: --wait 120）も表せるよう、RPMに丸めず開始間隔として渡す
+    # --wait is passed as a start interval rather than rounded into an RPM, so rates below one per minute (e.g. --wait 120) are kept
+    min_interval = args.wait if args.rpm is None and args.wait else None
+    llm_utils.configure_rate_limiter(rpm=args.rpm, tpm=args.tpm, min_interval=min_interval)
+    llm_utils.configure_concurrency(args.concurrency)
+    llm_utils.configure_cache(args.cache_dir, enabled=not args.no_cache, max_bytes=args.cache_max_mb * 1024 * 1024)
+    if args.model_backend == "fake":
+        llm_utils.configure_model_backend("fake", latency=args.fake_latency, error_rate=args.fake_error_rate)
+    else:
+        llm_utils.configure_model_backend(args.model_backend)
+
+    upstream_rerun = False
+    for current_step in selected_steps:
+        if args.stream and current_step in streaming.STREAM_STEPS:
+            if current_step != streaming.STREAM_STEPS[0]:
+                continue
+            run, reason = decide_stream(upstream_rerun)
+            if not run:
+                print(f"\n--- ストリーム: {'+'.join(streaming.STREAM_STEPS)} は最新のためスキップします / Skipping stream: {'+'.join(streaming.STREAM_STEPS)} (up to date) ---")
+                continue
+            upstream_rerun = True
+            print(f"\n--- ストリーム: {'+'.join(streaming.STREAM_STEPS)} を開始します ({reason}) / Starting stream: {'+'.join(streaming.STREAM_STEPS)} ({reason}) ---")
+            print(f"使用モデル / Model used: {args.model} ({args.model_backend})")
+            print(f"同時実行数 / Concurrency: {args.concurrency}")
+            for step_name in streaming.STREAM_STEPS:
+                build_state.invalidate(step_name)
+            started = time.time()
+            llm_utils.reset_llm_stats()
+            streaming.main(model_name=args.model, retries=args.retries, token_budget=args.batch_token_budget,
+                           fast_path=not args.no_fast_path, dedup=not args.no_dedup)
+            llm_utils.print_cache_stats()
+            llm_utils.print_llm_stats()
+            # 下流のステップの入力は上流の出力なので、シグネチャは実行後に計算する
+            # Downstream inputs are upstream outputs, so signatures are computed after the run
+            for step_name in streaming.STREAM_STEPS:
+                if all(os.path.exists(path) and os.path.getmtime(path) >= int(started) for path in specs[step_name]["outputs"]):
+                    build_state.record(step_name, step_signature(specs[step_name], specs[step_name]["params"]))
+            print(f"--- ストリーム: {'+'.join(streaming.STREAM_STEPS)} が完了しました / Stream: {'+'.join(streaming.STREAM_STEPS)} completed ---")
+            continue
+
+        run, reason, signature = decide(current_step, upstream_rerun)
+        if not run:
+            print(f"\n--- ステップ: {current_step} は最新のためスキップします / Skipping step: {current_step} (up to date) ---")
+            continue
+        upstream_rerun = True
+        print(f"\n--- ステップ: {current_step} を開始します ({reason}) / Starting step: {current_step} ({reason}) ---")
         
         kwargs = {}
         if current_step == 'step1':
             kwargs['start_page'] = args.start_page
             kwargs['end_page'] = args.end_page
+            kwargs['input_path'] = args.input
+            kwargs['workers'] = args.workers
+            kwargs['strip_headers'] = not args.keep_boilerplate
+        elif current_step == 'step6':
+            kwargs['batch_size'] = args.neo4j_batch_size
+            kwargs['bulk_export'] = args.neo4j_bulk_export
+            kwargs['full_sync'] = args.neo4j_full_sync
+            kwargs['dry_run'] = args.neo4j_dry_run
         elif current_step in llm_steps:
             kwargs['model_name'] = args.model
-            kwargs['wait'] = args.wait
             kwargs['retries'] = args.retries
-            print(f"使用モデル / Model used: {args.model}")
-            print(f"待機時間 / Wait time: {args.wait}秒 / seconds")
+            kwargs['resume'] = args.resume
+            kwargs['replay_failed'] = args.replay_failed
+            if current_step in ('step2a', 'step2b'):
+                kwargs['token_budget'] = args.batch_token_budget
+            if current_step == 'step2a':
+                kwargs['fast_path'] = not args.no_fast_path
+            if current_step in ('step2a', 'step2b', 'step3b'):
+                kwargs['dedup'] = not args.no_dedup
+            print(f"使用モデル / Model used: {args.model} ({args.model_backend})")
+            print(f"レート制限 / Rate limit: RPM={args.rpm or '無制限 / unlimited'}, TPM={args.tpm or '無制限 / unlimited'}" + (f", 間隔 / interval: {min_interval}s" if min_interval else ""))
+            print(f"同時実行数 / Concurrency: {args.concurrency}")
             print(f"リトライ回数 / Retries: {args.retries}回 / times")
 
-        steps[current_step](**kwargs)
+        # 実行前に前回の成功記録を消し、途中で中断された場合に古い記録で「最新」と判定されないようにする
+        # Clear the previous success record first, so a run interrupted partway is not judged up to date from the old record
+        build_state.invalidate(current_step)
+        started = time.time()
+        llm_utils.reset_llm_stats()
+        load_module(STEP_MODULES[current_step]).main(**kwargs)
+        if current_step in llm_steps:
+            llm_utils.print_cache_stats()
+            llm_utils.print_llm_stats()
+        # 全ての出力がこの実行で書き込まれた場合だけ成功として記録する（入力はステップの実行前に確定している）
+        # Record success only when every output was written by this run (the inputs were fixed before the step ran)
+        if all(os.path.exists(path) and os.path.getmtime(path) >= int(started) for path in specs[current_step]["outputs"]):
+            build_state.record(current_step, signature)
         print(f"--- ステップ: {current_step} が完了しました / Step: {current_step} completed ---")
 
 
@@ -0,0 +1,130 @@
+import heapq
+import json
+import os
+from collections import Counter, defaultdict
+
+# --- 定数 --- #
+# --- Constants --- #
+NORMALIZATION_STORE_PATH = "output/step4_normalization_store.json"
+NEAREST_CANONICAL_NAMES = 5  # 新しい用語1つあたりに文脈として添える既存の正規化名の数 / Number of existing canonical names sent as context per new term
+MAX_CONTEXT_NAMES = 50  # 1回のLLM呼び出しに含める既存の正規化名の上限 / Maximum number of existing canonical names included in one LLM call
+NGRAM_SIZE = 2
+
+def char_ngrams(text, size=NGRAM_SIZE):
+    """用語の文字n-gramの集合を返す（小文字化、短い用語はそれ自体） / Returns the set of character n-grams of a term (lowercased; short terms are their own n-gram)"""
+    text = text.lower()
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+class NormalizationStore:
+    """
+    実行をまたいで保持される正規化の投票の記録。用語ごとに、LLMが提案した正規化名とその得票数を持つ。
+    一度LLMに送った用語は単独では再送せず、過去の投票と合わせた多数決で正規化名を決める（新しい用語と同じ候補クラスタに入ったときだけ再び投票を受ける）。
+    A record of normalization votes kept across runs. For each term it holds the canonical names the LLM suggested and their vote counts.
+    Terms sent to the LLM once are not sent again on their own (they get further votes only when they fall in a candidate cluster with new terms); their canonical name is decided by majority vote over all past votes.
+    fingerprint（プロンプトとモデル名のハッシュ）が記録と異なる場合、過去の投票は別の条件によるものなので破棄して空のストアから始める。
+    If the fingerprint (a hash of the prompt and model name) differs from the recorded one, past votes were cast under other conditions, so they are discarded and the store starts empty.
+    """
+
+    def __init__(self, path=NORMALIZATION_STORE_PATH, fingerprint=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.votes = defaultdict(Counter)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+                if fingerprint is not None and stored.get("fingerprint") != fingerprint:
+                    print(f"正規化のプロンプトまたはモデルが変わったため、正規化ストアの過去の投票を破棄します: {path} / The normalization prompt or model changed, discarding past votes in the normalization store: {path}")
+                    stored = {}
+                for term, counts in stored.get("votes", {}).items():
+                    self.votes[term].update(counts)
+            except json.JSONDecodeError:
+                print(f"警告: 正規化ストアを読み込めないため、空のストアから開始します: {path} / Warning: Could not read the normalization store, starting from an empty store: {path}")
+
+    def __contains__(self, term):
+        return term in self.votes
+
+    def __len__(self):
+        return len(self.votes)
+
+    def add_votes(self, terms, batch_map):
+        """
+        1回のLLM呼び出しの結果を投票として加える。マップに含まれない送信済みの用語は、自身を正規化名とする票になる。
+        Adds the result of one LLM call as votes. Sent terms missing from the map count as a vote for themselves as the canonical name.
+        """
+        for alias, normalized_name in batch_map.items():
+            self.votes[alias][normalized_name] += 1
+        for term in terms:
+            if term not in batch_map:
+                self.votes[term][term] += 1
+
+    def canonical_name(self, term):
+        """多数決で選ばれた正規化名を返す（同数の場合は先に投票された名前） / Returns the canonical name chosen by majority vote (ties go to the name voted for first)"""
+        counts = self.votes.get(term)
+        if not counts:
+            return term
+        return counts.most_common(1)[0][0]
+
+    def canonical_names(self):
+        """現在の正規化名の集合 / The set of current canonical names"""
+        return {self.canonical_name(term) for term in self.votes}
+
+    def normalization_map(self, terms=None):
+        """
+        エイリアスから正規化名へのマップを返す（正規化名自身は含めない）。terms を指定するとその用語に限る。
+        Returns the map from aliases to canonical names (canonical names themselves are not included). Limited to terms if given.
+        """
+        normalization_map = {}
+        for term in (self.votes if terms is None else terms):
+            if term not in self.votes:
+                continue
+            canonical_name = self.canonical_name(term)
+            if canonical_name != term:
+                normalization_map[term] = canonical_name
+        return normalization_map
+
+    def save(self):
+        """ストアを原子的に書き換える / Atomically rewrites the store"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({"fingerprint": self.fingerprint, "votes": self.votes}, f, ensure_ascii=False, indent=2)
+        os.replace(temporary_path, self.path)
+
+class CanonicalNameIndex:
+    """
+    既存の正規化名に対する文字n-gramの転置インデックス。新しい用語に近い正規化名をn-gramのJaccard係数で検索する。
+    An inverted index of character n-grams over existing canonical names, finding the names nearest to a new term by n-gram Jaccard similarity.
+    """
+
+    def __init__(self, names):
+        self.names = sorted(names)
+        self._ngrams = [char_ngrams(name) for name in self.names]
+        self._postings = defaultdict(list)
+        for name_id, ngrams in enumerate(self._ngrams):
+            for ngram in ngrams:
+                self._postings[ngram].append(name_id)
+
+    def nearest(self, term, k=NEAREST_CANONICAL_NAMES):
+        """用語に近い正規化名を (類似度, 名前) の降順で最大k件返す / Returns up to k canonical names nearest to the term as (similarity, name), best first"""
+        ngrams = char_ngrams(term)
+        shared = Counter(name_id for ngram in ngrams for name_id in self._postings.get(ngram, ()))
+        scored = (
+            (count / (len(ngrams) + len(self._ngrams[name_id]) - count), self.names[name_id])
+            for name_id, count in shared.items()
+        )
+        return heapq.nlargest(k, scored)
+
+    def context_for(self, terms, k=NEAREST_CANONICAL_NAMES, limit=MAX_CONTEXT_NAMES):
+        """
+        用語のバッチに添える既存の正規化名のリストを返す。各用語の近傍をまとめ、類似度の高い順に limit 件までに絞る。
+        Returns the existing canonical names sent with a batch of terms: the neighbours of every term, best first, up to limit names.
+        """
+        best = {}
+        for term in terms:
+            for score, name in self.nearest(term, k):
+                if name != term and score > best.get(name, 0.0):
+                    best[name] = score
+        return [name for name, _ in sorted(best.items(), key=lambda item: (-item[1], item[0]))[:limit]]
@@ -0,0 +1,258 @@
+import re
+from itertools import combinations
+
+# --- 定数 --- #
+# --- Constants --- #
+MAX_PAIR_CHAR_DISTANCE = 200  # 同一文にないペアを残す最大文字距離 / Maximum character distance for pairs not in the same sentence
+PAIR_BUDGET_PER_PARAGRAPH = 150  # 1段落あたりにLLMへ送るペアの上限 (Noneで無制限) / Maximum pairs per paragraph sent to the LLM (None for unlimited)
+MAX_CONTEXTS_PER_PAIR = 3  # 関係が見つからないペアを問い合わせ直す最大の段落数 / Maximum paragraphs a pair with no relation found is queried with
+SENTENCE_BOUNDARY_PATTERN = re.compile(r"[。．！？!?\n]|\.(?=\s)")
+
+# 関係が成立しうるカテゴリの組み合わせ（順不同）。ここに無いカテゴリ同士のペアはLLMに送らない。
+# 行列に登場しないカテゴリ（未知のカテゴリ）を含むペアは、取りこぼしを避けるため常に残す。
+# Category combinations (unordered) that can hold a relation. Pairs of categories not listed here are not sent to the LLM.
+# Pairs involving a category absent from the matrix (an unknown category) are always kept to avoid losing relations.
+CATEGORY_COMPATIBILITY = {
+    "Disease": {"Disease", "Symptom", "Anatomy", "Drug", "Treatment", "Test/Diagnosis", "Pathophysiology", "MedicalDevice", "RiskFactor"},
+    "Symptom": {"Disease", "Symptom", "Anatomy", "Drug", "Treatment", "Test/Diagnosis", "Pathophysiology", "MedicalDevice", "RiskFactor"},
+    "Anatomy": {"Disease", "Symptom"},
+    "Drug": {"Disease", "Symptom", "Pathophysiology"},
+    "Treatment": {"Disease", "Symptom", "Pathophysiology"},
+    "Test/Diagnosis": {"Disease", "Symptom", "Pathophysiology"},
+    "Pathophysiology": {"Disease", "Symptom", "Drug", "Treatment", "Test/Diagnosis", "Pathophysiology", "RiskFactor"},
+    "MedicalDevice": {"Disease", "Symptom"},
+    "RiskFactor": {"Disease", "Symptom", "Pathophysiology"},
+    "ClinicalAttribute": set(),
+    "Organization": set(),
+}
+
+class PruningStats:
+    """ペア枝刈りの集計 / Counters for entity pair pruning"""
+
+    def __init__(self):
+        self.considered = 0
+        self.dropped_category = 0
+        self.dropped_distance = 0
+        self.dropped_budget = 0
+
+    @property
+    def kept(self):
+        return self.considered - self.dropped_category - self.dropped_distance - self.dropped_budget
+
+    @property
+    def dropped(self):
+        return self.considered - self.kept
+
+    def report(self):
+        print(f"ペア枝刈り: 候補 {self.considered}件, 保持 {self.kept}件, 除外 {self.dropped}件 (カテゴリ {self.dropped_category}, 距離 {self.dropped_distance}, 上限 {self.dropped_budget}) / Pair pruning: {self.considered} considered, {self.kept} kept, {self.dropped} dropped (category {self.dropped_category}, distance {self.dropped_distance}, budget {self.dropped_budget})")
+
+def is_category_compatible(category1, category2, compatibility=CATEGORY_COMPATIBILITY):
+    """2つのカテゴリ間に関係が成立しうるかを判定する / Determines whether a relation can hold between two categories"""
+    if category1 not in compatibility or category2 not in compatibility:
+        return True
+    return category2 in compatibility[category1] or category1 in compatibility[category2]
+
+def sentence_ids(paragraph):
+    """段落内の各文字が属する文の番号のリストを返す / Returns a list of the sentence number of each character in the paragraph"""
+    ids = []
+    current = 0
+    last_end = 0
+    for match in SENTENCE_BOUNDARY_PATTERN.finditer(paragraph):
+        ids.extend([current] * (match.end() - last_end))
+        last_end = match.end()
+        current += 1
+    ids.extend([current] * (len(paragraph) - last_end))
+    return ids
+
+def mention_distance(mentions1, mentions2):
+    """2つのエンティティの出現位置間の最小文字距離（重なる場合は0） / Minimum character distance between the mentions of two entities (0 if overlapping)"""
+    best = None
+    for start1, end1 in mentions1:
+        for start2, end2 in mentions2:
+            distance = max(0, max(start1, start2) - min(end1, end2))
+            if best is None or distance < best:
+                best = distance
+    return best
+
+def share_sentence(mentions1, mentions2, sentence_of):
+    """2つのエンティティが同じ文に出現するかを判定する / Determines whether two entities occur in the same sentence"""
+    sentences1 = {sentence_of[start] for start, _ in mentions1 if start < len(sentence_of)}
+    return any(start < len(sentence_of) and sentence_of[start] in sentences1 for start, _ in mentions2)
+
+def prune_entity_pairs(paragraph, entities_in_paragraph, stats=None, compatibility=CATEGORY_COMPATIBILITY,
+                       max_char_distance=MAX_PAIR_CHAR_DISTANCE, pair_budget=PAIR_BUDGET_PER_PARAGRAPH):
+    """
+    段落内のエンティティペアから、関係が成立しえないペアを除外する。
+    1. カテゴリ互換性行列で成立しえないカテゴリの組み合わせを除外
+    2. 同じ文になく、出現位置が max_char_distance 文字より離れているペアを除外
+    3. 残ったペアが pair_budget を超える場合、距離の近い順に上限まで残す
+    戻り値のペアは combinations() と同じ順序を保つ。
+    Removes entity pairs in a paragraph that cannot hold a relation.
+    1. Drops category combinations that the compatibility matrix rules out
+    2. Drops pairs not in the same sentence whose mentions are more than max_char_distance characters apart
+    3. If more than pair_budget pairs remain, keeps the closest pairs up to the budget
+    Returned pairs keep the same order as combinations().
+
+    Args:
+        paragraph: 段落のテキスト。 / The paragraph text.
+        entities_in_paragraph: "mentions" (出現位置) を持つエンティティのリスト。 / Entities carrying "mentions" (offsets).
+        stats: 集計を加算するPruningStats（任意）。 / Optional PruningStats to accumulate into.
+    """
+    if stats is None:
+        stats = PruningStats()
+    sentence_of = sentence_ids(paragraph)
+
+    candidates = []
+    for e1, e2 in combinations(entities_in_paragraph, 2):
+        stats.considered += 1
+        if not is_category_compatible(e1.get('category'), e2.get('category'), compatibility):
+            stats.dropped_category += 1
+            continue
+        mentions1 = e1.get('mentions')
+        mentions2 = e2.get('mentions')
+        distance = 0
+        if mentions1 and mentions2:
+            distance = mention_distance(mentions1, mentions2)
+            if distance > max_char_distance and not share_sentence(mentions1, mentions2, sentence_of):
+                stats.dropped_distance += 1
+                continue
+        candidates.append((distance, len(candidates), (e1, e2)))
+
+    if pair_budget is not None and len(candidates) > pair_budget:
+        stats.dropped_budget += len(candidates) - pair_budget
+        candidates = sorted(sorted(candidates)[:pair_budget], key=lambda candidate: candidate[1])
+
+    return [pair for _, _, pair in candidates]
+
+class PairRegistry:
+    """
+    段落をまたいでエンティティペアを追跡するレジストリ。
+    同じ (source, target) ペアは全ての出現段落を記録した上で、まず最初の段落を文脈としてLLMに問い合わせ、
+    関係が見つからなかったペアだけを次の出現段落で問い合わせ直します（最大 MAX_CONTEXTS_PER_PAIR 段落まで）。
+    抽出された関係の根拠は、実際にLLMへ文脈として送った段落（とその近似重複）に限られます。
+    A registry tracking entity pairs across paragraphs.
+    Each (source, target) pair is recorded with all its occurrences and first queried with its first paragraph as context;
+    only pairs with no relation found are queried again with their next occurrence (up to MAX_CONTEXTS_PER_PAIR paragraphs).
+    The evidence of an extracted relation is limited to the paragraphs actually sent to the LLM as context (and their near-duplicates).
+    """
+
+    def __init__(self):
+        self._pairs = {}
+        self._emitted = set()
+        self._answered = set()
+        self.occurrences = 0
+        self.evidence_only = 0
+
+    @staticmethod
+    def pair_key(term1, term2):
+        """向きに依存しないペアのキー / Direction-independent key of a pair"""
+        return (term1, term2) if term1 <= term2 else (term2, term1)
+
+    def register(self, pair, paragraph_id, source_pages, as_context=True, document_id=None, context_id=None):
+        """
+        ペアの出現を記録する。初出の場合はTrueを返す。
+        as_context=Falseの出現（近似重複する段落など）は問い合わせの文脈には使わず、context_id の段落が文脈として送られたときだけ根拠に加える。
+        document_id を指定すると、ページを文書ごとにも記録する（複数の文書のページ番号が混ざらないように）。
+        Records an occurrence of a pair; returns True on first occurrence.
+        Occurrences with as_context=False (e.g. near-duplicate paragraphs) are not used as query context; they only add evidence when paragraph context_id is sent as context.
+        With a document_id, pages are also recorded per document (so page numbers of different documents do not mix).
+        """
+        if pair[0]['term'] == pair[1]['term']:
+            return False
+        self.occurrences += 1
+        key = self.pair_key(pair[0]['term'], pair[1]['term'])
+        record = self._pairs.get(key)
+        is_new = record is None
+        if is_new:
+            record = {"pair": pair, "context_ids": [], "occurrences": {}, "queried": set(), "category_pairs": []}
+            self._pairs[key] = record
+        # 同じ用語が複数のカテゴリで現れる場合に備え、出現ごとのカテゴリの組をキーの用語順に記録する
+        # A term may appear under several categories, so each occurrence's category pair is recorded in the key's term order
+        categories = (pair[0].get('category'), pair[1].get('category'))
+        if pair[0]['term'] != key[0]:
+            categories = categories[::-1]
+        if categories not in record["category_pairs"]:
+            record["category_pairs"].append(categories)
+        if not as_context:
+            self.evidence_only += 1
+        else:
+            context_id = paragraph_id
+            if paragraph_id not in record["context_ids"]:
+                record["context_ids"].append(paragraph_id)
+        record["occurrences"][paragraph_id] = (context_id, document_id, sorted(source_pages))
+        return is_new
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def keys(self):
+        """登録された全てのペアのキー / Keys of all registered pairs"""
+        return set(self._pairs)
+
+    def evidence(self, term1, term2, context_ids=None):
+        """
+        文脈として送った段落 context_ids（Noneなら全ての段落）でのペアの出現箇所の根拠（ページ、文書ID → ページ、段落番号）と、
+        (term1のカテゴリ, term2のカテゴリ) の組のリストを返す（未登録、または context_ids に出現しない場合はNone）。
+        Returns the evidence (pages, document ID -> pages, paragraph ids) of a pair's occurrences in the paragraphs sent as context, context_ids (all paragraphs if None),
+        and its list of (category of term1, category of term2) pairs (None if unknown or not occurring in context_ids).
+        """
+        key = self.pair_key(term1, term2)
+        record = self._pairs.get(key)
+        if record is None:
+            return None
+        occurrences = {paragraph_id: occurrence for paragraph_id, occurrence in record["occurrences"].items()
+                       if context_ids is None or occurrence[0] in context_ids}
+        if not occurrences:
+            return None
+        source_pages = set()
+        source_documents = {}
+        for _, document_id, pages in occurrences.values():
+            source_pages.update(pages)
+            if document_id is not None:
+                source_documents.setdefault(document_id, set()).update(pages)
+        category_pairs = record["category_pairs"] if term1 == key[0] else [categories[::-1] for categories in record["category_pairs"]]
+        return {"source_pages": sorted(source_pages), "paragraph_ids": sorted(occurrences),
+                "source_documents": {document_id: sorted(pages) for document_id, pages in sorted(source_documents.items())},
+                "category_pairs": [list(categories) for categories in category_pairs]}
+
+    def pending_groups(self, max_contexts=MAX_CONTEXTS_PER_PAIR):
+        """
+        まだ関係が見つかっていないペアを、次に問い合わせる文脈段落（まだ送っていない最初の出現段落）ごとにまとめる。
+        最初の呼び出しでは全てのペアが最初の段落に入る。max_contexts 段落を送り終えたペアは含めない。
+        戻り値は (段落番号, ペアのリスト) のリストで、段落番号順に並ぶ。
+        Groups the pairs with no relation found yet by the context paragraph to query next (their first occurrence not yet sent).
+        On the first call every pair falls in its first paragraph. Pairs already sent with max_contexts paragraphs are left out.
+        Returns a list of (paragraph id, list of pairs), ordered by paragraph id.
+        """
+        grouped = {}
+        for key, record in self._pairs.items():
+            if key in self._answered or len(record["queried"]) >= max_contexts:
+                continue
+            next_context = next((paragraph_id for paragraph_id in record["context_ids"] if paragraph_id not in record["queried"]), None)
+            if next_context is not None:
+                grouped.setdefault(next_context, []).append(record["pair"])
+        return sorted(grouped.items(), key=lambda group: group[0])
+
+    def mark_queried(self, pairs, context_ids):
+        """ペアを context_ids の段落を文脈として問い合わせたことを記録する / Records that pairs were queried with the paragraphs context_ids as context"""
+        for e1, e2 in pairs:
+            record = self._pairs.get(self.pair_key(e1['term'], e2['term']))
+            if record is not None:
+                record["queried"].update(paragraph_id for paragraph_id in context_ids if paragraph_id in record["context_ids"])
+
+    def mark_answered(self, term1, term2):
+        """ペアに関係が見つかったことを記録する（以降は問い合わせ直さない） / Records that a relation was found for a pair (it is not queried again)"""
+        self._answered.add(self.pair_key(term1, term2))
+
+    def mark_emitted(self, source, relation, target):
+        """関係の出力を記録する。既に出力済みの場合はFalseを返す / Records an emitted relation; returns False if it was already emitted"""
+        key = (source, relation, target)
+        if key in self._emitted:
+            return False
+        self._emitted.add(key)
+        return True
+
+    def report(self):
+        print(f"ペアの重複排除: 出現 {self.occurrences}件 → 一意のペア {len(self)}件 ({self.occurrences - len(self)}件の重複問い合わせを削減) / Pair deduplication: {self.occurrences} occurrences -> {len(self)} unique pairs ({self.occurrences - len(self)} duplicate queries avoided)")
+        if self.evidence_only:
+            print(f"近似重複する段落での出現 {self.evidence_only}件は文脈に含めず、根拠にだけ加えました / {self.evidence_only} occurrences in near-duplicate paragraphs were added as evidence only, not as context")
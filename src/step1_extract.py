@@ -1,62 +1,185 @@
-import fitz  # PyMuPDF
-import json
+import glob
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from .layout_utils import BoilerplateStats, strip_boilerplate
+from .artifact_store import write_records
 
-def extract_text_from_pdf(pdf_path, start_page=None, end_page=None):
-    """PDFから指定されたページ範囲のテキストを抽出する
-    Extracts text from a specified page range of a PDF."""
-    doc = fitz.open(pdf_path)
+# --- 定数 --- #
+# --- Constants --- #
+DEFAULT_INPUT_PATH = "input/c00543.pdf"
+OUTPUT_PATH = "output/step1_structured_text.json"
+PAGES_PER_SHARD = 16  # 1つのワーカーが一度に処理するページ数 / Number of pages a worker processes at a time
+
+def resolve_pdf_paths(input_path):
+    """
+    入力パス（PDFファイル、ディレクトリ、またはglobパターン）を、PDFファイルのパスのソート済みリストに展開する。
+    Expands an input path (a PDF file, a directory or a glob pattern) into a sorted list of PDF file paths.
+    """
+    if os.path.isdir(input_path):
+        pdf_paths = glob.glob(os.path.join(input_path, "**", "*.pdf"), recursive=True)
+    elif os.path.isfile(input_path):
+        pdf_paths = [input_path]
+    else:
+        pdf_paths = [path for path in glob.glob(input_path, recursive=True) if path.lower().endswith(".pdf")]
+    if not pdf_paths:
+        raise FileNotFoundError(f"PDFファイルが見つかりません: {input_path} / No PDF files found: {input_path}")
+    return sorted(pdf_paths)
+
+def assign_document_ids(pdf_paths):
+    """
+    各PDFにファイル名（拡張子なし）から文書IDを割り当てる。同名のファイルには連番を付けて一意にする。
+    Assigns each PDF a document ID from its file name (without extension). Files with the same name get a numeric suffix to stay unique.
+    """
+    document_ids = []
+    seen = {}
+    for pdf_path in pdf_paths:
+        stem = os.path.splitext(os.path.basename(pdf_path))[0]
+        seen[stem] = seen.get(stem, 0) + 1
+        document_ids.append(stem if seen[stem] == 1 else f"{stem}_{seen[stem]}")
+    return document_ids
+
+def plan_page_shards(pdf_paths, document_ids, start_page=None, end_page=None, pages_per_shard=PAGES_PER_SHARD):
+    """
+    各PDFのページ範囲を、ワーカーに割り当てるシャード (文書ID, PDFパス, 開始インデックス, 終了インデックス) に分割する。
+    シャードは (文書, ページ) の順に並ぶ。
+    Splits the page range of each PDF into shards (document ID, PDF path, start index, end index) assigned to workers.
+    Shards are ordered by (document, page).
+    """
+    import fitz  # PyMuPDF（step1を実行するときだけ読み込む / imported only when step1 runs）
+    shards = []
+    for document_id, pdf_path in zip(document_ids, pdf_paths):
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+
+        # ページ範囲の指定がない場合は全ページを対象とする
+        # If no page range is specified, target all pages
+        first_page = start_page if start_page is not None else 1
+        last_page = end_page if end_page is not None else page_count
+        if len(pdf_paths) > 1:
+            # 複数文書の場合、ページ範囲は各文書のページ数に収める
+            # With several documents, the page range is clipped to each document's page count
+            last_page = min(last_page, page_count)
+            if first_page > last_page:
+                continue
+
+        # PyMuPDFのページ番号は0から始まるため調整
+        # Adjust for PyMuPDF's 0-based page numbering
+        start_index = first_page - 1
+        end_index = last_page - 1
+
+        # ページ範囲が妥当かチェック
+        # Check if the page range is valid
+        if start_index < 0 or end_index >= page_count or start_index > end_index:
+            raise ValueError(f"Invalid page range: {first_page}-{last_page}")
+
+        for shard_start in range(start_index, end_index + 1, pages_per_shard):
+            shards.append((document_id, pdf_path, shard_start, min(shard_start + pages_per_shard - 1, end_index)))
+    return shards
+
+def extract_page_shard(shard):
+    """
+    1つのシャードのページからテキストとテキストブロックの座標を抽出する。ワーカープロセスごとに自身のfitz文書を開く。
+    Extracts the text and text block coordinates from the pages of one shard. Each worker process opens its own fitz document.
+    """
+    import fitz  # PyMuPDF
+    document_id, pdf_path, start_index, end_index = shard
+    text_by_page = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(start_index, end_index + 1):
+            page = doc.load_page(page_num)
+            # テキストブロック（block_type 0）だけを残す。ブロックを連結すると page.get_text() と同じテキストになる
+            # Keep text blocks only (block_type 0); concatenating them gives the same text as page.get_text()
+            blocks = [
+                {"bbox": [x0, y0, x1, y1], "text": text}
+                for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks")
+                if block_type == 0
+            ]
+            # ページ番号は1から始まるように+1する
+            # Increment page number by 1 to make it 1-based
+            text_by_page.append({
+                "document_id": document_id,
+                "page_number": page_num + 1,
+                "text": "".join(block['text'] for block in blocks),
+                "height": page.rect.height,
+                "blocks": blocks,
+            })
+    return text_by_page
+
+def extract_text_from_pdfs(pdf_paths, start_page=None, end_page=None, workers=None, pages_per_shard=PAGES_PER_SHARD):
+    """
+    複数のPDFから指定されたページ範囲のテキストを、プロセスプールで並列に抽出する。
+    結果は (文書, ページ) の順に返され、各レコードには document_id が付与される。
+    Extracts text from the given page range of several PDFs in parallel on a process pool.
+    Results are returned in (document, page) order, and every record carries a document_id.
+
+    Args:
+        workers: ワーカープロセス数（NoneでCPUコア数、1以下で単一プロセス）。 / Number of worker processes (None for the CPU core count, 1 or less for a single process).
+    """
+    document_ids = assign_document_ids(pdf_paths)
+    shards = plan_page_shards(pdf_paths, document_ids, start_page=start_page, end_page=end_page, pages_per_shard=pages_per_shard)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(shards)) if shards else 1
+
+    started = time.monotonic()
     text_by_page = []
-    
-    # ページ範囲の指定がない場合は全ページを対象とする
-    # If no page range is specified, target all pages
-    if start_page is None:
-        start_page = 1
-    if end_page is None:
-        end_page = doc.page_count
-
-    # PyMuPDFのページ番号は0から始まるため調整
-    # Adjust for PyMuPDF's 0-based page numbering
-    start_index = start_page - 1
-    end_index = end_page - 1
-
-    # ページ範囲が妥当かチェック
-    # Check if the page range is valid
-    if start_index < 0 or end_index >= doc.page_count or start_index > end_index:
-        raise ValueError(f"Invalid page range: {start_page}-{end_page}")
-
-    for page_num in range(start_index, end_index + 1):
-        page = doc.load_page(page_num)
-        text = page.get_text()
-        # ページ番号は1から始まるように+1する
-        # Increment page number by 1 to make it 1-based
-        text_by_page.append({"page_number": page_num + 1, "text": text})
-        
-    doc.close()
+    if workers <= 1:
+        for shard in shards:
+            text_by_page.extend(extract_page_shard(shard))
+    else:
+        # executor.map は入力順に結果を返すため、出力の順序は安定する
+        # executor.map returns results in input order, so the output order is stable
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for shard_pages in executor.map(extract_page_shard, shards):
+                text_by_page.extend(shard_pages)
+    elapsed = time.monotonic() - started
+
+    pages_per_second = len(text_by_page) / elapsed if elapsed > 0 else float('inf')
+    print(f"{len(pdf_paths)}文書・{len(text_by_page)}ページを{workers}プロセスで{elapsed:.2f}秒で抽出しました ({pages_per_second:.1f}ページ/秒) / Extracted {len(text_by_page)} pages from {len(pdf_paths)} documents with {workers} processes in {elapsed:.2f}s ({pages_per_second:.1f} pages/s)")
     return text_by_page
 
-def main(start_page=None, end_page=None):
+def extract_text_from_pdf(pdf_path, start_page=None, end_page=None, workers=None):
+    """PDFから指定されたページ範囲のテキストを抽出する
+    Extracts text from a specified page range of a PDF."""
+    return extract_text_from_pdfs([pdf_path], start_page=start_page, end_page=end_page, workers=workers)
+
+def main(start_page=None, end_page=None, input_path=DEFAULT_INPUT_PATH, workers=None, strip_headers=True):
     """メイン処理
     Main process"""
-    pdf_path = "input/c00543.pdf"
-    output_path = "output/step1_structured_text.json"
+    output_path = OUTPUT_PATH
 
     # outputディレクトリが存在しない場合は作成
     # Create the output directory if it does not exist
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
+    pdf_paths = resolve_pdf_paths(input_path)
+    print(f"{len(pdf_paths)}件のPDFを処理します: {input_path} / Processing {len(pdf_paths)} PDF files: {input_path}")
+
     if start_page and end_page:
         print(f"PDFから {start_page}ページから{end_page}ページまでのテキストを抽出中... / Extracting text from pages {start_page} to {end_page} of the PDF...")
     else:
         print("PDFから全ページのテキストを抽出中... / Extracting text from all pages of the PDF...")
 
-    structured_data = extract_text_from_pdf(pdf_path, start_page=start_page, end_page=end_page)
+    structured_data = extract_text_from_pdfs(pdf_paths, start_page=start_page, end_page=end_page, workers=workers)
+
+    if strip_headers:
+        # LLMに送る前に、ヘッダー・フッター・ページ番号・繰り返される定型文を決定的に除去する
+        # Deterministically remove headers, footers, page numbers and repeated boilerplate before any LLM call
+        print("ヘッダー・フッターと定型文を除去中... / Stripping headers, footers and boilerplate...")
+        boilerplate_stats = BoilerplateStats()
+        strip_boilerplate(structured_data, stats=boilerplate_stats)
+        boilerplate_stats.report()
+
+    # ブロックの座標はstep2aの段落構築で使うため出力に残す
+    # Block coordinates are kept in the output for paragraph building in step2a
+    for page in structured_data:
+        del page['height']
 
     print(f"構造化されたデータを {output_path} に保存中... / Saving structured data to {output_path}...")
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(structured_data, f, ensure_ascii=False, indent=2)
+    write_records(output_path, structured_data)
 
     print("処理が完了しました。 / Process completed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
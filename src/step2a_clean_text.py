@@ -1,68 +1,46 @@
 import json
-import time
-from .llm_utils import get_gemini_model, llm_generate_with_retry
+from collections import defaultdict
+from .llm_utils import DEFAULT_BATCH_TOKEN_BUDGET, get_model, llm_generate_with_retry, pack_batches, print_packing_stats
+from .checkpoint_utils import UnitJournal, compute_fingerprint, iter_resumable
+from .failure_utils import DeadLetterQueue, bisect_process, collect_replay_units
+from .layout_utils import build_paragraphs, classify_paragraph
+from .dedup_utils import DuplicateClusters, find_near_duplicates
+from .artifact_store import load_records, write_records
 import os
 
+# --- 定数 --- #
+# --- Constants --- #
+EXPECTED_OUTPUT_RATIO = 1.0  # クレンジング後の出力は入力とほぼ同じ長さになる / Cleaned output is about as long as the input
+
 def load_structured_text(file_path):
     """構造化されたテキストデータを読み込む
     Loads structured text data."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return load_records(file_path)
 
 def create_paragraphs_with_source(pages):
     """ページ分割されたテキストから、出典情報付きの段落リストを作成する
-    Creates a list of paragraphs with source information from paginated text."""
-    paragraphs = []
-    current_paragraph = ""
-    current_pages = set()
-
-    for page in pages:
-        page_number = page['page_number']
-        text = page['text']
-        # ページ内のテキストを空行で分割
-        # Split the text within a page by blank lines
-        lines = text.split('\n')
-        
-        for i, line in enumerate(lines):
-            # 行が空でなく、前の段落が続いている場合
-            # If the line is not empty and the previous paragraph continues
-            if line.strip() and current_paragraph:
-                current_paragraph += " " + line
-            # 行が空でなく、新しい段落が始まる場合
-            # If the line is not empty and a new paragraph begins
-            elif line.strip():
-                current_paragraph = line
-            # 行が空（段落の区切り）で、現在の段落に内容がある場合
-            # If the line is empty (paragraph break) and the current paragraph has content
-            elif not line.strip() and current_paragraph:
-                paragraphs.append({
-                    "paragraph": current_paragraph.strip(),
-                    "source_pages": sorted(list(current_pages))
-                })
-                current_paragraph = ""
-                current_pages = set()
-            
-            # 現在の段落にページ番号を追加
-            # Add the page number to the current paragraph
-            if current_paragraph:
-                current_pages.add(page_number)
-
-            # ページの最後の行で、まだ段落が続いている場合
-            # If it is the last line of the page and the paragraph is still continuing
-            if i == len(lines) - 1 and current_paragraph:
-                # 次のページに続く可能性があるため、ここでは段落を確定しない
-                # Do not finalize the paragraph here as it may continue on the next page
-                pass
-
-    # 最後の段落を追加
-    # Add the last paragraph
-    if current_paragraph:
-        paragraphs.append({
-            "paragraph": current_paragraph.strip(),
-            "source_pages": sorted(list(current_pages))
-        })
+    step1が出力したテキストブロックの座標を使い、空行・箇条書き・ブロック間の空きで段落を区切ります。
+    Creates a list of paragraphs with source information from paginated text.
+    Uses the text block coordinates output by step1 to break paragraphs at blank lines, list items and gaps between blocks."""
+    return build_paragraphs(pages)
 
-    return paragraphs
+def route_paragraphs(paragraphs_with_source):
+    """
+    段落を、そのまま出力できるクリーンな段落（高速パス）と、LLMによるクレンジングが必要な段落に振り分ける。
+    戻り値は (高速パスのクレンジング済みレコードのリスト, LLMに送る段落の番号のリスト)。
+    Routes paragraphs into clean ones that can be output as is (fast path) and ones that need LLM cleaning.
+    Returns (a list of cleaned records for the fast path, a list of the indices of paragraphs sent to the LLM).
+    """
+    fast_records = []
+    llm_indices = []
+    for index, item in enumerate(paragraphs_with_source):
+        if classify_paragraph(item):
+            llm_indices.append(index)
+            continue
+        record = {key: value for key, value in item.items() if key != 'layout_issues'}
+        record.update({"origin": index, "piece": 0})
+        fast_records.append(record)
+    return fast_records, llm_indices
 
 def load_prompt_template(file_path):
     """プロンプトテンプレートを読み込む
@@ -70,58 +48,208 @@ def load_prompt_template(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-def clean_paragraphs_with_llm_batch(paragraphs_with_source, prompt_template, model, wait=60, retries=3, batch_size=5):
-    """LLMを使用して段落をクレンジングする（バッチ処理＆リトライ機能付き）
-    Cleans paragraphs using an LLM (with batch processing and retry functionality)."""
-    cleaned_data = []
-    
-    paragraphs_to_clean = [item['paragraph'] for item in paragraphs_with_source]
-
-    for i in range(0, len(paragraphs_to_clean), batch_size):
-        batch_paragraphs = paragraphs_to_clean[i:i + batch_size]
-        batch_source_info = paragraphs_with_source[i:i + batch_size]
-
-        batch_json = json.dumps(batch_paragraphs, ensure_ascii=False, indent=2)
-        prompt = prompt_template.replace("{{JSON_INPUT}}", batch_json)
-        
-        try:
-            print(f"段落バッチ {i // batch_size + 1} のクレンジングを開始... ({len(batch_paragraphs)}段落) / Starting cleaning for paragraph batch {i // batch_size + 1} ... ({len(batch_paragraphs)} paragraphs)")
-            response = llm_generate_with_retry(model, prompt, retries=retries)
-            
-            response_text = response.text.strip()
-            if response_text.startswith("```json") and response_text.endswith("```"):
-                response_json_str = response_text[len("```json"):-len("```")].strip()
-            else:
-                response_json_str = response_text
-
-            batch_cleaned_data = json.loads(response_json_str)
-            cleaned_paragraphs_batch = batch_cleaned_data.get('cleaned_paragraphs', [])
-            
-            for idx, cleaned_text in enumerate(cleaned_paragraphs_batch):
-                if cleaned_text and idx < len(batch_source_info):
-                    original_source = batch_source_info[idx]['source_pages']
-                    cleaned_data.append({
-                        "paragraph": cleaned_text,
-                        "source_pages": original_source
-                    })
-
-            print(f"段落バッチ {i // batch_size + 1} のクレンジングが完了しました。 / Cleaning of paragraph batch {i // batch_size + 1} completed.")
-
-        except Exception as e:
-            print(f"バッチ処理中に致命的なエラーが発生しました: {e} / A fatal error occurred during batch processing: {e}")
-            # エラーが発生したバッチはスキップして次のバッチへ
-            # Skip the batch where the error occurred and proceed to the next one
-            continue
-        finally:
-            # APIのレート制限を避けるために待機
-            # Wait to avoid API rate limits
-            if i + batch_size < len(paragraphs_to_clean):
-                print(f"{wait}秒待機します... / Waiting for {wait} seconds...")
-                time.sleep(wait)
-            
-    return cleaned_data
-
-def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
+def clean_paragraph_batch(batch_number, batch_source_info, prompt_template, model, retries=3):
+    """1バッチ分の段落をLLMでクレンジングする（失敗時はNoneを返す）
+    Cleans one batch of paragraphs with the LLM (returns None on failure)."""
+    batch_paragraphs = [item['paragraph'] for item in batch_source_info]
+    batch_json = json.dumps(batch_paragraphs, ensure_ascii=False, indent=2)
+    prompt = prompt_template.replace("{{JSON_INPUT}}", batch_json)
+
+    try:
+        print(f"段落バッチ {batch_number} のクレンジングを開始... ({len(batch_paragraphs)}段落) / Starting cleaning for paragraph batch {batch_number} ... ({len(batch_paragraphs)} paragraphs)")
+        response = llm_generate_with_retry(model, prompt, retries=retries)
+
+        response_text = response.text.strip()
+        if response_text.startswith("```json") and response_text.endswith("```"):
+            response_json_str = response_text[len("```json"):-len("```")].strip()
+        else:
+            response_json_str = response_text
+
+        batch_cleaned_data = json.loads(response_json_str)
+        cleaned_paragraphs_batch = batch_cleaned_data.get('cleaned_paragraphs', [])
+
+        cleaned_batch = []
+        for idx, cleaned_text in enumerate(cleaned_paragraphs_batch):
+            if cleaned_text and idx < len(batch_source_info):
+                original_source = batch_source_info[idx]['source_pages']
+                cleaned_record = {
+                    "paragraph": cleaned_text,
+                    "source_pages": original_source,
+                    "origin": batch_source_info[idx].get('origin', idx),
+                    "piece": batch_source_info[idx].get('piece', 0)
+                }
+                if 'document_id' in batch_source_info[idx]:
+                    cleaned_record['document_id'] = batch_source_info[idx]['document_id']
+                cleaned_batch.append(cleaned_record)
+
+        print(f"段落バッチ {batch_number} のクレンジングが完了しました。 / Cleaning of paragraph batch {batch_number} completed.")
+        return cleaned_batch
+
+    except Exception as e:
+        print(f"バッチ処理中に致命的なエラーが発生しました: {e} / A fatal error occurred during batch processing: {e}")
+        return None
+
+def merge_split_paragraphs(cleaned_data):
+    """
+    予算超過のため分割してクレンジングした段落の断片を、元の段落単位に連結し直す。
+    Rejoins the pieces of paragraphs that were split for the token budget into their original paragraphs.
+    """
+    merged = []
+    # 再処理したバッチの結果は末尾に追加されるため、元の段落と断片の順に並べ直す
+    # Results of replayed batches are appended at the end, so restore the order of original paragraphs and pieces
+    cleaned_data = sorted(cleaned_data, key=lambda record: (record['origin'], record.get('piece', 0)))
+    for record in cleaned_data:
+        if merged and merged[-1]['origin'] == record['origin']:
+            previous = merged[-1]['paragraph']
+            separator = " " if previous and previous[-1].isascii() and record['paragraph'][:1].isascii() else ""
+            merged[-1]['paragraph'] = previous + separator + record['paragraph']
+        else:
+            merged.append(dict(record))
+    for record in merged:
+        del record['origin']
+        record.pop('piece', None)
+    return merged
+
+def pack_replay_batches(items, token_budget=DEFAULT_BATCH_TOKEN_BUDGET):
+    """
+    デッドレターから読み込んだ段落の断片をバッチに詰め直す。元の段落番号（origin）と断片番号（piece）は保持する。
+    Re-packs paragraph pieces loaded from the dead letters into batches, keeping their original paragraph (origin) and piece numbers.
+    """
+    packed_batches, _ = pack_batches(items, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)
+    units = []
+    for batch in packed_batches:
+        for record in batch:
+            original = items[record['origin']]
+            record['origin'] = original.get('origin', record['origin'])
+            record['piece'] = original.get('piece', 0) + record['piece']
+        units.append({"batch_number": f"replay-{len(units) + 1}", "items": batch})
+    return units
+
+def iter_cleaned_paragraphs(paragraphs_with_source, prompt_template, model, retries=3, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, journal=None, dead_letters=None, fast_path=True, dedup=True):
+    """LLMを使用して段落をクレンジングし、クレンジング済みの段落を入力順にyieldする（バッチ処理＆リトライ機能付き）
+    段落はトークン予算に収まるようにバッチに詰め込まれ、予算を超える段落は分割後に連結し直されます。
+    バッチは並行して処理され、段落は自身を含む全てのバッチが完了した時点で入力順にyieldされるため、下流の処理は全体の完了を待たずに開始できます。
+    journalを指定すると、完了したバッチが記録され、再開時にはスキップされます。
+    失敗したバッチは二分割して再試行され、単独でも失敗した段落は dead_letters に保存されます。
+    fast_path=Trueの場合、既にクリーンな段落（classify_paragraph を参照）はLLMを経由せずに出力されます。
+    dedup=Trueの場合、近似重複する段落はクラスタごとに代表段落だけをLLMに送り、結果を各メンバーの出典ページに展開します。
+    Cleans paragraphs using an LLM and yields the cleaned paragraphs in input order (with batch processing and retry functionality).
+    Paragraphs are packed into batches within the token budget; paragraphs over budget are split and rejoined afterwards.
+    Batches are processed concurrently, and each paragraph is yielded in input order as soon as every batch holding it has completed, so downstream processing can start before the whole input is done.
+    If a journal is given, completed batches are recorded and skipped on resume.
+    Failed batches are bisected and retried; paragraphs that still fail on their own are saved to dead_letters.
+    With fast_path=True, paragraphs that are already clean (see classify_paragraph) are output without going through the LLM.
+    With dedup=True, only the representative of each cluster of near-duplicate paragraphs is sent to the LLM, and its result fans out to every member's source pages."""
+    records_by_origin = defaultdict(list)
+
+    if fast_path:
+        fast_records, llm_indices = route_paragraphs(paragraphs_with_source)
+    else:
+        fast_records, llm_indices = [], list(range(len(paragraphs_with_source)))
+    fast_ratio = len(fast_records) / len(paragraphs_with_source) if paragraphs_with_source else 0.0
+    print(f"高速パス: {len(fast_records)}/{len(paragraphs_with_source)}段落 ({fast_ratio:.1%}) はクリーンなためLLMを経由しません / Fast path: {len(fast_records)}/{len(paragraphs_with_source)} paragraphs ({fast_ratio:.1%}) are clean and skip the LLM")
+    for record in fast_records:
+        records_by_origin[record['origin']].append(record)
+    llm_paragraphs = [
+        {key: value for key, value in paragraphs_with_source[index].items() if key != 'layout_issues'}
+        for index in llm_indices
+    ]
+
+    # 近似重複する段落は代表段落だけをLLMに送る
+    # Send only the representative of near-duplicate paragraphs to the LLM
+    if dedup:
+        clusters = find_near_duplicates([item['paragraph'] for item in llm_paragraphs])
+    else:
+        clusters = DuplicateClusters.singletons(len(llm_paragraphs))
+    duplicates_by_origin = {
+        llm_indices[representative]: [llm_indices[member] for member in clusters.duplicates_of(representative)]
+        for representative in clusters.representatives
+    }
+    calls_without_dedup = len(pack_batches(llm_paragraphs, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)[0])
+    llm_indices = [llm_indices[representative] for representative in clusters.representatives]
+    llm_paragraphs = [llm_paragraphs[representative] for representative in clusters.representatives]
+
+    packed_batches, packing_stats = pack_batches(llm_paragraphs, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)
+    print_packing_stats("step2a", packing_stats, token_budget)
+    clusters.report("step2a", calls_without_dedup, len(packed_batches))
+
+    batches = []
+    for batch_number, batch_source_info in enumerate(packed_batches, start=1):
+        batches.append({
+            "key": UnitJournal.unit_key(batch_number),
+            "fingerprint": compute_fingerprint([prompt_template, batch_source_info]),
+            "batch_number": batch_number,
+            "items": batch_source_info,
+        })
+
+    batches.extend(collect_replay_units(journal, dead_letters, lambda items: pack_replay_batches(items, token_budget)))
+
+    # 各段落（と重複する段落）の断片を含む未完了のバッチを記録し、全て完了した段落から入力順に出力する。
+    # 以前の再処理で完了した単位は内容が分からないため、その場合は最後にまとめて出力する
+    # Track the unfinished batches holding pieces of each paragraph (and its duplicates), and output paragraphs in input order once all of them are done.
+    # Units completed by an earlier replay have unknown contents, so in that case everything is output at the end
+    origins_by_batch = {}
+    pending_batches = defaultdict(int)
+    for batch in batches:
+        origins = {member for item in batch["items"]
+                   for member in [llm_indices[item['origin']]] + duplicates_by_origin.get(llm_indices[item['origin']], [])}
+        origins_by_batch[batch["key"]] = origins
+        for origin in origins:
+            pending_batches[origin] += 1
+    hold_until_end = any(not batch["items"] for batch in batches)
+    next_origin = 0
+
+    def flush(final=False):
+        nonlocal next_origin
+        while next_origin < len(paragraphs_with_source) and (final or not (hold_until_end or pending_batches.get(next_origin))):
+            records = records_by_origin.pop(next_origin, [])
+            pending_batches.pop(next_origin, None)
+            next_origin += 1
+            if records:
+                yield merge_split_paragraphs(records)[0]
+
+    def process(batch):
+        cleaned_batch, failed_items = bisect_process(
+            batch["items"],
+            lambda items: clean_paragraph_batch(batch["batch_number"], items, prompt_template, model, retries=retries)
+        )
+        if dead_letters is None:
+            return cleaned_batch
+        # 失敗した段落はデッドレターに移し、バッチ自体は完了として記録する
+        # Move failed paragraphs to the dead letters and record the batch itself as completed
+        dead_letters.add(batch["key"], failed_items)
+        return cleaned_batch if cleaned_batch is not None else []
+
+    yield from flush()
+    for batch, cleaned_batch, _ in iter_resumable(journal, batches, process):
+        # エラーが発生したバッチの結果はスキップして次のバッチへ
+        # Skip the results of a batch where the error occurred and proceed to the next one
+        # LLMに送った段落の番号（origin）を、入力全体での段落番号に戻す
+        # Map the origin of paragraphs sent to the LLM back to their index in the full input
+        # 代表段落の結果は、重複する各段落にもその段落の出典情報で展開する
+        # A representative's result also fans out to each of its duplicates, with that paragraph's source information
+        for record in cleaned_batch or []:
+            origin = llm_indices[record['origin']]
+            records_by_origin[origin].append(dict(record, origin=origin))
+            for duplicate in duplicates_by_origin.get(origin, []):
+                duplicate_record = dict(record, origin=duplicate, source_pages=paragraphs_with_source[duplicate]['source_pages'])
+                if 'document_id' in paragraphs_with_source[duplicate]:
+                    duplicate_record['document_id'] = paragraphs_with_source[duplicate]['document_id']
+                records_by_origin[duplicate].append(duplicate_record)
+        for origin in origins_by_batch[batch["key"]]:
+            pending_batches[origin] -= 1
+        yield from flush()
+    yield from flush(final=True)
+
+def clean_paragraphs_with_llm_batch(paragraphs_with_source, prompt_template, model, retries=3, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, journal=None, dead_letters=None, fast_path=True, dedup=True):
+    """LLMを使用して段落をクレンジングし、クレンジング済みの段落のリストを返す（iter_cleaned_paragraphs を参照）
+    Cleans paragraphs using an LLM and returns the list of cleaned paragraphs (see iter_cleaned_paragraphs)."""
+    return list(iter_cleaned_paragraphs(
+        paragraphs_with_source, prompt_template, model, retries=retries, token_budget=token_budget,
+        journal=journal, dead_letters=dead_letters, fast_path=fast_path, dedup=dedup
+    ))
+
+def main(model_name='gemini-1.5-flash-latest', retries=3, resume=False, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, replay_failed=False, fast_path=True, dedup=True):
     """メイン処理
     Main process"""
     input_path = "output/step1_structured_text.json"
@@ -139,20 +267,28 @@ def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
     prompt_template = load_prompt_template(prompt_template_path)
 
     print("LLMモデルを初期化中... / Initializing LLM model...")
-    model = get_gemini_model(model_name)
+    model = get_model(model_name)
 
     print("LLMを使用して段落をクレンジング中（バッチ処理）... / Cleaning paragraphs using LLM (batch processing)...")
+    journal = UnitJournal("step2a", resume=resume or replay_failed)
+    dead_letters = DeadLetterQueue("step2a", resume=resume, replay=replay_failed)
     cleaned_paragraphs = clean_paragraphs_with_llm_batch(
         paragraphs_with_source, 
         prompt_template, 
         model, 
-        wait=wait, 
-        retries=retries
+        retries=retries,
+        token_budget=token_budget,
+        journal=journal,
+        dead_letters=dead_letters,
+        fast_path=fast_path,
+        dedup=dedup
     )
+    journal.close()
+    dead_letters.report()
+    dead_letters.close()
 
     print(f"クレンジングされた段落を {output_cleaned_text_path} に保存中... / Saving cleaned paragraphs to {output_cleaned_text_path}...")
-    with open(output_cleaned_text_path, 'w', encoding='utf-8') as f:
-        json.dump(cleaned_paragraphs, f, ensure_ascii=False, indent=2)
+    write_records(output_cleaned_text_path, cleaned_paragraphs)
 
     print("処理が完了しました。 / Process completed.")
 
@@ -1,13 +1,20 @@
 import json
 from collections import defaultdict
-import time
-from .llm_utils import get_gemini_model, llm_generate_with_retry
+from .llm_utils import DEFAULT_BATCH_TOKEN_BUDGET, estimate_tokens, get_model, llm_generate_with_retry, map_concurrently, pack_batches, print_packing_stats
+from .entity_index import EntityIndex
+from .checkpoint_utils import UnitJournal, compute_fingerprint, iter_resumable
+from .failure_utils import DeadLetterQueue, bisect_process, collect_replay_units
+from .dedup_utils import DuplicateClusters, find_near_duplicates
+from .artifact_store import load_records, write_records
+
+# --- 定数 --- #
+# --- Constants --- #
+EXPECTED_OUTPUT_RATIO = 0.5  # 抽出されるエンティティのJSONは入力のおよそ半分の長さ / The extracted entity JSON is about half as long as the input
 
 def load_cleaned_data(file_path):
     """クレンジングされた段落と出典情報のリストを読み込む
     Loads a list of cleaned paragraphs and source information."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return load_records(file_path)
 
 def load_prompt_template(file_path):
     """プロンプトテンプレートを読み込む
@@ -15,49 +22,116 @@ def load_prompt_template(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-def extract_entities_with_llm_batch(cleaned_data, prompt_template, model, wait=60, retries=3, batch_size=5):
+def extract_entity_batch(batch_number, batch_source_info, prompt_template, model, retries=3):
+    """1バッチ分の段落からLLMでエンティティを抽出し、(term, category)と出典ページの組のリストを返す（失敗時はNone）
+    Extracts entities from one batch of paragraphs with the LLM and returns a list of ((term, category), pages) (None on failure)."""
+    batch_paragraphs = [item['paragraph'] for item in batch_source_info]
+    batch_text = "\n\n".join(batch_paragraphs)
+    prompt = prompt_template.replace("{{JSON_INPUT}}", json.dumps(batch_text, ensure_ascii=False))
+
+    try:
+        print(f"エンティティ抽出バッチ {batch_number} を開始... ({len(batch_paragraphs)}段落) / Starting entity extraction batch {batch_number}... ({len(batch_paragraphs)} paragraphs)")
+        response = llm_generate_with_retry(model, prompt, retries=retries)
+
+        response_text = response.text.strip()
+        if response_text.startswith("```json") and response_text.endswith("```"):
+            response_json_str = response_text[len("```json"):-len("```")].strip()
+        else:
+            response_json_str = response_text
+
+        extracted_data = json.loads(response_json_str)
+
+        extracted_entities = [entity for entity in extracted_data.get('entities', []) if 'term' in entity and 'category' in entity]
+        categories_by_term = defaultdict(list)
+        for entity in extracted_entities:
+            if entity['category'] not in categories_by_term[entity['term']]:
+                categories_by_term[entity['term']].append(entity['category'])
+
+        # バッチ内の用語でインデックスを構築し、各段落を1回だけ走査して出現箇所を特定する
+        # Build an index over the batch's terms and scan each paragraph once to find occurrences
+        entity_index = EntityIndex(categories_by_term)
+        batch_entities = []
+        for item in batch_source_info:
+            for term in entity_index.find_mentions(item['paragraph']):
+                for category in categories_by_term[term]:
+                    batch_entities.append(((term, category), item['source_pages']))
+
+        print(f"エンティティ抽出バッチ {batch_number} が完了しました。 / Entity extraction batch {batch_number} completed.")
+        return batch_entities
+
+    except Exception as e:
+        print(f"バッチ処理中に致命的なエラーが発生しました: {e} / A fatal error occurred during batch processing: {e}")
+        return None
+
+def extract_entities_with_llm_batch(cleaned_data, prompt_template, model, retries=3, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, journal=None, dead_letters=None, dedup=True):
     """LLMを使用してエンティティを抽出する（バッチ処理＆リトライ機能付き）
-    Extracts entities using an LLM (with batch processing and retry functionality)."""
+    段落はトークン予算に収まるようにバッチに詰め込まれ、予算を超える段落は分割されます。
+    バッチは並行して処理されますが、結果は入力順に統合されるため出力は決定的です。
+    journalを指定すると、完了したバッチが記録され、再開時にはスキップされます。
+    失敗したバッチは二分割して再試行され、単独でも失敗した段落は dead_letters に保存されます。
+    dedup=Trueの場合、近似重複する段落はクラスタごとに代表段落だけをLLMに送り、抽出結果をクラスタ全体の出典ページに展開します。
+    Extracts entities using an LLM (with batch processing and retry functionality).
+    Paragraphs are packed into batches within the token budget, and paragraphs over budget are split.
+    Batches are processed concurrently, but results are merged in input order so the output is deterministic.
+    If a journal is given, completed batches are recorded and skipped on resume.
+    Failed batches are bisected and retried; paragraphs that still fail on their own are saved to dead_letters.
+    With dedup=True, only the representative of each cluster of near-duplicate paragraphs is sent to the LLM, and its entities fan out to the source pages of the whole cluster."""
     entity_sources = defaultdict(set)
-    paragraphs_to_process = [item['paragraph'] for item in cleaned_data]
-
-    for i in range(0, len(paragraphs_to_process), batch_size):
-        batch_paragraphs = paragraphs_to_process[i:i + batch_size]
-        batch_source_info = cleaned_data[i:i + batch_size]
-        
-        batch_text = "\n\n".join(batch_paragraphs)
-        prompt = prompt_template.replace("{{JSON_INPUT}}", json.dumps(batch_text, ensure_ascii=False))
-        
-        try:
-            print(f"エンティティ抽出バッチ {i // batch_size + 1} を開始... ({len(batch_paragraphs)}段落) / Starting entity extraction batch {i // batch_size + 1}... ({len(batch_paragraphs)} paragraphs)")
-            response = llm_generate_with_retry(model, prompt, retries=retries)
-            
-            response_text = response.text.strip()
-            if response_text.startswith("```json") and response_text.endswith("```"):
-                response_json_str = response_text[len("```json"):-len("```")].strip()
-            else:
-                response_json_str = response_text
-
-            extracted_data = json.loads(response_json_str)
-            
-            for entity in extracted_data.get('entities', []):
-                if 'term' in entity and 'category' in entity:
-                    for item in batch_source_info:
-                        if entity['term'] in item['paragraph']:
-                            entity_key = (entity['term'], entity['category'])
-                            for page_num in item['source_pages']:
-                                entity_sources[entity_key].add(page_num)
-
-            print(f"エンティティ抽出バッチ {i // batch_size + 1} が完了しました。 / Entity extraction batch {i // batch_size + 1} completed.")
-
-        except Exception as e:
-            print(f"バッチ処理中に致命的なエラーが発生しました: {e} / A fatal error occurred during batch processing: {e}")
+
+    # 近似重複する段落は代表段落だけをLLMに送り、出典ページはクラスタ全体の和集合とする
+    # Send only the representative of near-duplicate paragraphs, with the union of the cluster's source pages
+    if dedup:
+        clusters = find_near_duplicates([item['paragraph'] for item in cleaned_data])
+    else:
+        clusters = DuplicateClusters.singletons(len(cleaned_data))
+    representative_data = []
+    for representative in clusters.representatives:
+        pages = {page for member in clusters.members[representative] for page in cleaned_data[member]['source_pages']}
+        representative_data.append(dict(cleaned_data[representative], source_pages=sorted(pages)))
+    calls_without_dedup = len(pack_batches(cleaned_data, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)[0])
+
+    packed_batches, packing_stats = pack_batches(representative_data, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)
+    print_packing_stats("step2b", packing_stats, token_budget)
+    clusters.report("step2b", calls_without_dedup, len(packed_batches))
+
+    batches = []
+    for batch_number, batch_source_info in enumerate(packed_batches, start=1):
+        batches.append({
+            "key": UnitJournal.unit_key(batch_number),
+            "fingerprint": compute_fingerprint([prompt_template, batch_source_info]),
+            "batch_number": batch_number,
+            "items": batch_source_info,
+        })
+
+    def pack_replay_batches(items):
+        replay_batches, _ = pack_batches(items, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)
+        return [{"batch_number": f"replay-{n}", "items": batch} for n, batch in enumerate(replay_batches, start=1)]
+
+    batches.extend(collect_replay_units(journal, dead_letters, pack_replay_batches))
+
+    def process(batch):
+        batch_entities, failed_items = bisect_process(
+            batch["items"],
+            lambda items: extract_entity_batch(batch["batch_number"], items, prompt_template, model, retries=retries)
+        )
+        if dead_letters is None:
+            return batch_entities
+        # 失敗した段落はデッドレターに移し、バッチ自体は完了として記録する
+        # Move failed paragraphs to the dead letters and record the batch itself as completed
+        dead_letters.add(batch["key"], failed_items)
+        return batch_entities if batch_entities is not None else []
+
+    for _, batch_entities, _ in iter_resumable(journal, batches, process):
+        if batch_entities is None:
             continue
-        finally:
-            if i + batch_size < len(paragraphs_to_process):
-                print(f"{wait}秒待機します... / Waiting for {wait} seconds...")
-                time.sleep(wait)
-            
+        for (term, category), pages in batch_entities:
+            entity_sources[(term, category)].update(pages)
+
+    return format_entities(entity_sources)
+
+def format_entities(entity_sources):
+    """(term, category) ごとの出典ページの集合を、出力するエンティティのリストに変換する
+    Converts the source page sets per (term, category) into the list of entities to output."""
     final_entities = []
     for (term, category), pages in entity_sources.items():
         final_entities.append({
@@ -65,10 +139,80 @@ def extract_entities_with_llm_batch(cleaned_data, prompt_template, model, wait=6
             "category": category,
             "source_pages": sorted(list(pages))
         })
-    
     return final_entities
 
-def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
+def iter_paragraph_entities(paragraphs, prompt_template, model, retries=3, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, dead_letters=None, duplicate_index=None):
+    """ストリーミング実行用: 到着する段落をトークン予算ごとにバッチにまとめてエンティティを抽出し、
+    (段落, 段落内のエンティティの(term, category)のリスト, 代表段落の番号) を入力順にyieldする。
+    バッチは予算に達した時点でLLMに送られるため、上流の段落が全て揃うのを待たない。
+    duplicate_index（NearDuplicateIndex）を指定すると、近似重複する段落はLLMに送らず代表段落のエンティティを使う。
+    For streaming execution: packs arriving paragraphs into batches per token budget, extracts their entities, and yields
+    (paragraph, list of (term, category) in the paragraph, index of its representative) in input order.
+    A batch is sent to the LLM as soon as it reaches the budget, without waiting for every upstream paragraph.
+    With a duplicate_index (NearDuplicateIndex), near-duplicate paragraphs are not sent to the LLM and reuse their representative's entities."""
+    cost_factor = 1.0 + EXPECTED_OUTPUT_RATIO
+
+    def make_batch(batch_number, members):
+        # 代表段落だけをLLMに送り、予算を超える段落は pack_batches で分割する
+        # Only representatives go to the LLM; paragraphs over budget are split by pack_batches
+        positions = [position for position, _, representative in members if representative == position]
+        records = [record for position, record, representative in members if representative == position]
+        packed_batches, _ = pack_batches(records, token_budget=token_budget, output_ratio=EXPECTED_OUTPUT_RATIO)
+        return {
+            "key": UnitJournal.unit_key("stream", batch_number),
+            "batch_number": batch_number,
+            "members": members,
+            "positions": positions,
+            "packed": packed_batches,
+        }
+
+    def plan_batches():
+        members = []
+        members_cost = 0
+        batch_number = 0
+        for position, record in enumerate(paragraphs):
+            representative = duplicate_index.add(record['paragraph']) if duplicate_index is not None else position
+            cost = int(estimate_tokens(record['paragraph']) * cost_factor) if representative == position else 0
+            if members and members_cost and members_cost + cost > token_budget:
+                batch_number += 1
+                yield make_batch(batch_number, members)
+                members, members_cost = [], 0
+            members.append((position, record, representative))
+            members_cost += cost
+        if members:
+            yield make_batch(batch_number + 1, members)
+
+    def process(batch):
+        entities_by_position = defaultdict(dict)
+        for items in batch["packed"]:
+            batch_entities, failed_items = bisect_process(
+                items,
+                lambda part: extract_entity_batch(batch["batch_number"], part, prompt_template, model, retries=retries)
+            )
+            if dead_letters is not None:
+                dead_letters.add(batch["key"], failed_items)
+            # バッチで抽出された用語を、それぞれが出現する段落に対応付ける
+            # Map the terms extracted for the batch to the paragraphs they occur in
+            categories_by_term = defaultdict(list)
+            for (term, category), _ in batch_entities or []:
+                if category not in categories_by_term[term]:
+                    categories_by_term[term].append(category)
+            entity_index = EntityIndex(categories_by_term)
+            for item in items:
+                position = batch["positions"][item['origin']]
+                for term in entity_index.find_mentions(item['paragraph']):
+                    for category in categories_by_term[term]:
+                        entities_by_position[position][(term, category)] = None
+        return batch, entities_by_position
+
+    entities_of_representative = {}
+    for batch, entities_by_position in map_concurrently(process, plan_batches()):
+        for position, record, representative in batch["members"]:
+            if representative == position:
+                entities_of_representative[position] = list(entities_by_position.get(position, {}))
+            yield record, entities_of_representative[representative], representative
+
+def main(model_name='gemini-1.5-flash-latest', retries=3, resume=False, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, replay_failed=False, dedup=True):
     """メイン処理
     Main process"""
     input_path = "output/step2a_cleaned_text.json"
@@ -82,20 +226,27 @@ def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
     prompt_template = load_prompt_template(prompt_template_path)
 
     print("LLMモデルを初期化中... / Initializing LLM model...")
-    model = get_gemini_model(model_name)
+    model = get_model(model_name)
 
     print("LLMを使用してエンティティを抽出中（バッチ処理）... / Extracting entities using LLM (batch processing)...")
+    journal = UnitJournal("step2b", resume=resume or replay_failed)
+    dead_letters = DeadLetterQueue("step2b", resume=resume, replay=replay_failed)
     entities = extract_entities_with_llm_batch(
         cleaned_data, 
         prompt_template, 
         model, 
-        wait=wait, 
-        retries=retries
+        retries=retries,
+        token_budget=token_budget,
+        journal=journal,
+        dead_letters=dead_letters,
+        dedup=dedup
     )
+    journal.close()
+    dead_letters.report()
+    dead_letters.close()
 
     print(f"抽出されたエンティティを {output_entities_path} に保存中... / Saving extracted entities to {output_entities_path}...")
-    with open(output_entities_path, 'w', encoding='utf-8') as f:
-        json.dump(entities, f, ensure_ascii=False, indent=2)
+    write_records(output_entities_path, entities)
 
     print("処理が完了しました。 / Process completed.")
 
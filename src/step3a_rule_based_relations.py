@@ -1,6 +1,7 @@
 import json
 import spacy
 from spacy.matcher import Matcher
+from .entity_index import EntityIndex
 
 def main():
     # GiNZAのロード
@@ -18,6 +19,9 @@ def main():
     # エンティティのリストをセットに変換（高速なルックアップのため）
     # Convert the list of entities to a set (for faster lookup)
     entity_terms = {entity["term"] for entity in entities}
+    # 段落中のエンティティを1回の走査で見つけるためのインデックス
+    # Index to find the entities in a paragraph in a single pass
+    entity_index = EntityIndex(entity["term"] for entity in entities)
 
     relations = []
     for item in cleaned_text:
@@ -30,7 +34,8 @@ def main():
         if paragraph.strip().startswith("CQ"):
             # 段落に含まれるエンティティを特定
             # Identify entities contained in the paragraph
-            found_entities = [entity for entity in entities if entity["term"] in paragraph]
+            found_terms = entity_index.find_mentions(paragraph)
+            found_entities = [entity for entity in entities if entity["term"] in found_terms]
             
             # 疾患と治療法が1つずつ含まれ、「有効か」という文字列があれば関係を抽出
             # Extract relationship if one disease and one treatment are included and the string "有効か" (is it effective) is present
@@ -1,18 +1,23 @@
 import json
 from collections import defaultdict
-import time
-from .llm_utils import get_gemini_model, llm_generate_with_retry
-from itertools import combinations
+from .llm_utils import get_model, llm_generate_with_retry
+from .entity_index import EntityIndex
+from .pair_pruning import PairRegistry, PruningStats, prune_entity_pairs
+from .checkpoint_utils import UnitJournal, compute_fingerprint, iter_resumable
+from .artifact_store import ArtifactWriter, artifact_offset, artifact_path, get_artifact_format, iter_records, load_records, truncate_artifact
+from .failure_utils import DeadLetterQueue, bisect_process, collect_replay_units
+from .dedup_utils import DuplicateClusters, find_near_duplicates
 from string import Template
-import os
 
 
 # --- 定数 ---
 # --- Constants ---
 ENTITY_PAIR_BATCH_SIZE = 100 # 1回のLLM呼び出しで処理するエンティティペアの数 / Number of entity pairs to process in a single LLM call
+MAX_PARAGRAPHS_PER_BATCH = 3 # ペアの少ない段落をまとめて1回で問い合わせる際の最大段落数 / Maximum paragraphs combined into one call when packing paragraphs with few pairs
 INPUT_CLEANED_TEXT_PATH = "output/step2a_cleaned_text.json"
 INPUT_ENTITIES_PATH = "output/step2b_entities.json"
 OUTPUT_FILE = "output/step3b_relations.jsonl"
+REQUERY_UNIT_PREFIX = "requery"  # 2回目以降の問い合わせのバッチのキーの接頭辞 / Key prefix of batches in later query rounds
 MAX_TOTAL_BATCHES = None # テスト用に最大バッチ数を設定 (Noneで無制限) / Set a maximum number of batches for testing (None for unlimited)
 
 def load_prompt_template(file_path):
@@ -23,91 +28,440 @@ def load_prompt_template(file_path):
         print(f"エラー: プロンプトファイルが見つかりません: {file_path} / Error: Prompt file not found: {file_path}")
         return None
 
-def extract_relations_in_batches(model, paragraph, entities_in_paragraph, prompt_template, total_batch_counter, wait=60, retries=3):
-    if len(entities_in_paragraph) < 2:
-        return
+def group_entities_by_term(entities):
+    """用語ごとにエンティティのインデックスをまとめる（同じ用語が複数カテゴリで現れる場合がある） / Groups entity indices by term (a term may appear under several categories)"""
+    entity_ids_by_term = defaultdict(list)
+    for entity_id, entity in enumerate(entities):
+        entity_ids_by_term[entity['term']].append(entity_id)
+    return entity_ids_by_term
 
-    all_pairs = list(combinations(entities_in_paragraph, 2))
-    
-    for i in range(0, len(all_pairs), ENTITY_PAIR_BATCH_SIZE):
-        if MAX_TOTAL_BATCHES is not None and total_batch_counter >= MAX_TOTAL_BATCHES:
-            print("\nテスト用の最大バッチ数に達したため、処理を停止します。 / Reached the maximum number of batches for testing. Stopping processing.")
-            return
-
-        batch_pairs = all_pairs[i:i + ENTITY_PAIR_BATCH_SIZE]
-        entity_pairs_json = json.dumps([{"source": e1['term'], "target": e2['term']} for e1, e2 in batch_pairs], ensure_ascii=False, indent=2)
-
-        prompt = prompt_template.substitute(
-            context_paragraph=paragraph,
-            entity_pairs=entity_pairs_json
-        )
-
-        try:
-            log_message = f"  - バッチ {total_batch_counter + 1}"
-            if MAX_TOTAL_BATCHES is not None:
-                log_message += f"/{MAX_TOTAL_BATCHES}"
-            log_message += f" (段落内 {i//ENTITY_PAIR_BATCH_SIZE + 1}/{(len(all_pairs) + ENTITY_PAIR_BATCH_SIZE - 1)//ENTITY_PAIR_BATCH_SIZE}): {len(batch_pairs)}ペアを処理中... / Processing {len(batch_pairs)} pairs..."
-            print(log_message)
-            
-            response = llm_generate_with_retry(model, prompt, retries=retries)
-            response_text = response.text.strip()
-            
-            json_start = response_text.find('[')
-            json_end = response_text.rfind(']')
-            
-            if json_start != -1 and json_end != -1:
-                json_response_str = response_text[json_start:json_end+1]
-                relations = json.loads(json_response_str)
-                print(f"    -> {len(relations)}件の関係を抽出しました。 / Extracted {len(relations)} relations.")
-                for rel in relations:
-                    yield rel
-            else:
-                print(f"    -> 警告: レスポンスから有効なJSON配列が見つかりませんでした。 / Warning: No valid JSON array found in the response.")
-
-        except json.JSONDecodeError:
-            print(f"    -> エラー: LLMのレスポンスのJSONパースに失敗しました。 / Error: Failed to parse JSON from LLM response.")
-            print(f"       LLM Response: {response_text}")
-        except Exception as e:
-            print(f"    -> LLM呼び出し中に致命的なエラーが発生しました: {e} / A fatal error occurred during the LLM call: {e}")
-        
-        total_batch_counter += 1
-        yield total_batch_counter # ジェネレータから更新されたカウンタを返す / Return the updated counter from the generator
-
-        if i + ENTITY_PAIR_BATCH_SIZE < len(all_pairs):
-            time.sleep(wait)
-
-def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
+def find_entities_in_paragraph(entity_index, entities, paragraph, entity_ids_by_term=None):
+    """
+    段落に出現するエンティティを、エンティティリストの順序で返す。
+    各エンティティのコピーには、段落内の出現位置 (開始, 終了) のリストが "mentions" として付与される。
+    Returns the entities occurring in a paragraph, in the order of the entity list.
+    Each returned copy carries its (start, end) offsets in the paragraph as "mentions".
+    """
+    if entity_ids_by_term is None:
+        entity_ids_by_term = group_entities_by_term(entities)
+    mentions_by_term = entity_index.find_mentions(paragraph)
+    entity_ids = sorted(entity_id for term in mentions_by_term for entity_id in entity_ids_by_term[term])
+    return [dict(entities[entity_id], mentions=mentions_by_term[entities[entity_id]['term']]) for entity_id in entity_ids]
+
+def build_context(cleaned_text, context_ids):
+    """
+    問い合わせに使う文脈テキストを作成する。複数段落の場合は各段落に出典ページを付けて連結する。
+    Builds the context text for a query. Multiple paragraphs are joined, each labelled with its source pages.
+    """
+    if len(context_ids) == 1:
+        return cleaned_text[context_ids[0]]["paragraph"]
+    return "\n\n".join(
+        f"[{i + 1}] (p.{', '.join(str(page) for page in cleaned_text[paragraph_id]['source_pages'])}) {cleaned_text[paragraph_id]['paragraph']}"
+        for i, paragraph_id in enumerate(context_ids)
+    )
+
+def group_pages_by_document(cleaned_text, paragraph_ids):
+    """段落の出典ページを文書ごとにまとめる（文書ID → ページのリスト。document_id のない段落は含めない） / Groups the source pages of paragraphs by document (document ID -> list of pages; paragraphs without a document_id are left out)"""
+    pages_by_document = defaultdict(set)
+    for paragraph_id in paragraph_ids:
+        document_id = cleaned_text[paragraph_id].get("document_id")
+        if document_id is not None:
+            pages_by_document[document_id].update(cleaned_text[paragraph_id]["source_pages"])
+    return {document_id: sorted(pages) for document_id, pages in sorted(pages_by_document.items())}
+
+def pack_pair_batches(groups, batch_size=ENTITY_PAIR_BATCH_SIZE, max_paragraphs=MAX_PARAGRAPHS_PER_BATCH):
+    """
+    段落ごとのペア（(段落番号, ペアのリスト) のリスト）を、段落順に batch_size ペアまで詰めたバッチに分ける。
+    ペアの少ない段落は最大 max_paragraphs 段落まで1つのバッチにまとめ、batch_size を超える段落は連続するバッチに分ける。
+    (文脈の段落番号のリスト, ペアのリスト) のリストを返す。
+    Splits per-paragraph pairs (a list of (paragraph id, list of pairs)) into batches filled up to batch_size pairs, in paragraph order.
+    Paragraphs with few pairs are combined into one batch, up to max_paragraphs paragraphs; a paragraph over batch_size spans consecutive batches.
+    Returns a list of (list of context paragraph ids, list of pairs).
+    """
+    packed = []
+    context_ids, batch_pairs = [], []
+    for paragraph_id, pairs in groups:
+        remaining = list(pairs)
+        while remaining:
+            if len(batch_pairs) >= batch_size or len(context_ids) >= max_paragraphs:
+                packed.append((context_ids, batch_pairs))
+                context_ids, batch_pairs = [], []
+            taken = remaining[:batch_size - len(batch_pairs)]
+            remaining = remaining[len(taken):]
+            context_ids.append(paragraph_id)
+            batch_pairs.extend(taken)
+    if batch_pairs:
+        packed.append((context_ids, batch_pairs))
+    return packed
+
+def make_relation_batches(cleaned_text, packed, registry, round_index=0):
+    """
+    詰め込んだ (文脈の段落番号のリスト, ペアのリスト) からバッチを作り、各ペアをその文脈で問い合わせたことをレジストリに記録する。
+    2回目以降の問い合わせ（round_index > 0）のバッチは、最初の問い合わせと区別されるキーを持つ。
+    Builds batches from packed (list of context paragraph ids, list of pairs) and records in the registry that each pair was queried with that context.
+    Batches of later query rounds (round_index > 0) get keys distinct from the first round.
+    """
+    # 1つの段落が複数のバッチにまたがる場合に、同じ文脈のバッチの中での番号を振る
+    # Number batches within the same context, for a paragraph spanning several batches
+    batch_counts = defaultdict(int)
+    for context_ids, _ in packed:
+        batch_counts[tuple(context_ids)] += 1
+    batch_indices = defaultdict(int)
+
+    batches = []
+    for context_ids, batch_pairs in packed:
+        if MAX_TOTAL_BATCHES is not None and len(batches) >= MAX_TOTAL_BATCHES:
+            print("\nテスト用の最大バッチ数に達したため、以降のバッチは計画しません。 / Reached the maximum number of batches for testing. No further batches are planned.")
+            break
+        registry.mark_queried(batch_pairs, context_ids)
+        context = build_context(cleaned_text, context_ids)
+        batch_index = batch_indices[tuple(context_ids)]
+        batch_indices[tuple(context_ids)] += 1
+        context_key = "-".join(str(paragraph_id) for paragraph_id in context_ids)
+        key_parts = (context_key, batch_index) if round_index == 0 else (f"{REQUERY_UNIT_PREFIX}{round_index}", context_key, batch_index)
+        batches.append({
+            "key": UnitJournal.unit_key(*key_parts),
+            "fingerprint": compute_fingerprint([context, [(e1['term'], e2['term']) for e1, e2 in batch_pairs]]),
+            "round": round_index,
+            "paragraph_index": context_ids[0],
+            "context_ids": list(context_ids),
+            "batch_index": batch_index,
+            "batch_count": batch_counts[tuple(context_ids)],
+            "paragraph": context,
+            "source_pages": sorted({page for paragraph_id in context_ids for page in cleaned_text[paragraph_id]["source_pages"]}),
+            "source_documents": group_pages_by_document(cleaned_text, context_ids),
+            "pairs": batch_pairs,
+        })
+    return batches
+
+def register_paragraph_pairs(cleaned_text, entities, registry, clusters=None, pruning_stats=None):
+    """
+    代表段落ごとに出現するエンティティのペアを枝刈りしてレジストリに登録し、近似重複する段落での出現を根拠として加える。
+    段落ごとにペアを問い合わせた場合の呼び出し回数（比較用）を返す。
+    Registers the pruned entity pairs occurring in each representative paragraph, adding the occurrences in near-duplicate paragraphs as evidence.
+    Returns the number of calls needed when querying pairs paragraph by paragraph (for comparison).
+    """
+    if clusters is None:
+        clusters = DuplicateClusters.singletons(len(cleaned_text))
+    if pruning_stats is None:
+        pruning_stats = PruningStats()
+    entity_index = EntityIndex(entity['term'] for entity in entities)
+    entity_ids_by_term = group_entities_by_term(entities)
+    per_paragraph_calls = 0
+    for paragraph_index, item in enumerate(cleaned_text):
+        if not clusters.is_representative(paragraph_index):
+            continue
+        paragraph = item["paragraph"]
+        entities_in_paragraph = find_entities_in_paragraph(entity_index, entities, paragraph, entity_ids_by_term)
+        if len(entities_in_paragraph) < 2:
+            continue
+
+        # カテゴリの組み合わせ・出現位置の距離・段落ごとの上限でペアを絞り込む
+        # Narrow down pairs by category combination, mention distance and the per-paragraph budget
+        pairs = prune_entity_pairs(paragraph, entities_in_paragraph, stats=pruning_stats)
+        per_paragraph_calls += (len(pairs) + ENTITY_PAIR_BATCH_SIZE - 1) // ENTITY_PAIR_BATCH_SIZE
+        for pair in pairs:
+            registry.register(pair, paragraph_index, item["source_pages"], document_id=item.get("document_id"))
+            for duplicate in clusters.duplicates_of(paragraph_index):
+                registry.register(pair, duplicate, cleaned_text[duplicate]["source_pages"], as_context=False,
+                                  document_id=cleaned_text[duplicate].get("document_id"), context_id=paragraph_index)
+    return per_paragraph_calls
+
+def plan_relation_batches(cleaned_text, entities, registry=None, clusters=None):
+    """
+    全段落のエンティティペアをLLM呼び出し単位（バッチ）に分割する。
+    同じペアが複数の段落に現れる場合は、まず最初に現れた段落を文脈として一度だけ問い合わせる（関係が見つからなかったペアは plan_requery_batches で次の段落を使って問い合わせ直す）。
+    重複を除いたペアは pack_pair_batches で ENTITY_PAIR_BATCH_SIZE ペアまで詰めるため、この最初の呼び出し回数は段落ごとに問い合わせる場合を超えない。
+    近似重複する段落（clusters）は代表段落だけを文脈に使い、重複する段落は代表段落が文脈として送られたときの根拠（ページと段落番号）にだけ加える。
+    バッチは最初の文脈段落の順に並び、この順序で結果が出力される。
+    Splits the entity pairs of all paragraphs into LLM call units (batches).
+    A pair occurring in several paragraphs is first queried once, with the first paragraph it occurs in as context (pairs with no relation found are queried again with their next paragraph by plan_requery_batches).
+    The deduplicated pairs are packed up to ENTITY_PAIR_BATCH_SIZE pairs by pack_pair_batches, so this first round never makes more calls than querying paragraph by paragraph.
+    For near-duplicate paragraphs (clusters), only the representative is used as context; duplicates only add evidence (pages and paragraph ids) when their representative is sent as context.
+    Batches are ordered by their first context paragraph, and results are written in this order.
+    """
+    if registry is None:
+        registry = PairRegistry()
+    pruning_stats = PruningStats()
+    per_paragraph_calls = register_paragraph_pairs(cleaned_text, entities, registry, clusters=clusters, pruning_stats=pruning_stats)
+    pruning_stats.report()
+    registry.report()
+
+    packed = pack_pair_batches(registry.pending_groups())
+    print(f"LLM呼び出し: {len(packed)}回（段落ごとに問い合わせる場合 {per_paragraph_calls}回） / LLM calls: {len(packed)} (vs. {per_paragraph_calls} when querying paragraph by paragraph)")
+    return make_relation_batches(cleaned_text, packed, registry)
+
+def plan_requery_batches(cleaned_text, registry, round_index):
+    """
+    これまでの問い合わせで関係が見つからなかったペアを、まだ送っていない次の出現段落を文脈にしてバッチに分割する
+    （ペアごとに最大 MAX_CONTEXTS_PER_PAIR 段落まで）。問い合わせ直すペアがなければ空のリストを返す。
+    Splits the pairs with no relation found so far into batches, using their next occurrence not yet sent as context
+    (up to MAX_CONTEXTS_PER_PAIR paragraphs per pair). Returns an empty list if there is nothing to query again.
+    """
+    groups = registry.pending_groups()
+    if not groups:
+        return []
+    packed = pack_pair_batches(groups)
+    print(f"関係の見つからなかった{sum(len(pairs) for _, pairs in groups)}ペアを次の出現段落で問い合わせ直します (ラウンド {round_index + 1}, LLM呼び出し {len(packed)}回) / Querying {sum(len(pairs) for _, pairs in groups)} pairs with no relation found again with their next occurrence (round {round_index + 1}, {len(packed)} LLM calls)")
+    return make_relation_batches(cleaned_text, packed, registry, round_index=round_index)
+
+def plan_replay_batches(cleaned_text, dead_letter_items):
+    """
+    デッドレターから読み込んだペアを、元の文脈段落ごとにバッチへまとめ直す。
+    Regroups pairs loaded from the dead letters into batches per original context paragraphs.
+    """
+    items_by_context = defaultdict(list)
+    for item in dead_letter_items:
+        items_by_context[tuple(item["context_ids"])].append(item)
+
+    batches = []
+    for context_ids, items in sorted(items_by_context.items()):
+        batch_count = (len(items) + ENTITY_PAIR_BATCH_SIZE - 1) // ENTITY_PAIR_BATCH_SIZE
+        for batch_index, i in enumerate(range(0, len(items), ENTITY_PAIR_BATCH_SIZE)):
+            batch_items = items[i:i + ENTITY_PAIR_BATCH_SIZE]
+            batches.append({
+                "paragraph_index": context_ids[0],
+                "context_ids": list(context_ids),
+                "batch_index": batch_index,
+                "batch_count": batch_count,
+                "paragraph": build_context(cleaned_text, context_ids),
+                "source_pages": batch_items[0]["source_pages"],
+                "source_documents": batch_items[0].get("source_documents", {}),
+                "pairs": [tuple(item["pair"]) for item in batch_items],
+                "items": batch_items,
+            })
+    return batches
+
+def plan_streamed_relation_batches(paragraph_entities, registry, pruning_stats=None):
+    """
+    ストリーミング実行用: (段落番号, 段落, 段落内のエンティティの(term, category)のリスト, 代表段落の番号) を受け取るたびに、
+    その段落で初めて現れたペアをバッチにしてyieldする。段落はその段落のバッチの用語だけでなく、それまでに到着した全ての用語と照合する。
+    ここでのペアは暫定で、後から到着した用語とのペアは含まれないため、ストリームの終了後に reconcile_streamed_results で
+    全てのエンティティから作り直したレジストリに合わせ、足りないペアを問い合わせる。
+    近似重複する段落は代表段落のペアを根拠にだけ加える。
+    For streaming execution: each time a (paragraph index, paragraph, list of (term, category) in it, representative index) arrives,
+    yields batches of the pairs first seen in that paragraph. Each paragraph is matched against every term that has arrived so far, not only its own batch's terms.
+    These pairs are provisional and miss terms that arrive later, so once the stream ends they are reconciled by reconcile_streamed_results
+    with a registry rebuilt from all entities, and the missing pairs are queried.
+    Near-duplicate paragraphs add their representative's pairs as evidence only.
+    """
+    if pruning_stats is None:
+        pruning_stats = PruningStats()
+    categories_by_term = {}
+    entity_index = None
+    pairs_of_representative = {}
+    for paragraph_index, item, entity_keys, representative in paragraph_entities:
+        for term, category in entity_keys:
+            categories = categories_by_term.setdefault(term, [])
+            if category not in categories:
+                categories.append(category)
+                entity_index = None
+        if representative != paragraph_index:
+            for pair in pairs_of_representative.get(representative, []):
+                registry.register(pair, paragraph_index, item["source_pages"], as_context=False,
+                                  document_id=item.get("document_id"), context_id=representative)
+            continue
+
+        # 新しい用語が届いたときだけ、これまでの全ての用語からインデックスを作り直す
+        # Rebuild the index over every term so far only when new terms have arrived
+        if entity_index is None:
+            entity_index = EntityIndex(categories_by_term)
+        mentions_by_term = entity_index.find_mentions(item["paragraph"])
+        entities_in_paragraph = [
+            {"term": term, "category": category, "mentions": mentions_by_term[term]}
+            for term, categories in categories_by_term.items() if term in mentions_by_term
+            for category in categories
+        ]
+        if len(entities_in_paragraph) < 2:
+            continue
+
+        pairs = prune_entity_pairs(item["paragraph"], entities_in_paragraph, stats=pruning_stats)
+        pairs_of_representative[paragraph_index] = pairs
+        new_pairs = [pair for pair in pairs if registry.register(pair, paragraph_index, item["source_pages"], document_id=item.get("document_id"))]
+        registry.mark_queried(new_pairs, [paragraph_index])
+        batch_count = (len(new_pairs) + ENTITY_PAIR_BATCH_SIZE - 1) // ENTITY_PAIR_BATCH_SIZE
+        for batch_index, i in enumerate(range(0, len(new_pairs), ENTITY_PAIR_BATCH_SIZE)):
+            yield {
+                "key": UnitJournal.unit_key(paragraph_index, batch_index),
+                "paragraph_index": paragraph_index,
+                "context_ids": [paragraph_index],
+                "batch_index": batch_index,
+                "batch_count": batch_count,
+                "paragraph": item["paragraph"],
+                "source_pages": item["source_pages"],
+                "source_documents": {item["document_id"]: item["source_pages"]} if item.get("document_id") is not None else {},
+                "pairs": new_pairs[i:i + ENTITY_PAIR_BATCH_SIZE],
+            }
+
+def reconcile_streamed_results(batch_results, registry):
+    """
+    ストリーミング中に暫定のペアで問い合わせた (バッチ, 関係のリスト) を、全てのエンティティから作り直したレジストリに合わせる。
+    レジストリにあるペアは問い合わせ済み（関係があれば回答済み）として記録し、レジストリにないペア（通常の実行では問い合わせないペア）の関係は捨てる。
+    残りのペア（後から到着した用語とのペアなど）は pending_groups から通常どおり問い合わせられる。
+    Reconciles the (batch, list of relations) queried with provisional pairs during streaming with a registry rebuilt from all entities.
+    Pairs in the registry are recorded as queried (and answered if a relation was found); relations of pairs missing from the registry (pairs a normal run would not query) are dropped.
+    The remaining pairs (e.g. pairs with terms that arrived later) are then queried as usual through pending_groups.
+    """
+    known = registry.keys()
+    reconciled = []
+    for batch, relations in batch_results:
+        asked = {registry.pair_key(e1['term'], e2['term']) for e1, e2 in batch["pairs"]}
+        dropped = asked - known
+        batch = dict(batch, pairs=[pair for pair in batch["pairs"] if registry.pair_key(pair[0]['term'], pair[1]['term']) in known])
+        relations = [relation for relation in relations
+                     if registry.pair_key(relation.get('source', ''), relation.get('target', '')) not in dropped]
+        registry.mark_queried(batch["pairs"], batch["context_ids"])
+        mark_answered_pairs(relations, registry)
+        reconciled.append((batch, relations))
+    return reconciled
+
+def attach_evidence(relation, batch, registry):
+    """
+    関係に、バッチで文脈として送った段落でのペアの出現箇所のページ、文書ごとのページ (source_documents)、段落番号と、
+    始点と終点のカテゴリの組 (endpoint_categories) を付与する。文脈として送っていない段落の出現は根拠に含めない。
+    ペアがその文脈で登録されていない場合はバッチの文脈を根拠とし、カテゴリはバッチのペアから探す。
+    Attaches the pages, pages per document (source_documents) and paragraph ids of the pair's occurrences in the paragraphs the batch sent as context,
+    and the (source, target) category pairs (endpoint_categories), to a relation. Occurrences in paragraphs not sent as context are not evidence.
+    Falls back to the batch's context if the pair is not registered in it, looking the categories up in the batch's pairs.
+    """
+    source, target = relation.get('source', ''), relation.get('target', '')
+    evidence = registry.evidence(source, target, batch["context_ids"])
+    if evidence is None:
+        category_pairs = []
+        for e1, e2 in batch["pairs"]:
+            if (e1['term'], e2['term']) in ((source, target), (target, source)):
+                categories = [e1.get('category'), e2.get('category')] if e1['term'] == source else [e2.get('category'), e1.get('category')]
+                if categories not in category_pairs:
+                    category_pairs.append(categories)
+        evidence = {"source_pages": batch["source_pages"], "source_documents": batch.get("source_documents", {}),
+                    "paragraph_ids": batch["context_ids"], "category_pairs": category_pairs}
+    relation['source_pages'] = evidence["source_pages"]
+    relation['source_documents'] = evidence["source_documents"]
+    relation['paragraph_ids'] = evidence["paragraph_ids"]
+    relation['endpoint_categories'] = evidence["category_pairs"]
+    return relation
+
+def extract_relations_for_batch(model, batch, prompt_template, total_batches, retries=3):
+    """1バッチ分のエンティティペアについてLLMで関係を抽出する（失敗時はNone）
+    Extracts relations for one batch of entity pairs with the LLM (None on failure)."""
+    batch_pairs = batch["pairs"]
+    entity_pairs_json = json.dumps([{"source": e1['term'], "target": e2['term']} for e1, e2 in batch_pairs], ensure_ascii=False, indent=2)
+
+    prompt = prompt_template.substitute(
+        context_paragraph=batch["paragraph"],
+        entity_pairs=entity_pairs_json
+    )
+
+    response_text = ""
+    try:
+        paragraph_label = ",".join(str(paragraph_id + 1) for paragraph_id in batch['context_ids'])
+        print(f"  - バッチ (段落 {paragraph_label}, 段落内 {batch['batch_index'] + 1}/{batch['batch_count']}, 全{total_batches}バッチ): {len(batch_pairs)}ペアを処理中... / Processing {len(batch_pairs)} pairs (paragraph {paragraph_label}, batch {batch['batch_index'] + 1}/{batch['batch_count']})...")
+
+        response = llm_generate_with_retry(model, prompt, retries=retries)
+        response_text = response.text.strip()
+
+        json_start = response_text.find('[')
+        json_end = response_text.rfind(']')
+
+        if json_start != -1 and json_end != -1:
+            json_response_str = response_text[json_start:json_end+1]
+            relations = json.loads(json_response_str)
+            print(f"    -> {len(relations)}件の関係を抽出しました。 / Extracted {len(relations)} relations.")
+            return relations
+        else:
+            print(f"    -> 警告: レスポンスから有効なJSON配列が見つかりませんでした。 / Warning: No valid JSON array found in the response.")
+
+    except json.JSONDecodeError:
+        print(f"    -> エラー: LLMのレスポンスのJSONパースに失敗しました。 / Error: Failed to parse JSON from LLM response.")
+        print(f"       LLM Response: {response_text}")
+    except Exception as e:
+        print(f"    -> LLM呼び出し中に致命的なエラーが発生しました: {e} / A fatal error occurred during the LLM call: {e}")
+    return None
+
+def process_relation_batch(batch, model, prompt_template, total_batches, retries=3, dead_letters=None):
+    """
+    1バッチを処理する。失敗したバッチはペアを二分割して再試行し、単独でも失敗したペアは文脈とともにデッドレターに移す。
+    Processes one batch. A failed batch is retried with its pairs bisected; pairs that still fail alone go to the dead letters with their context.
+    """
+    relations, failed_pairs = bisect_process(
+        batch["pairs"],
+        lambda pairs: extract_relations_for_batch(model, dict(batch, pairs=pairs), prompt_template, total_batches, retries=retries)
+    )
+    if dead_letters is not None:
+        dead_letters.add(batch["key"], [
+            {"context_ids": batch["context_ids"], "source_pages": batch["source_pages"], "source_documents": batch.get("source_documents", {}), "pair": list(pair)}
+            for pair in failed_pairs
+        ])
+    return relations if relations is not None else []
+
+def mark_answered_pairs(relations, registry):
+    """
+    関係の見つかったペアをレジストリに記録し、そのペアのキーのリストを返す（チェックポイントに保存し、再開時に復元するため）。
+    Records the pairs with a relation found in the registry and returns their keys (saved in the checkpoint and restored on resume).
+    """
+    answered = []
+    for result in relations:
+        key = registry.pair_key(result.get('source', ''), result.get('target', ''))
+        registry.mark_answered(*key)
+        if list(key) not in answered:
+            answered.append(list(key))
+    return answered
+
+def format_relation_records(batch, relations, registry):
+    """
+    バッチの結果を出力するレコードに変換する。同じ関係は一度だけ出力し、文脈として送った段落での出現箇所を根拠にする。
+    Converts a batch's results into output records. Each relation is written once, with the occurrences in the paragraphs sent as context as evidence.
+    """
+    records = []
+    for result in relations:
+        if not registry.mark_emitted(result.get('source'), result.get('relation'), result.get('target')):
+            continue
+        records.append(attach_evidence(result, batch, registry))
+    return records
+
+def prepare_output_for_resume(journal):
+    """
+    再開時、出力ファイルを最後に記録された完了単位のオフセットまで切り詰め、書き込み途中の行を除去する。
+    出力ファイルがチェックポイントと一致しない場合はチェックポイントを破棄する。
+    On resume, truncates the output file to the offset of the last recorded unit, removing any partially written line.
+    Discards the checkpoint if the output file does not match it.
+    """
+    committed_offset = max((entry.get('offset', 0) for entry in journal.completed.values()), default=0)
+    current_offset = artifact_offset(OUTPUT_FILE)
+    # オフセットの単位は成果物の形式によって異なる（JSONLはバイト数、SQLiteはレコード数）
+    # The unit of an offset depends on the artifact format (bytes for JSONL, records for SQLite)
+    format_changed = any(entry.get('artifact_format', 'json') != get_artifact_format() for entry in journal.completed.values())
+    if current_offset is None or current_offset < committed_offset or format_changed:
+        print(f"警告: {OUTPUT_FILE} がチェックポイントと一致しないため、最初から処理します。 / Warning: {OUTPUT_FILE} does not match the checkpoint. Starting from scratch.")
+        journal.completed.clear()
+        committed_offset = 0
+    if current_offset is not None:
+        truncate_artifact(OUTPUT_FILE, committed_offset)
+    else:
+        ArtifactWriter(OUTPUT_FILE).close()
+
+def main(model_name='gemini-1.5-flash-latest', retries=3, resume=False, replay_failed=False, dedup=True):
     print("--- ステップ: step3b を開始します --- / --- Starting step: step3b ---")
     
-    model = get_gemini_model(model_name)
+    model = get_model(model_name)
 
     try:
-        print(f"DEBUG: Current working directory: {os.getcwd()}")
-        output_dir = os.path.dirname(OUTPUT_FILE)
-        print(f"DEBUG: Trying to use output directory: {output_dir}")
-        print(f"DEBUG: Absolute path of output directory: {os.path.abspath(output_dir)}")
-        print(f"DEBUG: Does output directory exist? {os.path.exists(output_dir)}")
-        if not os.path.exists(output_dir):
-            print(f"DEBUG: Output directory does not exist. Creating it...")
-            try:
-                os.makedirs(output_dir)
-                print(f"DEBUG: Successfully created directory: {output_dir}")
-            except Exception as e:
-                print(f"FATAL: Failed to create directory {output_dir}: {e}")
-                return
-        print(f"DEBUG: Trying to open {OUTPUT_FILE} for writing...")
-        with open(OUTPUT_FILE, "w") as f:
-            pass
-        print(f"DEBUG: Successfully initialized {OUTPUT_FILE}")
+        # 出力ディレクトリは ArtifactWriter が必要に応じて作成する
+        # ArtifactWriter creates the output directory when needed
+        journal = UnitJournal("step3b", resume=resume or replay_failed)
+        dead_letters = DeadLetterQueue("step3b", resume=resume, replay=replay_failed)
+        if resume or replay_failed:
+            prepare_output_for_resume(journal)
+        else:
+            ArtifactWriter(OUTPUT_FILE).close()
+        print(f"出力ファイルを初期化しました: {artifact_path(OUTPUT_FILE)} / Initialized output file: {artifact_path(OUTPUT_FILE)}")
     except Exception as e:
         print(f"エラー: {OUTPUT_FILE} の初期化に失敗しました: {e} / Error: Failed to initialize {OUTPUT_FILE}: {e}")
         return
 
     try:
-        with open(INPUT_CLEANED_TEXT_PATH, "r", encoding="utf-8") as f:
-            cleaned_text = json.load(f)
-        with open(INPUT_ENTITIES_PATH, "r", encoding="utf-8") as f:
-            entities = json.load(f)
+        cleaned_text = load_records(INPUT_CLEANED_TEXT_PATH, columns=["paragraph", "source_pages", "document_id"])
+        entities = load_records(INPUT_ENTITIES_PATH)
     except FileNotFoundError as e:
         print(f"エラー: 入力ファイルが見つかりません: {e.filename} / Error: Input file not found: {e.filename}")
         return
@@ -116,28 +470,55 @@ def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
     if not prompt_template:
         return
 
+    registry = PairRegistry()
+    if resume or replay_failed:
+        # 再開時は出力済みの関係を登録し、重複して書き込まないようにする
+        # On resume, register already written relations so they are not written twice
+        for rel in iter_records(OUTPUT_FILE, columns=["source", "relation", "target"]):
+            registry.mark_emitted(rel.get('source'), rel.get('relation'), rel.get('target'))
+
+    print("段落ごとのエンティティペアをバッチに分割中... / Planning entity pair batches per paragraph...")
+    # 近似重複する段落は代表段落だけを処理し、根拠を重複する段落に展開する
+    # Process only the representative of near-duplicate paragraphs and fan evidence out to its duplicates
+    if dedup:
+        clusters = find_near_duplicates([item["paragraph"] for item in cleaned_text])
+    else:
+        clusters = DuplicateClusters.singletons(len(cleaned_text))
+    clusters.report("step3b")
+    batches = plan_relation_batches(cleaned_text, entities, registry=registry, clusters=clusters)
+    print(f"{len(cleaned_text)}段落から{len(batches)}バッチを作成しました。 / Planned {len(batches)} batches from {len(cleaned_text)} paragraphs.")
+    batches.extend(collect_replay_units(journal, dead_letters, lambda items: plan_replay_batches(cleaned_text, items)))
+
+    # バッチは並行して処理されるが、結果は計画順（段落順）に書き込む。
+    # 各バッチの結果は1回の書き込みで追記・確定され、書き込み後のオフセットと関係の見つかったペアがチェックポイントに記録される。
+    # 関係の見つからなかったペアは、前のラウンドが終わってから次の出現段落で問い合わせ直す。
+    # Batches run concurrently, but results are written in planned (paragraph) order.
+    # Each batch's results are appended and committed in a single write; the offset after it and the pairs with a relation found are recorded in the checkpoint.
+    # Pairs with no relation found are queried again with their next occurrence once the previous round is done.
     total_relations_found = 0
-    total_batch_counter = 0
-    for i, item in enumerate(cleaned_text):
-        if MAX_TOTAL_BATCHES is not None and total_batch_counter >= MAX_TOTAL_BATCHES:
-            break
-        paragraph = item["paragraph"]
-        source_pages = item["source_pages"]
-        
-        print(f"\n段落 {i+1}/{len(cleaned_text)} を処理中 (出典ページ: {source_pages})... / Processing paragraph {i+1}/{len(cleaned_text)} (source pages: {source_pages})...")
-        
-        entities_in_paragraph = [entity for entity in entities if entity['term'] in paragraph]
-
-        relations_generator = extract_relations_in_batches(model, paragraph, entities_in_paragraph, prompt_template, total_batch_counter, wait=wait, retries=retries)
-        
-        with open(OUTPUT_FILE, "a", encoding="utf-8") as f:
-            for result in relations_generator:
-                if isinstance(result, int):
-                    total_batch_counter = result
-                else:
-                    result['source_pages'] = source_pages
-                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
-                    total_relations_found += 1
+    round_index = 0
+    with ArtifactWriter(OUTPUT_FILE, append=True) as writer:
+        while batches:
+            def process(batch, total_batches=len(batches)):
+                return process_relation_batch(batch, model, prompt_template, total_batches, retries=retries, dead_letters=dead_letters)
+
+            for batch, relations, from_checkpoint in iter_resumable(journal, batches, process, record=False):
+                if from_checkpoint:
+                    # 再開時は、チェックポイントに記録された関係の見つかったペアを復元する
+                    # On resume, restore the pairs with a relation found from the checkpoint
+                    for key in journal.get(batch["key"], batch["fingerprint"]).get('answered', []):
+                        registry.mark_answered(*key)
+                    continue
+                answered = mark_answered_pairs(relations, registry)
+                records = format_relation_records(batch, relations, registry)
+                offset = writer.write(records)
+                journal.record(batch["key"], batch["fingerprint"], offset=offset, artifact_format=get_artifact_format(), answered=answered)
+                total_relations_found += len(records)
+            round_index += 1
+            batches = plan_requery_batches(cleaned_text, registry, round_index)
+    journal.close()
+    dead_letters.report()
+    dead_letters.close()
 
     print(f"\n処理が完了しました。合計 {total_relations_found} 件の関係を {OUTPUT_FILE} に保存しました。 / Process completed. A total of {total_relations_found} relations have been saved to {OUTPUT_FILE}.")
     print("--- ステップ: step3b が完了しました --- / --- Step: step3b completed ---")
@@ -1,9 +1,11 @@
 import json
-import os
-import time
-from collections import Counter, defaultdict
 from tqdm import tqdm
-from .llm_utils import get_gemini_model, llm_generate_with_retry
+from .llm_utils import get_model, llm_generate_with_retry
+from .checkpoint_utils import UnitJournal, compute_fingerprint, iter_resumable
+from .failure_utils import DeadLetterQueue, bisect_process, collect_replay_units
+from .normalization_store import CanonicalNameIndex, NormalizationStore
+from .term_blocking import block_terms, merge_exact_variants, pack_term_batches, print_blocking_stats
+from .artifact_store import artifact_exists, iter_records, load_records, write_records
 
 # --- 定数 --- #
 INPUT_ENTITIES_PATH = "output/step2b_entities.json"
@@ -11,145 +13,210 @@ INPUT_RELATIONS_PATH = "output/step3b_relations.jsonl"
 OUTPUT_NORMALIZED_ENTITIES_PATH = "output/step4_normalized_entities.json"
 OUTPUT_NORMALIZED_RELATIONS_PATH = "output/step4_normalized_relations.jsonl"
 NORMALIZATION_MAP_PATH = "output/step4_normalization_map.json"
+NORMALIZATION_STORE_PATH = "output/step4_normalization_store.json"
 PROMPT_TEMPLATE_PATH = "entity_normalization_prompt.md"
 LLM_REQUEST_BATCH_SIZE = 100  # 一度にLLMに送るエンティティの数
 
-def load_json(path):
-    """JSONファイルを読み込む
-    Loads a JSON file."""
-    with open(path, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
 def save_json(data, path):
     """JSONファイルに保存する
     Saves data to a JSON file."""
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
-def load_jsonl(path):
-    """JSON Linesファイルを読み込む
-    Loads a JSON Lines file."""
-    data = []
-    with open(path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data.append(json.loads(line))
-    return data
-
-def save_jsonl(data, path):
-    """JSON Linesファイルに保存する
-    Saves data to a JSON Lines file."""
-    with open(path, 'w', encoding='utf-8') as f:
-        for item in data:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+def normalization_fingerprint(model_name):
+    """正規化ストアの投票の条件（プロンプトとモデル名）のフィンガープリント / Fingerprint of the conditions of the normalization store's votes (prompt and model name)"""
+    with open(PROMPT_TEMPLATE_PATH, 'r', encoding='utf-8') as f:
+        return compute_fingerprint([f.read(), model_name])
+
+def request_normalization_batch(batch_number, batch, prompt_template, model, retries=3, canonical_names=()):
+    """1バッチ分の用語についてLLMから正規化マッピングを取得する（失敗時はNone）
+    canonical_names には、用語に近い既存の正規化名を文脈として渡す。
+    Gets the normalization mapping for one batch of terms from the LLM (None on failure).
+    canonical_names passes the existing canonical names nearest to the terms as context."""
+    entities_json_str = json.dumps(batch, ensure_ascii=False, indent=2)
+    canonical_json_str = json.dumps(list(canonical_names), ensure_ascii=False, indent=2)
+    prompt = prompt_template.format(entities_json=entities_json_str, canonical_json=canonical_json_str)
+
+    try:
+        response = llm_generate_with_retry(model, prompt, retries=retries)
+        response_text = response.text.strip()
+        json_start = response_text.find('```json') + len('```json\n')
+        json_end = response_text.rfind('```')
+        if json_start != -1 and json_end != -1:
+            json_content = response_text[json_start:json_end].strip()
+            data = json.loads(json_content)
+            return data.get("normalization_map", {})
+        else:
+            print(f"警告: バッチ {batch_number} の応答からJSONを抽出できませんでした。 / Warning: Could not extract JSON from the response of batch {batch_number}.")
+
+    except Exception as e:
+        print(f"エラー: LLM呼び出し中に致命的なエラーが発生しました: {e} / Error: A fatal error occurred during the LLM call: {e}")
+    return None
 
-def get_normalization_map_from_llm(entities, model, wait=60, retries=3):
+def get_normalization_map_from_llm(entities, model, retries=3, journal=None, dead_letters=None, store=None):
     """LLMを使用して正規化マッピングを取得し、多数決で最終版を生成する
-    Gets a normalization map using an LLM and generates the final version by majority vote."""
+    未知の用語を含む候補クラスタだけを、それに近い既存の正規化名とともに送ります。store（NormalizationStore）に記録済みの用語は、そのようなクラスタの一員としてだけ送られます。
+    LLMの提案は store に投票として加算され、過去の実行の投票と合わせた多数決で正規化名が決まります。
+    journalを指定すると、完了したバッチが記録され、再開時にはスキップされます。
+    失敗したバッチは二分割して再試行され、単独でも失敗した用語は dead_letters に保存されます。
+    Gets a normalization map using an LLM and generates the final version by majority vote.
+    Only candidate clusters containing unseen terms are sent, together with the nearest existing canonical names; terms already recorded in the store (NormalizationStore) are sent only as members of such clusters.
+    The LLM's suggestions are added to the store as votes, and canonical names are decided by majority vote together with votes from earlier runs.
+    If a journal is given, completed batches are recorded and skipped on resume.
+    Failed batches are bisected and retried; terms that still fail on their own are saved to dead_letters."""
     print("LLMを呼び出してエンティティの正規化マッピングを生成します... / Calling LLM to generate entity normalization mapping...")
     with open(PROMPT_TEMPLATE_PATH, 'r', encoding='utf-8') as f:
         prompt_template = f.read()
 
-    all_suggestions = defaultdict(list)
-    entity_terms = [entity['term'] for entity in entities]
-
-    for i in tqdm(range(0, len(entity_terms), LLM_REQUEST_BATCH_SIZE), desc="正規化マッピング生成 / Generating normalization mapping"):
-        batch = entity_terms[i:i + LLM_REQUEST_BATCH_SIZE]
-        entities_json_str = json.dumps(batch, ensure_ascii=False, indent=2)
-        prompt = prompt_template.format(entities_json=entities_json_str)
-
-        try:
-            response = llm_generate_with_retry(model, prompt, retries=retries)
-            response_text = response.text.strip()
-            json_start = response_text.find('```json') + len('```json\n')
-            json_end = response_text.rfind('```')
-            if json_start != -1 and json_end != -1:
-                json_content = response_text[json_start:json_end].strip()
-                data = json.loads(json_content)
-                batch_map = data.get("normalization_map", {})
-                for alias, normalized_name in batch_map.items():
-                    all_suggestions[alias].append(normalized_name)
-            else:
-                print(f"警告: バッチ {i//LLM_REQUEST_BATCH_SIZE + 1} の応答からJSONを抽出できませんでした。 / Warning: Could not extract JSON from the response of batch {i//LLM_REQUEST_BATCH_SIZE + 1}.")
-
-        except Exception as e:
-            print(f"エラー: LLM呼び出し中に致命的なエラーが発生しました: {e} / Error: A fatal error occurred during the LLM call: {e}")
-
-        if i + LLM_REQUEST_BATCH_SIZE < len(entity_terms):
-            time.sleep(wait)
-
-    final_normalization_map = {}
-    print("\n正規化マッピングを統合しています... / Consolidating normalization mapping...")
-    for alias, suggestions in tqdm(all_suggestions.items(), desc="マッピング統合 / Consolidating mapping"):
-        if not suggestions:
+    if store is None:
+        store = NormalizationStore(path=None)
+    entity_terms = list(dict.fromkeys(entity['term'] for entity in entities))
+    # 全角・半角、空白、長音だけが異なる用語はLLMを使わずにまとめ、代表の用語（既知の用語を優先）だけを扱う
+    # Terms differing only in width, whitespace or long vowels are merged without the LLM; only representatives (known terms first) are handled
+    representatives, variant_map = merge_exact_variants(entity_terms, known=store.votes)
+    # デッドレターから再処理する用語は再処理の単位で送る
+    # Terms replayed from the dead letters are sent in the replay units
+    replay_terms = set(dead_letters.replay_items) if dead_letters is not None else set()
+    candidate_terms = [term for term in representatives if term not in replay_terms]
+    new_terms = {term for term in candidate_terms if term not in store}
+    canonical_index = CanonicalNameIndex(store.canonical_names())
+
+    # 文字n-gram TF-IDFで近い用語を候補クラスタにまとめ、新しい用語を含むクラスタだけをLLMに送る。
+    # 同じクラスタの既知の用語も一緒に送って投票を重ね、多数決が実行ごとに改善されるようにする。クラスタは分割せずにバッチへ詰める
+    # Group similar terms into candidate clusters by character n-gram TF-IDF and send only the clusters containing new terms.
+    # Known terms in those clusters are sent along and get further votes, so the majority vote improves run by run. Whole clusters are packed into batches
+    clusters = [cluster for cluster in block_terms(candidate_terms) if any(candidate_terms[index] in new_terms for index in cluster)]
+    revoted_terms = sum(1 for cluster in clusters for index in cluster if candidate_terms[index] not in new_terms)
+    print(f"正規化ストア: 既知の用語 {len(representatives) - len(new_terms)}件, 新しい用語 {len(new_terms)}件と、同じクラスタの既知の用語 {revoted_terms}件をLLMに送ります / Normalization store: {len(representatives) - len(new_terms)} known terms, sending {len(new_terms)} new terms and {revoted_terms} known terms in the same clusters to the LLM")
+    term_batches = pack_term_batches(candidate_terms, clusters, LLM_REQUEST_BATCH_SIZE)
+    print_blocking_stats(len(new_terms) + revoted_terms, len(variant_map), clusters, len(term_batches))
+
+    batches = []
+    for batch_number, batch_terms in enumerate(term_batches, start=1):
+        canonical_names = canonical_index.context_for(batch_terms)
+        batches.append({
+            "key": UnitJournal.unit_key(batch_number),
+            "fingerprint": compute_fingerprint([prompt_template, batch_terms, canonical_names]),
+            "batch_number": batch_number,
+            "items": batch_terms,
+            "canonical_names": canonical_names,
+        })
+
+    def chunk_replay_terms(terms):
+        return [
+            {"batch_number": f"replay-{i // LLM_REQUEST_BATCH_SIZE + 1}", "items": terms[i:i + LLM_REQUEST_BATCH_SIZE],
+             "canonical_names": canonical_index.context_for(terms[i:i + LLM_REQUEST_BATCH_SIZE])}
+            for i in range(0, len(terms), LLM_REQUEST_BATCH_SIZE)
+        ]
+
+    batches.extend(collect_replay_units(journal, dead_letters, chunk_replay_terms))
+
+    def process(batch):
+        batch_map, failed_terms = bisect_process(
+            batch["items"],
+            lambda terms: request_normalization_batch(batch["batch_number"], terms, prompt_template, model, retries=retries,
+                                                      canonical_names=batch.get("canonical_names", ()))
+        )
+        # 成功した用語（失敗した用語以外）をマップと一緒に返し、マップにない用語を自身への投票として数える
+        # Return the terms that succeeded (all but the failed ones) with the map, so terms missing from the map count as votes for themselves
+        failed = set(failed_terms)
+        succeeded_terms = [term for term in batch["items"] if term not in failed]
+        if dead_letters is None:
+            return None if batch_map is None else {"map": batch_map, "terms": succeeded_terms}
+        # 失敗した用語はデッドレターに移し、バッチ自体は完了として記録する
+        # Move failed terms to the dead letters and record the batch itself as completed
+        dead_letters.add(batch["key"], failed_terms)
+        return {"map": batch_map or {}, "terms": succeeded_terms}
+
+    # バッチは並行して処理されるが、投票は入力順に集計する
+    # Batches run concurrently, but votes are collected in input order
+    for _, result, _ in tqdm(iter_resumable(journal, batches, process), total=len(batches), desc="正規化マッピング生成 / Generating normalization mapping"):
+        if not result:
             continue
-        counts = Counter(suggestions)
-        most_common_name = counts.most_common(1)[0][0]
-        final_normalization_map[alias] = most_common_name
+        store.add_votes(result["terms"], result["map"])
 
-    return final_normalization_map
+    print("\n正規化マッピングを統合しています... / Consolidating normalization mapping...")
+    normalization_map = store.normalization_map(representatives)
+    for term, representative in variant_map.items():
+        normalization_map[term] = normalization_map.get(representative, representative)
+    return normalization_map
 
 def normalize_entities(entities, normalization_map):
     """エンティティリストを正規化する
-    Normalizes the entity list."""
-    normalized_entities = []
-    seen_terms = set()
+    正規化後の (用語, カテゴリ) をキーとする辞書で同じエンティティを集約するため、エンティティ数に比例する時間で処理できます。
+    同じ名前でもカテゴリが異なるエンティティ（例: DiseaseとSymptom）は別々に残ります。
+    出典ページは集合に集め、最後に一度だけソートします。出力は各エンティティが最初に現れた順に並びます。
+    Normalizes the entity list.
+    Identical entities are aggregated in a dict keyed by the normalized (term, category), so processing time is linear in the number of entities.
+    Entities with the same name but different categories (e.g. Disease and Symptom) stay separate.
+    Source pages are collected in sets and sorted once at the end. The output keeps the order in which each entity first appears."""
+    normalized_by_key = {}
+    pages_by_key = {}
     for entity in entities:
         original_term = entity['term']
         normalized_term = normalization_map.get(original_term, original_term)
+        key = (normalized_term, entity.get('category'))
 
-        if normalized_term not in seen_terms:
+        pages = pages_by_key.get(key)
+        if pages is None:
             new_entity = entity.copy()
             new_entity['term'] = normalized_term
-            normalized_entities.append(new_entity)
-            seen_terms.add(normalized_term)
-        else:
-            for ne in normalized_entities:
-                if ne['term'] == normalized_term:
-                    ne['source_pages'] = sorted(list(set(ne['source_pages'] + entity['source_pages'])))
-                    break
+            normalized_by_key[key] = new_entity
+            pages = pages_by_key[key] = set()
+        pages.update(entity.get('source_pages', []))
 
+    normalized_entities = list(normalized_by_key.values())
+    for key, entity in normalized_by_key.items():
+        entity['source_pages'] = sorted(pages_by_key[key])
     return normalized_entities
 
 def normalize_relations(relations, normalization_map):
-    """リレーションリストを正規化する
-    Normalizes the relation list."""
-    normalized_relations = []
+    """リレーションを1件ずつ正規化してyieldする（自己ループになったリレーションは除く）
+    成果物をチャンクごとに読み書きするストリーミング処理で使うため、リレーション全体をメモリに載せません。
+    Normalizes relations one at a time and yields them (relations that became self-loops are dropped).
+    Used in a streaming pass that reads and writes the artifacts chunk by chunk, so the relations are never all held in memory."""
     for rel in relations:
         new_rel = rel.copy()
         new_rel['source'] = normalization_map.get(rel['source'], rel['source'])
         new_rel['target'] = normalization_map.get(rel['target'], rel['target'])
         if new_rel['source'] != new_rel['target']:
-            normalized_relations.append(new_rel)
-    return normalized_relations
+            yield new_rel
 
-def main(model_name='gemini-1.5-flash-latest', wait=60, retries=3):
+def main(model_name='gemini-1.5-flash-latest', retries=3, resume=False, replay_failed=False):
     """
     エンティティとリレーションを正規化するメイン関数
     Main function to normalize entities and relations
     """
     print("--- ステップ4: ナレッジの正規化を開始します --- / --- Step 4: Starting knowledge normalization ---")
 
-    if not os.path.exists(INPUT_ENTITIES_PATH):
+    if not artifact_exists(INPUT_ENTITIES_PATH):
         print(f"エラー: {INPUT_ENTITIES_PATH} が見つかりません。 / Error: {INPUT_ENTITIES_PATH} not found.")
         return
-    if not os.path.exists(INPUT_RELATIONS_PATH):
+    if not artifact_exists(INPUT_RELATIONS_PATH):
         print(f"エラー: {INPUT_RELATIONS_PATH} が見つかりません。 / Error: {INPUT_RELATIONS_PATH} not found.")
         return
 
-    entities = load_json(INPUT_ENTITIES_PATH)
-    relations = load_jsonl(INPUT_RELATIONS_PATH)
+    entities = load_records(INPUT_ENTITIES_PATH)
 
-    model = get_gemini_model(model_name)
+    model = get_model(model_name)
 
-    normalization_map = get_normalization_map_from_llm(entities, model, wait=wait, retries=retries)
+    journal = UnitJournal("step4", resume=resume or replay_failed)
+    dead_letters = DeadLetterQueue("step4", resume=resume, replay=replay_failed)
+    store = NormalizationStore(NORMALIZATION_STORE_PATH, fingerprint=normalization_fingerprint(model_name))
+    normalization_map = get_normalization_map_from_llm(entities, model, retries=retries, journal=journal, dead_letters=dead_letters, store=store)
+    journal.close()
+    dead_letters.report()
+    dead_letters.close()
+    store.save()
+    print(f"正規化ストア（{len(store)}語）を {NORMALIZATION_STORE_PATH} に保存しました。 / Saved the normalization store ({len(store)} terms) to {NORMALIZATION_STORE_PATH}.")
     save_json(normalization_map, NORMALIZATION_MAP_PATH)
     print(f"正規化マッピングを {NORMALIZATION_MAP_PATH} に保存しました。 / Saved normalization map to {NORMALIZATION_MAP_PATH}.")
 
     normalized_entities = normalize_entities(entities, normalization_map)
-    normalized_relations = normalize_relations(relations, normalization_map)
-
-    save_json(normalized_entities, OUTPUT_NORMALIZED_ENTITIES_PATH)
-    save_jsonl(normalized_relations, OUTPUT_NORMALIZED_RELATIONS_PATH)
+    write_records(OUTPUT_NORMALIZED_ENTITIES_PATH, normalized_entities)
+    # リレーションは入力の成果物からチャンクごとに読み、正規化して書き出す
+    # Relations are read from the input artifact chunk by chunk, normalized and written out
+    write_records(OUTPUT_NORMALIZED_RELATIONS_PATH, normalize_relations(iter_records(INPUT_RELATIONS_PATH), normalization_map))
 
     print(f"正規化されたエンティティを {OUTPUT_NORMALIZED_ENTITIES_PATH} に保存しました。 / Saved normalized entities to {OUTPUT_NORMALIZED_ENTITIES_PATH}.")
     print(f"正規化されたリレーションを {OUTPUT_NORMALIZED_RELATIONS_PATH} に保存しました。 / Saved normalized relations to {OUTPUT_NORMALIZED_RELATIONS_PATH}.")
@@ -1,7 +1,9 @@
 import os
+import csv
 import json
-import pandas as pd
+import hashlib
 from collections import defaultdict
+from .artifact_store import artifact_exists, iter_records
 
 
 # --- 定数 --- #
@@ -14,7 +16,14 @@ OUTPUT_EDGES_PATH = "output/step5_edges.csv"
 OUTPUT_NORMALIZATION_NODES_PATH = "output/step5_normalization_nodes.csv"
 OUTPUT_NORMALIZATION_EDGES_PATH = "output/step5_normalization_edges.csv"
 
-PDF_FILENAME = "c00543.pdf"
+DEFAULT_DOCUMENT_ID = "c00543"  # 文書ごとのページを持たない古い成果物の関係に使う文書ID / Document ID used for relations in older artifacts without pages per document
+NODE_ID_HASH_LENGTH = 16  # ノードIDに使うハッシュの16進桁数（64ビット） / Number of hex digits of the hash used in node IDs (64 bits)
+PAGE_LIST_SEPARATOR = ";"  # SourcePages 列のページ番号の区切り（neo4j-admin の配列の既定の区切りと同じで、step6 では int[] として読み込む） / Separator of page numbers in the SourcePages column (neo4j-admin's default array delimiter; step6 loads the column as int[])
+
+NODE_FIELDS = ["NodeID", "Label", "Category"]
+EDGE_FIELDS = ["SourceID", "TargetID", "Relation", "DataSource", "SourcePages", "EvidenceCount"]
+NORMALIZATION_NODE_FIELDS = ["NodeID", "Label"]
+NORMALIZATION_EDGE_FIELDS = ["SourceID", "TargetID", "Relation"]
 
 CATEGORY_PREFIX_MAP = {
     "Disease": "DISEASE",
@@ -36,16 +45,114 @@ RELATION_MAP = {
     "is_diagnosed_by": "biolink:diagnosed_by",
 }
 
+def stable_node_id(prefix, *parts):
+    """
+    内容（正規化された用語とカテゴリなど）から決まるノードIDを返す。実行の順序に依存しないため、再実行しても同じノードは同じIDになる。
+    Returns a node ID derived from its content (normalized term, category, etc.). It does not depend on enumeration order, so the same node keeps its ID across runs.
+    """
+    digest = hashlib.sha1("\x1f".join(parts).encode('utf-8')).hexdigest()
+    return f"{prefix}_{digest[:NODE_ID_HASH_LENGTH]}"
+
 def load_json(path):
     with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def load_jsonl(path):
-    data = []
-    with open(path, 'r', encoding='utf-8') as f:
-        for line in f:
-            data.append(json.loads(line))
-    return data
+def write_csv(path, fieldnames, rows):
+    """
+    辞書の行を1行ずつCSVに書き出し（Excelで開けるようにBOM付きUTF-8）、原子的に置き換える。書き出した行数を返す。
+    Writes dict rows to a CSV one at a time (UTF-8 with BOM so that Excel opens it) and atomically replaces the file. Returns the number of rows written.
+    """
+    written = 0
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            written += 1
+    os.replace(temporary_path, path)
+    return written
+
+def resolve_endpoints(rel, entity_to_node_id, categories_by_term):
+    """
+    関係の (始点のノードID, 終点のノードID) のリストを返す。ノードは (用語, カテゴリ) ごとにあるため、step3b が記録した
+    (始点のカテゴリ, 終点のカテゴリ) の組 (endpoint_categories) ごとにノードを引く。組の記録がない古い成果物では、
+    用語のカテゴリが1つに決まる場合だけそれを使う。ノードを決められない場合は空のリストを返す。
+    Returns the list of (source node ID, target node ID) of a relation. Nodes exist per (term, category), so they are looked up
+    for each (source category, target category) pair recorded by step3b (endpoint_categories). Older artifacts without the pairs
+    use a term's category only when it has exactly one. Returns an empty list when the nodes cannot be determined.
+    """
+    source_term = rel['source']
+    target_term = rel['target']
+    category_pairs = rel.get('endpoint_categories')
+    if not category_pairs:
+        source_categories = categories_by_term.get(source_term, [])
+        target_categories = categories_by_term.get(target_term, [])
+        if len(source_categories) != 1 or len(target_categories) != 1:
+            return []
+        category_pairs = [(source_categories[0], target_categories[0])]
+
+    endpoints = []
+    for source_category, target_category in category_pairs:
+        source_id = entity_to_node_id.get((source_term, source_category))
+        target_id = entity_to_node_id.get((target_term, target_category))
+        if source_id and target_id and (source_id, target_id) not in endpoints:
+            endpoints.append((source_id, target_id))
+    return endpoints
+
+def aggregate_edges(relations, entity_to_node_id, categories_by_term):
+    """
+    関係を1件ずつ読み、同じ (始点, リレーション, 終点, 文書) のエッジを1つにまとめる。始点と終点は resolve_endpoints でノードに解決する。
+    ページ番号は文書ごとに数えられるため、関係の source_documents（文書ID → ページ）の文書ごとに別のエッジにし、異なる文書のページを混ぜない。
+    エッジごとに出現ページの和集合と、まとめた関係の件数（根拠の数）を持つため、メモリは関係の件数ではなく異なるエッジの数に比例する。
+    (まとめたエッジ, ノードを決められずに除いた関係の件数) を返す。
+    Reads relations one at a time and merges edges with the same (source, relation, target, document) into one. Endpoints are resolved to nodes with resolve_endpoints.
+    Page numbers count within a document, so each document in a relation's source_documents (document ID -> pages) gets its own edge and pages of different documents never mix.
+    Each edge keeps the union of its pages and the number of merged relations (its evidence count), so memory grows with the number of distinct edges, not relations.
+    Returns (merged edges, number of relations dropped because their nodes could not be determined).
+    """
+    edges = {}  # (始点ID, リレーション, 終点ID, 文書ID) → {"pages": ページの集合, "count": 件数} / (source ID, relation, target ID, document ID) -> {"pages": set of pages, "count": count}
+    unresolved = 0
+    for rel in relations:
+        source_term = rel.get('source')
+        target_term = rel.get('target')
+        original_relation = rel.get('relation')
+
+        if not all([source_term, target_term, original_relation]):
+            continue
+        endpoints = resolve_endpoints(rel, entity_to_node_id, categories_by_term)
+        if not endpoints:
+            unresolved += 1
+            continue
+
+        # 標準的なリレーション名に変換
+        # Convert to standard relation name
+        standard_relation = RELATION_MAP.get(original_relation, original_relation)
+
+        source_documents = rel.get('source_documents') or {DEFAULT_DOCUMENT_ID: rel.get('source_pages') or []}
+        for source_id, target_id in endpoints:
+            for document_id, pages in source_documents.items():
+                key = (source_id, standard_relation, target_id, document_id)
+                edge = edges.get(key)
+                if edge is None:
+                    edge = edges[key] = {"pages": set(), "count": 0}
+                edge["pages"].update(pages)
+                edge["count"] += 1
+    return edges, unresolved
+
+def iter_edge_rows(edges):
+    """まとめたエッジをCSVの行として返す。DataSource は「文書ID_p最初のページ」 / Yields the merged edges as CSV rows; DataSource is <document ID>_p<first page>"""
+    for (source_id, relation, target_id, document_id), edge in edges.items():
+        pages = sorted(edge["pages"])
+        source_page = f"_p{pages[0]}" if pages else ""
+        yield {
+            "SourceID": source_id,
+            "TargetID": target_id,
+            "Relation": relation,
+            "DataSource": f"{document_id}{source_page}",
+            "SourcePages": PAGE_LIST_SEPARATOR.join(str(page) for page in pages),
+            "EvidenceCount": edge["count"],
+        }
 
 def export_normalization_graph():
     print("--- 正規化マップのグラフエクスポートを開始します --- / --- Starting export of normalization map graph ---")
@@ -54,91 +161,68 @@ def export_normalization_graph():
         return
 
     normalization_map = load_json(INPUT_NORMALIZATION_MAP_PATH)
-    node_list, edge_list = [], []
     term_to_node_id = {}
-    node_counter = 0
 
-    all_terms = set(normalization_map.keys()) | set(normalization_map.values())
-    for term in all_terms:
-        if term not in term_to_node_id:
-            node_id = f"TERM_{node_counter:04d}"
+    def node_rows():
+        all_terms = sorted(set(normalization_map.keys()) | set(normalization_map.values()))
+        for term in all_terms:
+            node_id = stable_node_id("TERM", term)
             term_to_node_id[term] = node_id
-            node_list.append({"NodeID": node_id, "Label": term})
-            node_counter += 1
-
-    for alias, normalized_name in normalization_map.items():
-        if alias != normalized_name:
-            source_id = term_to_node_id[alias]
-            target_id = term_to_node_id[normalized_name]
-            edge_list.append({
-                "SourceID": source_id,
-                "TargetID": target_id,
-                "Relation": "skos:exactMatch"  # is_normalized_to から変更 / Changed from is_normalized_to
-            })
-
-    pd.DataFrame(node_list).to_csv(OUTPUT_NORMALIZATION_NODES_PATH, index=False, encoding='utf-8-sig')
-    print(f"正規化ノードリストを {OUTPUT_NORMALIZATION_NODES_PATH} に保存しました。 ({len(node_list)}件) / Saved normalization node list to {OUTPUT_NORMALIZATION_NODES_PATH}. ({len(node_list)} items)")
-
-    pd.DataFrame(edge_list).to_csv(OUTPUT_NORMALIZATION_EDGES_PATH, index=False, encoding='utf-8-sig')
-    print(f"正規化エッジリストを {OUTPUT_NORMALIZATION_EDGES_PATH} に保存しました。 ({len(edge_list)}件) / Saved normalization edge list to {OUTPUT_NORMALIZATION_EDGES_PATH}. ({len(edge_list)} items)")
+            yield {"NodeID": node_id, "Label": term}
+
+    def edge_rows():
+        for alias, normalized_name in normalization_map.items():
+            if alias != normalized_name:
+                yield {
+                    "SourceID": term_to_node_id[alias],
+                    "TargetID": term_to_node_id[normalized_name],
+                    "Relation": "skos:exactMatch"  # is_normalized_to から変更 / Changed from is_normalized_to
+                }
+
+    node_count = write_csv(OUTPUT_NORMALIZATION_NODES_PATH, NORMALIZATION_NODE_FIELDS, node_rows())
+    print(f"正規化ノードリストを {OUTPUT_NORMALIZATION_NODES_PATH} に保存しました。 ({node_count}件) / Saved normalization node list to {OUTPUT_NORMALIZATION_NODES_PATH}. ({node_count} items)")
+
+    edge_count = write_csv(OUTPUT_NORMALIZATION_EDGES_PATH, NORMALIZATION_EDGE_FIELDS, edge_rows())
+    print(f"正規化エッジリストを {OUTPUT_NORMALIZATION_EDGES_PATH} に保存しました。 ({edge_count}件) / Saved normalization edge list to {OUTPUT_NORMALIZATION_EDGES_PATH}. ({edge_count} items)")
     print("--- 正規化マップのグラフエクスポートが完了しました --- / --- Export of normalization map graph completed ---")
 
 def main():
     print("--- ステップ5: CSVへのエクスポートを開始します --- / --- Step 5: Starting export to CSV ---")
 
-    if not os.path.exists(INPUT_NORMALIZED_ENTITIES_PATH) or not os.path.exists(INPUT_NORMALIZED_RELATIONS_PATH):
+    if not artifact_exists(INPUT_NORMALIZED_ENTITIES_PATH) or not artifact_exists(INPUT_NORMALIZED_RELATIONS_PATH):
         print(f"エラー: 入力ファイルが見つかりません。 / Error: Input file not found.")
         return
 
-    entities = load_json(INPUT_NORMALIZED_ENTITIES_PATH)
-    relations = load_jsonl(INPUT_NORMALIZED_RELATIONS_PATH)
+    # 根拠などの大きなフィールドは読まない / Large fields such as the evidence are not read
+    entities = iter_records(INPUT_NORMALIZED_ENTITIES_PATH, columns=['term', 'category'])
+    relations = iter_records(INPUT_NORMALIZED_RELATIONS_PATH, columns=['source', 'target', 'relation', 'source_pages', 'source_documents', 'endpoint_categories'])
 
-    node_list = []
+    # 同じ用語が複数のカテゴリのノードになるため、(用語, カテゴリ) をキーにする
+    # The same term can become nodes of several categories, so (term, category) is the key
     entity_to_node_id = {}
-    category_counters = defaultdict(int)
-
-    for entity in entities:
-        term = entity['term']
-        category = entity['category']
-        prefix = CATEGORY_PREFIX_MAP.get(category, "UNKNOWN")
-        category_counters[prefix] += 1
-        node_id = f"{prefix}_{category_counters[prefix]:03d}"
-        node_list.append({"NodeID": node_id, "Label": term, "Category": category})
-        entity_to_node_id[term] = node_id
-
-    nodes_df = pd.DataFrame(node_list)
-    nodes_df.to_csv(OUTPUT_NODES_PATH, index=False, encoding='utf-8-sig')
-    print(f"ノードリストを {OUTPUT_NODES_PATH} に保存しました。 ({len(nodes_df)}件) / Saved node list to {OUTPUT_NODES_PATH}. ({len(nodes_df)} items)")
-
-    edge_list = []
-    for rel in relations:
-        source_term = rel.get('source')
-        target_term = rel.get('target')
-        original_relation = rel.get('relation')
-
-        if not all([source_term, target_term, original_relation]) or source_term not in entity_to_node_id or target_term not in entity_to_node_id:
-            continue
-
-        source_id = entity_to_node_id[source_term]
-        target_id = entity_to_node_id[target_term]
-        
-        # 標準的なリレーション名に変換
-        # Convert to standard relation name
-        standard_relation = RELATION_MAP.get(original_relation, original_relation)
-
-        source_page = f"_p{min(rel['source_pages'])}" if rel.get('source_pages') else ""
-        datasource = f"{PDF_FILENAME}{source_page}"
-
-        edge_list.append({
-            "SourceID": source_id,
-            "TargetID": target_id,
-            "Relation": standard_relation,
-            "DataSource": datasource
-        })
-
-    edges_df = pd.DataFrame(edge_list).drop_duplicates()
-    edges_df.to_csv(OUTPUT_EDGES_PATH, index=False, encoding='utf-8-sig')
-    print(f"エッジリストを {OUTPUT_EDGES_PATH} に保存しました。 ({len(edges_df)}件) / Saved edge list to {OUTPUT_EDGES_PATH}. ({len(edges_df)} items)")
+    categories_by_term = defaultdict(list)
+
+    def node_rows():
+        for entity in entities:
+            term = entity['term']
+            category = entity['category']
+            prefix = CATEGORY_PREFIX_MAP.get(category, "UNKNOWN")
+            node_id = stable_node_id(prefix, term, category)
+            if (term, category) in entity_to_node_id:
+                continue
+            entity_to_node_id[(term, category)] = node_id
+            categories_by_term[term].append(category)
+            yield {"NodeID": node_id, "Label": term, "Category": category}
+
+    node_count = write_csv(OUTPUT_NODES_PATH, NODE_FIELDS, node_rows())
+    print(f"ノードリストを {OUTPUT_NODES_PATH} に保存しました。 ({node_count}件) / Saved node list to {OUTPUT_NODES_PATH}. ({node_count} items)")
+
+    edges, unresolved = aggregate_edges(relations, entity_to_node_id, categories_by_term)
+    if unresolved:
+        print(f"警告: 始点か終点のノード（用語とカテゴリ）を決められない関係 {unresolved}件を除きました。 / Warning: Dropped {unresolved} relations whose source or target node (term and category) could not be determined.")
+    edge_count = write_csv(OUTPUT_EDGES_PATH, EDGE_FIELDS, iter_edge_rows(edges))
+    evidence_count = sum(edge["count"] for edge in edges.values())
+    print(f"エッジリストを {OUTPUT_EDGES_PATH} に保存しました。 ({edge_count}件、根拠 {evidence_count}件) / Saved edge list to {OUTPUT_EDGES_PATH}. ({edge_count} items from {evidence_count} relations)")
 
     print("--- ステップ5: CSVへのエクスポートが完了しました --- / --- Step 5: Export to CSV completed ---")
 
@@ -1,56 +1,365 @@
-
 import os
 import csv
-from neo4j import GraphDatabase
+import time
+from collections import defaultdict
+from .graph_delta import GraphSnapshot, diff_graphs
+from .fake_neo4j import RecordingDriver
+from .step5_export import PAGE_LIST_SEPARATOR
+
+# --- 定数 --- #
+# --- Constants --- #
+DEFAULT_IMPORT_BATCH_SIZE = 1000  # 1つのトランザクションで UNWIND する行数 / Number of rows UNWOUND in one transaction
+BULK_IMPORT_DIR = "output/neo4j_bulk_import"
+NODES_PATH = "output/step5_nodes.csv"
+EDGES_PATH = "output/step5_edges.csv"
+NORMALIZATION_NODES_PATH = "output/step5_normalization_nodes.csv"
+NORMALIZATION_EDGES_PATH = "output/step5_normalization_edges.csv"
+
+# グラフの差分の計算に使うノード (CSV, ラベル, ID列, プロパティ列) とエッジ (CSV, ラベル, プロパティ列)
+# Nodes (CSV, label, ID field, property fields) and edges (CSV, label, property fields) used to compute the graph delta
+NODE_SOURCES = [
+    (NODES_PATH, 'Node', 'NodeID', ['Label', 'Category']),
+    (NORMALIZATION_NODES_PATH, 'Term', 'NodeID', ['Label']),
+]
+EDGE_SOURCES = [
+    (EDGES_PATH, 'Node', ['DataSource', 'SourcePages', 'EvidenceCount']),
+    (NORMALIZATION_EDGES_PATH, 'Term', []),
+]
+EDGE_PROPERTIES = {label: properties_fields for _, label, properties_fields in EDGE_SOURCES}
+# 数値のエッジのプロパティの型。neo4j-admin のヘッダーと同じ型にCypherで送る値も変換し、どちらの経路でも同じ型のプロパティにする
+# Types of the numeric edge properties. Values sent through Cypher are converted to the same types as the neo4j-admin header, so both routes store the same property types
+EDGE_PROPERTY_TYPES = {"SourcePages": "int[]", "EvidenceCount": "int"}
+
+# neo4j-admin database import 用のファイル: (出力ファイル名, 入力CSV, ヘッダー, 入力の列（定数は "=値"）)
+# Files for neo4j-admin database import: (output file name, input CSV, header, input columns ("=value" for constants))
+# Node と Term は別のID空間を使うため、同じIDを持っていても衝突しない
+# Node and Term use separate ID spaces, so equal IDs do not collide
+BULK_NODE_FILES = [
+    ("nodes.csv", NODES_PATH, ["NodeID:ID(Node)", "Label", "Category", ":LABEL"], ["NodeID", "Label", "Category", "=Node"]),
+    ("terms.csv", NORMALIZATION_NODES_PATH, ["NodeID:ID(Term)", "Label", ":LABEL"], ["NodeID", "Label", "=Term"]),
+]
+BULK_RELATIONSHIP_FILES = [
+    ("edges.csv", EDGES_PATH, [":START_ID(Node)", ":END_ID(Node)", ":TYPE", "DataSource", "SourcePages:int[]", "EvidenceCount:int"], ["SourceID", "TargetID", "Relation", "DataSource", "SourcePages", "EvidenceCount"]),
+    ("normalization_edges.csv", NORMALIZATION_EDGES_PATH, [":START_ID(Term)", ":END_ID(Term)", ":TYPE"], ["SourceID", "TargetID", "Relation"]),
+]
 
 def get_neo4j_driver():
+    # neo4jドライバーは実際に接続する場合だけ読み込み、テスト用の代替ドライバーを渡す場合は不要にする
+    # The neo4j driver is imported only when actually connecting, so it is not needed when a stand-in driver is passed in
+    from neo4j import GraphDatabase
     uri = os.getenv("NEO4J_URI")
     user = os.getenv("NEO4J_USER")
     password = os.getenv("NEO4J_PASSWORD")
     return GraphDatabase.driver(uri, auth=(user, password))
 
-def import_nodes(driver, node_file, label, id_field, properties_fields):
+def quote_name(name):
+    """ラベル・リレーション型・プロパティ名をCypherの識別子としてバッククォートで囲む / Quotes a label, relationship type or property name as a Cypher identifier with backticks"""
+    return "`" + name.replace("`", "``") + "`"
+
+def typed_property(field, value):
+    """CSVの値を EDGE_PROPERTY_TYPES の型に変換する（型の指定がない列は文字列のまま） / Converts a CSV value to its EDGE_PROPERTY_TYPES type (fields without a type stay strings)"""
+    property_type = EDGE_PROPERTY_TYPES.get(field)
+    if property_type == "int":
+        return int(value)
+    if property_type == "int[]":
+        return [int(item) for item in value.split(PAGE_LIST_SEPARATOR) if item]
+    return value
+
+def iter_csv_rows(path):
+    """CSVファイルの行を辞書として1行ずつ返す / Yields the rows of a CSV file as dicts, one at a time"""
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from csv.DictReader(f)
+
+def iter_batches(rows, batch_size):
+    """行のイテラブルを batch_size 行ずつのリストに分ける / Splits an iterable of rows into lists of batch_size rows"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def run_batch(session, query, rows):
+    """1バッチを明示的な書き込みトランザクションで実行する / Runs one batch in an explicit write transaction"""
+    session.execute_write(lambda tx: tx.run(query, rows=rows).consume())
+
+def report_throughput(name, rows, started):
+    elapsed = time.monotonic() - started
+    rows_per_second = rows / elapsed if elapsed > 0 else float('inf')
+    print(f"{name}: {rows}行を{elapsed:.2f}秒で処理しました ({rows_per_second:.0f}行/秒) / Processed {rows} rows in {elapsed:.2f}s ({rows_per_second:.0f} rows/s)")
+
+def create_constraints(driver, labels_and_fields):
+    """
+    各ラベルのID列に一意性制約を作成する（既にあれば何もしない）。制約はインデックスも兼ねるため、MERGEとエッジのMATCHが速くなる。
+    Creates a uniqueness constraint on each label's ID field (no-op if it exists). The constraint doubles as an index, speeding up MERGE and edge MATCHes.
+    """
+    with driver.session() as session:
+        for label, id_field in labels_and_fields:
+            constraint_name = f"{label}_{id_field}_unique".lower()
+            session.run(f"CREATE CONSTRAINT {quote_name(constraint_name)} IF NOT EXISTS FOR (n:{quote_name(label)}) REQUIRE n.{quote_name(id_field)} IS UNIQUE").consume()
+
+def node_merge_query(label, id_field):
+    """
+    UNWINDした行 row のノードをMERGEし、既存のプロパティを行のプロパティで置き換えるクエリ。
+    A query MERGEing the node in the UNWOUND row and replacing its existing properties with the row's.
+    """
+    return f"""
+    UNWIND $rows AS row
+    MERGE (n:{quote_name(label)} {{ {quote_name(id_field)}: row.id }})
+    SET n = row.props, n.{quote_name(id_field)} = row.id
+    """
+
+def edge_pattern(relation, source_node_label, target_node_label, source_node_id_field, target_node_id_field, properties_fields):
+    """UNWINDした行 row のエッジを表すMATCH句とリレーションのパターンを返す / Returns the MATCH clauses and the relationship pattern for the edge in the UNWOUND row"""
+    properties = ", ".join(f"{quote_name(field)}: row.{quote_name(field)}" for field in properties_fields)
+    properties = f" {{ {properties} }}" if properties else ""
+    match = f"""
+    UNWIND $rows AS row
+    MATCH (a:{quote_name(source_node_label)} {{ {quote_name(source_node_id_field)}: row.source_id }})
+    MATCH (b:{quote_name(target_node_label)} {{ {quote_name(target_node_id_field)}: row.target_id }})
+    """
+    return match, f"(a)-[r:{quote_name(relation)}{properties}]->(b)"
+
+def run_node_batches(driver, query, rows, batch_size):
+    """ノードの行を batch_size 行ずつ実行し、処理した行数を返す / Runs node rows batch_size at a time and returns the number of rows processed"""
+    processed = 0
+    with driver.session() as session:
+        for batch in iter_batches(rows, batch_size):
+            run_batch(session, query, batch)
+            processed += len(batch)
+    return processed
+
+def run_edge_batches(driver, query_for_relation, edges, batch_size):
+    """
+    (リレーション型, 行) のエッジをリレーション型ごとにまとめ、batch_size 行ずつ実行する。処理した行数を返す。
+    リレーション型はパラメータにできないため、型ごとに別のクエリを使う。
+    Groups (relationship type, row) edges by relationship type and runs them batch_size rows at a time. Returns the number of rows processed.
+    Relationship types cannot be parameterized, so each type uses its own query.
+    """
+    processed = 0
+    pending = defaultdict(list)
+    with driver.session() as session:
+        for relation, row in edges:
+            pending[relation].append(row)
+            if len(pending[relation]) >= batch_size:
+                run_batch(session, query_for_relation(relation), pending.pop(relation))
+                processed += batch_size
+        for relation, batch in pending.items():
+            run_batch(session, query_for_relation(relation), batch)
+            processed += len(batch)
+    return processed
+
+def import_nodes(driver, node_file, label, id_field, properties_fields, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    ノードを batch_size 行ずつ UNWIND してMERGEし、既存のプロパティをCSVの値で置き換える。同じIDのノードは再実行しても重複しない。
+    MERGEs nodes, UNWINDing batch_size rows at a time, and replaces their existing properties with the CSV values. Rerunning does not duplicate nodes with the same ID.
+    """
+    started = time.monotonic()
+    rows = ({"id": row[id_field], "props": {field: row[field] for field in properties_fields}} for row in iter_csv_rows(node_file))
+    imported = run_node_batches(driver, node_merge_query(label, id_field), rows, batch_size)
+    report_throughput(node_file, imported, started)
+
+def import_edges(driver, edge_file, source_id_field, target_id_field, relation_field, source_node_label, target_node_label, source_node_id_field, target_node_id_field, properties_fields=(), batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    エッジをリレーション型ごとにまとめ、batch_size 行ずつ UNWIND してMERGEする。エッジは (始点, 型, 終点, properties_fields の値) で同一とみなす。
+    Groups edges by relationship type and MERGEs them, UNWINDing batch_size rows at a time. An edge is identified by (start, type, end, values of properties_fields).
+    """
+    def edge_query(relation):
+        match, pattern = edge_pattern(relation, source_node_label, target_node_label, source_node_id_field, target_node_id_field, properties_fields)
+        return f"{match}MERGE {pattern}"
+
+    started = time.monotonic()
+    edges = (
+        (row[relation_field], dict({field: typed_property(field, row[field]) for field in properties_fields}, source_id=row[source_id_field], target_id=row[target_id_field]))
+        for row in iter_csv_rows(edge_file)
+    )
+    imported = run_edge_batches(driver, edge_query, edges, batch_size)
+    report_throughput(edge_file, imported, started)
+
+def edge_key(source_id, relation, target_id, properties):
+    """エッジを比較するためのキー。リストのプロパティはタプルにする / Key used to compare edges; list properties become tuples"""
+    return (source_id, relation, target_id, *(tuple(value) if isinstance(value, list) else value for value in properties))
+
+def delete_stale_nodes(driver, label, id_field, current_ids, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    データベースにあって current_ids にないラベル label のノードを、接続するエッジごと削除する。削除した件数を返す。
+    Deletes the nodes with label label that are in the database but not in current_ids, together with their edges. Returns the number deleted.
+    """
     with driver.session() as session:
-        with open(node_file, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            print(f"DEBUG: Headers for {node_file}: {reader.fieldnames}")
-            for row in reader:
-                # BOM in header
-                row = {k.lstrip('\ufeff'): v for k, v in row.items()}
-                properties = {field: row[field] for field in properties_fields}
-                session.run(f"""
-                CREATE (n:{label} {{ {id_field}: $id }})
-                SET n += $props
-                """, id=row[id_field], props=properties)
-
-def import_edges(driver, edge_file, source_id_field, target_id_field, relation_field, source_node_label, target_node_label, source_node_id_field, target_node_id_field):
+        stored = [record["id"] for record in session.run(f"MATCH (n:{quote_name(label)}) RETURN n.{quote_name(id_field)} AS id")]
+    stale = ({"id": node_id} for node_id in stored if node_id is not None and node_id not in current_ids)
+    query = f"UNWIND $rows AS row MATCH (n:{quote_name(label)} {{ {quote_name(id_field)}: row.id }}) DETACH DELETE n"
+    return run_node_batches(driver, query, stale, batch_size)
+
+def delete_stale_edges(driver, label, id_field, properties_fields, current_edges, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    ラベル label のノード間のエッジのうち、current_edges（(始点, 型, 終点, プロパティの値...) の集合）にないものと、重複するものを削除する。
+    プロパティは型も含めて比較するため、古い型で書き込まれたエッジも削除される。削除した件数を返す。
+    Deletes the edges between nodes with label label that are not in current_edges (a set of (start, type, end, property values...)), as well as duplicates.
+    Properties are compared including their types, so edges written with outdated types are deleted too. Returns the number deleted.
+    """
+    expected = {
+        edge_key(source_id, relation, target_id, (typed_property(field, value) for field, value in zip(properties_fields, values)))
+        for source_id, relation, target_id, *values in current_edges
+    }
+    properties = "".join(f", r.{quote_name(field)} AS {quote_name(field)}" for field in properties_fields)
+    query = f"""
+    MATCH (a:{quote_name(label)})-[r]->(b:{quote_name(label)})
+    RETURN elementId(r) AS id, a.{quote_name(id_field)} AS source_id, type(r) AS relation, b.{quote_name(id_field)} AS target_id{properties}
+    """
+    stale = []
+    kept = set()
     with driver.session() as session:
-        with open(edge_file, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            print(f"DEBUG: Headers for {edge_file}: {reader.fieldnames}")
-            for row in reader:
-                # BOM in header
-                row = {k.lstrip('\ufeff'): v for k, v in row.items()}
-                session.run(f"""
-                MATCH (a:{source_node_label} {{ {source_node_id_field}: $source_id }})
-                MATCH (b:{target_node_label} {{ {target_node_id_field}: $target_id }})
-                CREATE (a)-[:`{row[relation_field]}`]->(b)
-                """, source_id=row[source_id_field], target_id=row[target_id_field])
-
-def main():
-    driver = get_neo4j_driver()
-
-    # Import knowledge graph nodes and edges
-    # ナレッジグラフのノードとエッジをインポート
-    import_nodes(driver, 'output/step5_nodes.csv', 'Node', 'NodeID', ['Label', 'Category'])
-    import_edges(driver, 'output/step5_edges.csv', 'SourceID', 'TargetID', 'Relation', 'Node', 'Node', 'NodeID', 'NodeID')
-
-    # Import normalization graph nodes and edges
-    # 正規化グラフのノードとエッジをインポート
-    import_nodes(driver, 'output/step5_normalization_nodes.csv', 'Term', 'NodeID', ['Label'])
-    import_edges(driver, 'output/step5_normalization_edges.csv', 'SourceID', 'TargetID', 'Relation', 'Term', 'Term', 'NodeID', 'NodeID')
-
-    driver.close()
+        for record in session.run(query):
+            key = edge_key(record["source_id"], record["relation"], record["target_id"], (record[field] for field in properties_fields))
+            if key in expected and key not in kept:
+                kept.add(key)
+            else:
+                stale.append({"id": record["id"]})
+    return run_node_batches(driver, "UNWIND $rows AS row MATCH ()-[r]->() WHERE elementId(r) = row.id DELETE r", stale, batch_size)
+
+def full_sync_graph(driver, current, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    step5のCSVの全てのノードとエッジをMERGEしてから、データベースにあってCSVにないノードとエッジを削除し、データベースをCSVと一致させる。
+    前回同期したグラフのスナップショットには依存しない。
+    MERGEs every node and edge of the step5 CSVs, then deletes the nodes and edges that are in the database but not in the CSVs, so the database matches the CSVs.
+    Does not depend on the snapshot of the previously synced graph.
+    """
+    for path, label, id_field, properties_fields in NODE_SOURCES:
+        import_nodes(driver, path, label, id_field, properties_fields, batch_size=batch_size)
+    for path, label, properties_fields in EDGE_SOURCES:
+        import_edges(driver, path, 'SourceID', 'TargetID', 'Relation', label, label, 'NodeID', 'NodeID', properties_fields, batch_size=batch_size)
+    for _, label, properties_fields in EDGE_SOURCES:
+        started = time.monotonic()
+        deleted = delete_stale_edges(driver, label, 'NodeID', properties_fields, current.edges.get(label, set()), batch_size=batch_size)
+        report_throughput(f"{label} (CSVにないエッジを削除 / deleted edges missing from the CSVs)", deleted, started)
+    for _, label, id_field, _ in NODE_SOURCES:
+        started = time.monotonic()
+        deleted = delete_stale_nodes(driver, label, id_field, current.nodes.get(label, {}), batch_size=batch_size)
+        report_throughput(f"{label} (CSVにないノードを削除 / deleted nodes missing from the CSVs)", deleted, started)
+
+def apply_graph_delta(driver, delta, batch_size=DEFAULT_IMPORT_BATCH_SIZE):
+    """
+    グラフの差分だけをNeo4jに適用する。削除されたエッジとノードを消してから、追加・変更されたノードとエッジをMERGEする。
+    Applies only the graph delta to Neo4j: removed edges and nodes are deleted first, then added or changed nodes and edges are MERGEd.
+    """
+    def edges_of(label_edges):
+        # エッジは (始点, 型, 終点, プロパティの値...) のタプル / Edges are (start, type, end, property values...) tuples
+        for source_id, relation, target_id, *values in label_edges:
+            properties = {field: typed_property(field, value) for field, value in zip(EDGE_PROPERTIES[label], values)}
+            yield relation, dict(properties, source_id=source_id, target_id=target_id)
+
+    def edge_query(verb):
+        def query_for_relation(relation):
+            match, pattern = edge_pattern(relation, label, label, 'NodeID', 'NodeID', EDGE_PROPERTIES[label])
+            return f"{match}MATCH {pattern} DELETE r" if verb == "DELETE" else f"{match}MERGE {pattern}"
+        return query_for_relation
+
+    for label, removed in delta.removed_edges.items():
+        started = time.monotonic()
+        report_throughput(f"{label} (削除されたエッジ / removed edges)", run_edge_batches(driver, edge_query("DELETE"), edges_of(removed), batch_size), started)
+    for label, removed in delta.removed_nodes.items():
+        started = time.monotonic()
+        query = f"UNWIND $rows AS row MATCH (n:{quote_name(label)} {{ {quote_name('NodeID')}: row.id }}) DETACH DELETE n"
+        report_throughput(f"{label} (削除されたノード / removed nodes)", run_node_batches(driver, query, ({"id": node_id} for node_id in removed), batch_size), started)
+    for label, upserted in delta.upserted_nodes.items():
+        started = time.monotonic()
+        query = node_merge_query(label, 'NodeID')
+        rows = ({"id": node_id, "props": properties} for node_id, properties in upserted.items())
+        report_throughput(f"{label} (追加・変更されたノード / added or changed nodes)", run_node_batches(driver, query, rows, batch_size), started)
+    for label, added in delta.added_edges.items():
+        started = time.monotonic()
+        report_throughput(f"{label} (追加されたエッジ / added edges)", run_edge_batches(driver, edge_query("MERGE"), edges_of(added), batch_size), started)
+
+def write_bulk_import_file(source_path, output_path, header, columns):
+    """
+    step5のCSVを1行ずつ読み、型付きヘッダーを持つ neo4j-admin 用のCSVに書き出す。書き出した行数を返す。
+    Reads a step5 CSV row by row and writes it as a neo4j-admin CSV with a typed header. Returns the number of rows written.
+    """
+    written = 0
+    temporary_path = output_path + ".tmp"
+    with open(temporary_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in iter_csv_rows(source_path):
+            writer.writerow([column[1:] if column.startswith("=") else row[column] for column in columns])
+            written += 1
+    os.replace(temporary_path, output_path)
+    return written
+
+def bulk_import_command(output_dir=BULK_IMPORT_DIR, database="neo4j"):
+    """書き出したファイルを読み込む neo4j-admin のコマンドを返す / Returns the neo4j-admin command that loads the written files"""
+    arguments = ["neo4j-admin", "database", "import", "full", database, "--overwrite-destination"]
+    arguments += [f"--nodes={os.path.join(output_dir, name)}" for name, _, _, _ in BULK_NODE_FILES]
+    arguments += [f"--relationships={os.path.join(output_dir, name)}" for name, _, _, _ in BULK_RELATIONSHIP_FILES]
+    return " ".join(arguments)
+
+def export_bulk_import_files(output_dir=BULK_IMPORT_DIR):
+    """
+    step5のCSVを neo4j-admin database import（オフラインの一括インポート）用のCSVに変換し、読み込むためのコマンドを表示する。
+    DataFrameは作らず、1行ずつストリーミングで書き出す。
+    Converts the step5 CSVs into CSVs for neo4j-admin database import (offline bulk import) and prints the command that loads them.
+    No DataFrames are built; rows are streamed to disk one at a time.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for name, source_path, header, columns in BULK_NODE_FILES + BULK_RELATIONSHIP_FILES:
+        started = time.monotonic()
+        written = write_bulk_import_file(source_path, os.path.join(output_dir, name), header, columns)
+        elapsed = time.monotonic() - started
+        print(f"{os.path.join(output_dir, name)}: {written}行を{elapsed:.2f}秒で書き出しました / Wrote {written} rows in {elapsed:.2f}s")
+    print("Neo4jを停止した状態で、次のコマンドで一括インポートしてください（既存のデータベースは上書きされます）: / With Neo4j stopped, bulk-import with the following command (the existing database is overwritten):")
+    print(f"  {bulk_import_command(output_dir)}")
+
+def main(driver=None, batch_size=DEFAULT_IMPORT_BATCH_SIZE, bulk_export=False, full_sync=False, dry_run=False):
+    """
+    step5のCSVをNeo4jに同期する。前回同期したグラフのスナップショットがあれば、その差分（追加・変更・削除されたノードとエッジ）だけを適用する。
+    スナップショットがない場合や full_sync を指定した場合は、全てのノードとエッジをMERGEし、データベースにあってCSVにないノードとエッジを削除する。
+    driverを渡すと、ローカルのNeo4jコンテナや代替ドライバーに対して実行できる。dry_run を指定すると、Neo4jに接続せず記録用の代替ドライバー（RecordingDriver）に
+    送り、UNWINDのバッチを表示する。この場合スナップショットは更新しない。
+    bulk_export を指定すると、データベースには接続せず neo4j-admin database import 用のファイルを書き出す。
+    Syncs the step5 CSVs to Neo4j. If there is a snapshot of the previously synced graph, only the delta (added, changed and removed nodes and edges) is applied.
+    Without a snapshot, or with full_sync, every node and edge is MERGEd and the nodes and edges in the database but not in the CSVs are deleted.
+    Passing a driver runs it against a local Neo4j container or a stand-in driver. With dry_run, nothing connects to Neo4j: the calls go to a recording
+    stand-in driver (RecordingDriver) and its UNWIND batches are printed. The snapshot is not updated in that case.
+    With bulk_export, no database connection is made and files for neo4j-admin database import are written instead.
+    """
+    if bulk_export:
+        export_bulk_import_files()
+        return
+
+    current = GraphSnapshot.from_csvs(NODE_SOURCES, EDGE_SOURCES)
+    delta = None
+    if not full_sync:
+        previous = GraphSnapshot.load()
+        if previous is None:
+            print("前回同期したグラフがないため、全体を同期します。 / No previously synced graph, syncing the whole graph.")
+        else:
+            delta = diff_graphs(previous, current)
+            delta.report()
+
+    if dry_run:
+        driver = RecordingDriver()
+    owns_driver = driver is None
+    if owns_driver:
+        driver = get_neo4j_driver()
+    try:
+        create_constraints(driver, [(label, id_field) for _, label, id_field, _ in NODE_SOURCES])
+        if delta is None:
+            full_sync_graph(driver, current, batch_size=batch_size)
+        else:
+            apply_graph_delta(driver, delta, batch_size=batch_size)
+    finally:
+        if owns_driver:
+            driver.close()
+
+    if dry_run:
+        driver.report()
+        print("Neo4jには何も書き込んでいません（--neo4j-dry-run）。 / Nothing was written to Neo4j (--neo4j-dry-run).")
+        return
+    # 適用が成功した場合だけスナップショットを更新する / The snapshot is updated only when the delta was applied successfully
+    current.save()
     print("Successfully imported data into Neo4j. / Neo4jへのデータインポートが正常に完了しました。")
 
 if __name__ == "__main__":
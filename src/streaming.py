@@ -0,0 +1,196 @@
+import queue
+import threading
+import time
+from collections import defaultdict
+from .llm_utils import DEFAULT_BATCH_TOKEN_BUDGET, get_model, map_concurrently
+from .checkpoint_utils import UnitJournal
+from .failure_utils import DeadLetterQueue
+from .dedup_utils import DuplicateClusters, NearDuplicateIndex, find_near_duplicates
+from .artifact_store import ArtifactWriter, write_records
+from .pair_pruning import PairRegistry, PruningStats
+from . import step2a_clean_text
+from . import step2b_extract_entities
+from . import step3b_llm_based_relations
+
+# --- 定数 --- #
+# --- Constants --- #
+STREAM_QUEUE_SIZE = 64  # ステージ間のキューに保持する段落の最大数 / Maximum number of paragraphs held in the queue between stages
+STREAM_STEPS = ['step2a', 'step2b', 'step3b']
+_END_OF_STREAM = object()
+
+class StageThread:
+    """
+    イテラブルを別スレッドで実行し、結果を有界キュー経由で受け渡すパイプラインのステージ。
+    キューが満杯の間は上流が待機するため、ステージ間のメモリ使用量は STREAM_QUEUE_SIZE で抑えられる。
+    ステージで発生した例外は、下流がイテレートした時点で再送出される。
+    A pipeline stage that runs an iterable on its own thread and hands its results over through a bounded queue.
+    The upstream waits while the queue is full, so memory between stages is bounded by STREAM_QUEUE_SIZE.
+    An exception raised in the stage is re-raised when the downstream iterates.
+    """
+
+    def __init__(self, name, iterable, maxsize=STREAM_QUEUE_SIZE):
+        self.name = name
+        self.items = 0
+        self.output_wait = 0.0  # 下流が遅く、キューへの追加を待った時間 / Time spent waiting to enqueue because the downstream was slower
+        self.input_wait = 0.0  # 下流がこのステージの出力を待った時間 / Time the downstream spent waiting for this stage's output
+        self.started = time.monotonic()
+        self.finished = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(iterable,), name=f"stream-{name}", daemon=True)
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                waited = time.monotonic()
+                self._queue.put(item)
+                self.output_wait += time.monotonic() - waited
+                self.items += 1
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.finished = time.monotonic()
+            self._queue.put(_END_OF_STREAM)
+
+    def __iter__(self):
+        while True:
+            waited = time.monotonic()
+            item = self._queue.get()
+            self.input_wait += time.monotonic() - waited
+            if item is _END_OF_STREAM:
+                break
+            yield item
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def report(self, started):
+        elapsed = (self.finished or time.monotonic()) - started
+        print(f"  [{self.name}] {self.items}件, 完了 {elapsed:.2f}秒後, 下流待ち {self.output_wait:.2f}秒 / {self.items} items, finished after {elapsed:.2f}s, waited {self.output_wait:.2f}s for the downstream")
+
+def main(model_name='gemini-1.5-flash-latest', retries=3, token_budget=DEFAULT_BATCH_TOKEN_BUDGET, fast_path=True, dedup=True):
+    """
+    step2a→step2b→step3bをストリーミングで実行する。各ステージは別スレッドで動き、有界キューで接続される。
+    クレンジングの済んだ段落はすぐにエンティティ抽出へ、エンティティの分かった段落はすぐに関係抽出へ流れるため、
+    1文書の処理時間は全ステージの合計ではなく最も遅いステージに近づく。
+    各ステップの出力ファイル（JSON/JSONL）は通常の実行と同じ形式で書き出される。
+    チェックポイントからの再開とデッドレターの再処理は通常の実行でのみ使える（失敗したアイテムはデッドレターに保存される）。
+    Runs step2a -> step2b -> step3b as a stream. Each stage runs on its own thread, connected by bounded queues.
+    Cleaned paragraphs flow straight into entity extraction, and paragraphs whose entities are known flow straight into relation extraction,
+    so the latency for one document approaches the slowest stage rather than the sum of all stages.
+    Each step's output files (JSON/JSONL) are written in the same format as a normal run.
+    Resuming from checkpoints and replaying dead letters are only available in normal runs (failed items are still saved to the dead letters).
+    """
+    print("構造化されたテキストを読み込み中... / Loading structured text...")
+    pages = step2a_clean_text.load_structured_text("output/step1_structured_text.json")
+    paragraphs_with_source = step2a_clean_text.create_paragraphs_with_source(pages)
+    print(f"{len(paragraphs_with_source)}個の段落に分割されました。 / The text has been split into {len(paragraphs_with_source)} paragraphs.")
+
+    cleaning_prompt = step2a_clean_text.load_prompt_template("paragraph_cleaning_prompt.md")
+    entity_prompt = step2b_extract_entities.load_prompt_template("entity_extraction_prompt.md")
+    relation_prompt = step3b_llm_based_relations.load_prompt_template("relation_extraction_batch_prompt.md")
+    if not relation_prompt:
+        return
+
+    print("LLMモデルを初期化中... / Initializing LLM model...")
+    model = get_model(model_name)
+
+    # ストリーミングでは step2b/3b のバッチ構成が通常の実行と異なるため、古いチェックポイントはリセットする
+    # In streaming, step2b/3b batches differ from a normal run, so their old checkpoints are reset
+    for step_name in ('step2b', 'step3b'):
+        UnitJournal(step_name).close()
+    journal = UnitJournal("step2a")
+    dead_letters = {step_name: DeadLetterQueue(step_name) for step_name in STREAM_STEPS}
+
+    cleaned_paragraphs = []
+    entity_sources = defaultdict(set)
+    duplicate_index = NearDuplicateIndex() if dedup else None
+    streamed_registry = PairRegistry()  # ストリーミング中の暫定のペア / Provisional pairs during streaming
+
+    def record_cleaned(paragraphs):
+        for item in paragraphs:
+            cleaned_paragraphs.append(item)
+            yield item
+
+    def record_entities(paragraph_entities):
+        for paragraph_index, (item, entity_keys, representative) in enumerate(paragraph_entities):
+            for key in entity_keys:
+                entity_sources[key].update(item['source_pages'])
+            yield paragraph_index, item, entity_keys, representative
+
+    print("ストリーミング実行を開始します (step2a → step2b → step3b)... / Starting streaming execution (step2a -> step2b -> step3b)...")
+    started = time.monotonic()
+    cleaning_stage = StageThread("step2a", step2a_clean_text.iter_cleaned_paragraphs(
+        paragraphs_with_source, cleaning_prompt, model, retries=retries, token_budget=token_budget,
+        journal=journal, dead_letters=dead_letters['step2a'], fast_path=fast_path, dedup=dedup
+    ))
+    entity_stage = StageThread("step2b", step2b_extract_entities.iter_paragraph_entities(
+        record_cleaned(cleaning_stage), entity_prompt, model, retries=retries, token_budget=token_budget,
+        dead_letters=dead_letters['step2b'], duplicate_index=duplicate_index
+    ))
+
+    # 関係抽出はこのスレッドで行い、全ての段落を見た後に根拠を集約して出力する
+    # Relation extraction runs on this thread; results are written after every paragraph is seen so evidence is fully aggregated
+    batch_results = []
+    relation_batches = step3b_llm_based_relations.plan_streamed_relation_batches(
+        record_entities(entity_stage), streamed_registry
+    )
+
+    def process(batch):
+        return batch, step3b_llm_based_relations.process_relation_batch(
+            batch, model, relation_prompt, "?", retries=retries, dead_letters=dead_letters['step3b']
+        )
+
+    for batch, relations in map_concurrently(process, relation_batches):
+        batch_results.append((batch, relations))
+    streamed_batches = len(batch_results)
+
+    # ストリーム中のペアは、それまでに到着した用語だけから作った暫定のもの。全てのエンティティが揃った後に通常の実行と同じ方法でペアを作り直し、
+    # 問い合わせ済みの結果を合わせた上で、足りないペアと関係の見つからなかったペアを問い合わせる
+    # Pairs during the stream are provisional, built only from the terms that had arrived. Once every entity is known, pairs are rebuilt the same way as in a normal run,
+    # the results so far are reconciled with them, and the missing pairs and the pairs with no relation found are queried
+    entities = step2b_extract_entities.format_entities(entity_sources)
+    texts = [item["paragraph"] for item in cleaned_paragraphs]
+    clusters = find_near_duplicates(texts) if dedup else DuplicateClusters.singletons(len(texts))
+    registry = PairRegistry()
+    pruning_stats = PruningStats()
+    step3b_llm_based_relations.register_paragraph_pairs(cleaned_paragraphs, entities, registry, clusters=clusters, pruning_stats=pruning_stats)
+    batch_results = step3b_llm_based_relations.reconcile_streamed_results(batch_results, registry)
+    print(f"ストリーム中に{len(streamed_registry)}ペアを問い合わせました。全てのエンティティから作り直したペアは{len(registry)}件です / Queried {len(streamed_registry)} pairs during the stream; rebuilding from all entities gives {len(registry)} pairs")
+    round_index = 1
+    requery_batches = step3b_llm_based_relations.plan_requery_batches(cleaned_paragraphs, registry, round_index)
+    while requery_batches:
+        for batch, relations in map_concurrently(process, requery_batches):
+            step3b_llm_based_relations.mark_answered_pairs(relations, registry)
+            batch_results.append((batch, relations))
+        round_index += 1
+        requery_batches = step3b_llm_based_relations.plan_requery_batches(cleaned_paragraphs, registry, round_index)
+    finished = time.monotonic()
+    journal.close()
+
+    if duplicate_index is not None:
+        duplicate_index.clusters.report("step2b")
+    clusters.report("step3b")
+    pruning_stats.report()
+    registry.report()
+
+    print("クレンジングされた段落を保存中... / Saving cleaned paragraphs...")
+    write_records("output/step2a_cleaned_text.json", cleaned_paragraphs)
+    print("抽出されたエンティティを保存中... / Saving extracted entities...")
+    write_records("output/step2b_entities.json", entities)
+    total_relations_found = 0
+    with ArtifactWriter(step3b_llm_based_relations.OUTPUT_FILE) as writer:
+        for batch, relations in batch_results:
+            records = step3b_llm_based_relations.format_relation_records(batch, relations, registry)
+            writer.write(records)
+            total_relations_found += len(records)
+
+    for step_name in STREAM_STEPS:
+        dead_letters[step_name].report()
+        dead_letters[step_name].close()
+
+    print(f"ストリーミング実行が{finished - started:.2f}秒で完了しました: {len(cleaned_paragraphs)}段落, {len(entity_sources)}エンティティ, {total_relations_found}関係 / Streaming execution completed in {finished - started:.2f}s: {len(cleaned_paragraphs)} paragraphs, {len(entity_sources)} entities, {total_relations_found} relations")
+    cleaning_stage.report(started)
+    entity_stage.report(started)
+    print(f"  [step3b] {len(batch_results)}バッチ (うちストリーム中 {streamed_batches}), 完了 {finished - started:.2f}秒後, 上流待ち {entity_stage.input_wait:.2f}秒 / {len(batch_results)} batches ({streamed_batches} during the stream), finished after {finished - started:.2f}s, waited {entity_stage.input_wait:.2f}s for the upstream")
@@ -0,0 +1,223 @@
+import re
+import unicodedata
+from collections import Counter
+import numpy as np
+
+# --- 定数 --- #
+# --- Constants --- #
+BLOCKING_SIMILARITY_THRESHOLD = 0.5  # 同じ候補クラスタにまとめるTF-IDFベクトルのコサイン類似度 / Cosine similarity of TF-IDF vectors for terms to share a candidate cluster
+MAX_CANDIDATE_DOCUMENT_FREQUENCY = 100  # これより多くの用語に現れるn-gramは候補の生成に使わない（計算量を用語数に比例させる） / N-grams occurring in more terms than this do not generate candidates (keeps the work linear in the number of terms)
+MAX_PRODUCTS_PER_BLOCK = 4_000_000  # 類似度をまとめて計算する1ブロックあたりの積の数 / Number of products computed together in one block of the similarity computation
+NGRAM_SIZES = (2, 3)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+# カタカナの後に続く長音記号の異体（NFKC後） / Variants of the long vowel mark following katakana (after NFKC)
+LONG_VOWEL_VARIANT_PATTERN = re.compile(r"(?<=[ァ-ヴー])[-‐‑‒–—―−~～〜]")
+# 3文字以上のカタカナ語の末尾の長音（例: コンピューター / コンピュータ） / Trailing long vowel of katakana words of three or more characters (e.g. コンピューター / コンピュータ)
+TRAILING_LONG_VOWEL_PATTERN = re.compile(r"(?<=[ァ-ヴー]{3})ー(?![ァ-ヴー])")
+HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in range(ord("ぁ"), ord("ゖ") + 1)}
+
+def variant_key(term):
+    """
+    表記の揺れだけが異なる用語に同じキーを返す。全角・半角（NFKC）、空白、英字の大文字・小文字、長音記号の異体と語末の長音を統一する。
+    Returns the same key for terms differing only in notation: unifies full/half width (NFKC), whitespace, Latin case, long vowel mark variants and trailing long vowels.
+    """
+    key = unicodedata.normalize("NFKC", term)
+    key = WHITESPACE_PATTERN.sub("", key).lower()
+    key = LONG_VOWEL_VARIANT_PATTERN.sub("ー", key)
+    return TRAILING_LONG_VOWEL_PATTERN.sub("", key)
+
+def merge_exact_variants(terms, known=()):
+    """
+    表記の揺れだけが異なる用語をLLMを使わずにまとめる。
+    代表の用語は、同じキーを持つ既知の用語（known）、なければNFKC正規化済みの表記の用語、なければ最初に現れた用語とする。
+    戻り値は (代表の用語のリスト, 代表以外の用語から代表の用語へのマップ)。
+    Merges terms differing only in notation without any LLM call.
+    The representative is a known term (in known) with the same key, or else a term already in NFKC form, or else the first one seen.
+    Returns (a list of representative terms, a map from the other terms to their representative).
+
+    Args:
+        terms: 用語のリスト（重複なし）。 / A list of terms (without duplicates).
+        known: 代表として優先する既知の用語（正規化ストアの用語など）。 / Known terms preferred as representatives (e.g. the normalization store's terms).
+    """
+    known_by_key = {}
+    for term in known:
+        known_by_key.setdefault(variant_key(term), term)
+    groups = {}
+    for term in terms:
+        groups.setdefault(variant_key(term), []).append(term)
+    representatives = []
+    variant_map = {}
+    for key, members in groups.items():
+        representative = known_by_key.get(key) or next(
+            (term for term in members if term == unicodedata.normalize("NFKC", term)), members[0]
+        )
+        representatives.append(representative)
+        for term in members:
+            if term != representative:
+                variant_map[term] = representative
+    return representatives, variant_map
+
+def term_features(term):
+    """
+    TF-IDFに使う用語の特徴を返す。ひらがなをカタカナに揃えた上での文字2-gram・3-gram（語頭・語末の記号付き）と、漢字1文字ずつ。
+    Returns the features of a term used for TF-IDF: character 2- and 3-grams (with start and end markers) after folding hiragana into katakana, plus each kanji on its own.
+    """
+    key = variant_key(term).translate(HIRAGANA_TO_KATAKANA)
+    padded = f"^{key}$"
+    features = [padded[i:i + size] for size in NGRAM_SIZES for i in range(len(padded) - size + 1)]
+    # 漢字は1文字でも意味を持つため単独でも特徴にする
+    # A single kanji carries meaning, so each is also a feature on its own
+    features.extend(char for char in key if "一" <= char <= "鿿")
+    return features
+
+class TfidfNgramVectors:
+    """
+    用語の文字n-gram TF-IDFベクトル（L2正規化済み）を疎行列として保持する。
+    scipyに依存しないよう、行列はCSR/CSC形式のnumpy配列（ポインタ・列番号・値）で表す。
+    Holds the character n-gram TF-IDF vectors of terms (L2-normalized) as a sparse matrix.
+    To avoid a scipy dependency, the matrix is stored as CSR/CSC numpy arrays (pointers, indices, values).
+    """
+
+    def __init__(self, terms):
+        feature_ids = {}
+        rows, columns, counts = [], [], []
+        for row, term in enumerate(terms):
+            for feature, count in Counter(term_features(term)).items():
+                rows.append(row)
+                columns.append(feature_ids.setdefault(feature, len(feature_ids)))
+                counts.append(count)
+        self.term_count = len(terms)
+        self.feature_count = len(feature_ids)
+        rows = np.array(rows, dtype=np.int64)
+        columns = np.array(columns, dtype=np.int64)
+        counts = np.array(counts, dtype=np.float64)
+
+        # 劣線形のTFと平滑化したIDFを掛け、行ごとにL2正規化する
+        # Multiply sublinear TF by smoothed IDF and L2-normalize each row
+        self.document_frequency = np.bincount(columns, minlength=self.feature_count)
+        idf = np.log((1 + self.term_count) / (1 + self.document_frequency)) + 1.0
+        values = (1.0 + np.log(counts)) * idf[columns]
+        norms = np.sqrt(np.bincount(rows, weights=values ** 2, minlength=self.term_count))
+        values /= norms[rows]
+
+        # CSR（行ごと）: 行は入力順に追加したため既に並んでいる
+        # CSR (by row): rows were appended in input order, so they are already sorted
+        self.row_pointer = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=self.term_count))])
+        self.row_columns = columns
+        self.row_values = values
+        # CSC（特徴ごとの転置リスト）
+        # CSC (a posting list per feature)
+        order = np.argsort(columns, kind="stable")
+        self.column_pointer = np.concatenate([[0], np.cumsum(self.document_frequency)])
+        self.column_rows = rows[order]
+        self.column_values = values[order]
+
+    def similar_pairs(self, threshold=BLOCKING_SIMILARITY_THRESHOLD, max_document_frequency=MAX_CANDIDATE_DOCUMENT_FREQUENCY):
+        """
+        コサイン類似度がしきい値以上の用語のペア (i, j, 類似度)（i < j）を配列で返す。
+        出現用語数が max_document_frequency を超えるn-gramは候補の生成に使わない（ブロッキング）ため、類似度は識別力のある特徴だけで計算される。
+        疎行列の積は、行のブロックごとに転置リストを展開してnumpyでまとめて計算する。
+        Returns arrays of term pairs (i, j, similarity) with i < j whose cosine similarity reaches the threshold.
+        N-grams in more than max_document_frequency terms are not used for candidates (blocking), so similarity is computed over discriminative features only.
+        The sparse product is computed with numpy, expanding the posting lists for one block of rows at a time.
+        """
+        entry_rows = np.repeat(np.arange(self.term_count), np.diff(self.row_pointer))
+        posting_lengths = self.document_frequency[self.row_columns]
+        usable = posting_lengths <= max_document_frequency
+        entry_rows = entry_rows[usable]
+        entry_columns = self.row_columns[usable]
+        entry_values = self.row_values[usable]
+        posting_lengths = posting_lengths[usable]
+
+        found_first, found_second, found_similarity = [], [], []
+        cumulative = np.cumsum(posting_lengths)
+        start = 0
+        while start < len(entry_rows):
+            # 積の数が上限に収まるように、エントリのブロックを行の境界で区切る
+            # Cut a block of entries at a row boundary so that the number of products stays within the limit
+            base = cumulative[start - 1] if start else 0
+            end = int(np.searchsorted(cumulative, base + MAX_PRODUCTS_PER_BLOCK, side="right"))
+            end = max(end, start + 1)
+            if end < len(entry_rows):
+                boundary = int(np.searchsorted(entry_rows, entry_rows[end], side="left"))
+                end = boundary if boundary > start else int(np.searchsorted(entry_rows, entry_rows[start], side="right"))
+            first, second, similarity = self._block_products(
+                entry_rows[start:end], entry_columns[start:end], entry_values[start:end], posting_lengths[start:end]
+            )
+            keep = similarity >= threshold
+            found_first.append(first[keep])
+            found_second.append(second[keep])
+            found_similarity.append(similarity[keep])
+            start = end
+
+        if not found_first:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(found_first), np.concatenate(found_second), np.concatenate(found_similarity)
+
+    def _block_products(self, rows, columns, values, lengths):
+        total = int(lengths.sum())
+        offsets = np.repeat(self.column_pointer[columns] - (np.cumsum(lengths) - lengths), lengths)
+        positions = np.arange(total) + offsets
+        first = np.repeat(rows, lengths)
+        second = self.column_rows[positions]
+        products = np.repeat(values, lengths) * self.column_values[positions]
+        upper = first < second
+        keys = first[upper] * self.term_count + second[upper]
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        similarity = np.bincount(inverse, weights=products[upper])
+        return unique_keys // self.term_count, unique_keys % self.term_count, similarity
+
+def block_terms(terms, threshold=BLOCKING_SIMILARITY_THRESHOLD):
+    """
+    文字n-gram TF-IDFの近傍で用語を候補クラスタにまとめる（しきい値以上のペアを連結成分として結合）。
+    クラスタは最初の用語の順に並び、各クラスタ内の用語も入力順に並ぶ。
+    Groups terms into candidate clusters by character n-gram TF-IDF neighbourhood (pairs over the threshold are joined into connected components).
+    Clusters are ordered by their first term, and terms within a cluster keep the input order.
+    """
+    if not terms:
+        return []
+    first, second, _ = TfidfNgramVectors(terms).similar_pairs(threshold)
+
+    parent = list(range(len(terms)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for i, j in zip(first.tolist(), second.tolist()):
+        root1, root2 = find(i), find(j)
+        if root1 != root2:
+            parent[max(root1, root2)] = min(root1, root2)
+
+    clusters = {}
+    for index in range(len(terms)):
+        clusters.setdefault(find(index), []).append(index)
+    return list(clusters.values())
+
+def pack_term_batches(terms, clusters, batch_size):
+    """
+    候補クラスタを分割せずに用語のバッチへ詰める。batch_size を超えるクラスタだけは分割する。
+    Packs candidate clusters into batches of terms without splitting them; only clusters larger than batch_size are split.
+    """
+    batches = []
+    current = []
+    for cluster in clusters:
+        members = [terms[index] for index in cluster]
+        for i in range(0, len(members), batch_size):
+            chunk = members[i:i + batch_size]
+            if current and len(current) + len(chunk) > batch_size:
+                batches.append(current)
+                current = []
+            current.extend(chunk)
+    if current:
+        batches.append(current)
+    return batches
+
+def print_blocking_stats(term_count, variant_count, clusters, batch_count):
+    """表記ゆれの統合とブロッキングの集計を表示する / Prints notation variant merging and blocking statistics"""
+    multi = [cluster for cluster in clusters if len(cluster) > 1]
+    largest = max((len(cluster) for cluster in clusters), default=0)
+    print(f"[step4] 表記ゆれの統合: {variant_count}語をLLMを使わずに統合しました / Notation variants: merged {variant_count} terms without the LLM")
+    print(f"[step4] ブロッキング: {term_count}語を{len(clusters)}クラスタにまとめ (複数語のクラスタ {len(multi)}個, 最大 {largest}語), {batch_count}バッチに詰め込みました / Blocking: grouped {term_count} terms into {len(clusters)} clusters ({len(multi)} with several terms, largest {largest}) and packed them into {batch_count} batches")
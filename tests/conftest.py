@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from src import artifact_store, llm_utils  # noqa: E402
+from src.benchmark import PROMPT_FILES, write_synthetic_pdf  # noqa: E402
+
+# --- 定数 --- #
+# --- Constants --- #
+SYNTHETIC_PAGES = 8  # テスト用の合成PDFのページ数 / Number of pages in the synthetic test PDF
+INPUT_PDF = "input/synthetic.pdf"
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    プロンプトを複製した一時ディレクトリに移動し、偽のLLMを設定する（各ステップは output/ 以下に書き込む）。
+    Moves into a temporary directory holding copies of the prompts and configures the fake LLM (each step writes under output/).
+    """
+    for prompt_file in PROMPT_FILES:
+        shutil.copy(os.path.join(REPO_ROOT, prompt_file), tmp_path / prompt_file)
+    monkeypatch.chdir(tmp_path)
+    artifact_store.configure_artifact_format()
+    llm_utils.configure_model_backend("fake", latency=0.0, error_rate=0.0, seed=0)
+    llm_utils.configure_cache(enabled=False)
+    llm_utils.configure_concurrency(1)
+    llm_utils.configure_rate_limiter()
+    llm_utils.reset_llm_stats()
+    yield tmp_path
+    llm_utils.configure_model_backend()
+
+
+@pytest.fixture
+def synthetic_pdf(workspace):
+    """合成PDFを書き出し、step1 を実行する / Writes the synthetic PDF and runs step1"""
+    from src import step1_extract
+    os.makedirs("input", exist_ok=True)
+    write_synthetic_pdf(INPUT_PDF, SYNTHETIC_PAGES)
+    step1_extract.main(input_path=INPUT_PDF, workers=1)
+    return INPUT_PDF
+
+
+@pytest.fixture
+def extracted_entities(synthetic_pdf):
+    """step2a と step2b を実行し、step3b の入力を用意する / Runs step2a and step2b to prepare the input of step3b"""
+    from src import step2a_clean_text, step2b_extract_entities
+    step2a_clean_text.main()
+    step2b_extract_entities.main()
+    return synthetic_pdf
@@ -0,0 +1,58 @@
+import pytest
+
+from src import artifact_store
+from src.artifact_store import ArtifactWriter, artifact_offset, artifact_path, load_records, truncate_artifact
+
+
+@pytest.fixture(params=artifact_store.ARTIFACT_FORMATS)
+def artifact_format(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    artifact_store.configure_artifact_format(request.param)
+    yield request.param
+    artifact_store.configure_artifact_format()
+
+
+def test_truncating_to_a_write_offset_drops_only_later_records(artifact_format):
+    path = "output/demo.jsonl"
+    ArtifactWriter(path).close()
+    assert artifact_offset(path) == 0
+
+    with ArtifactWriter(path, append=True) as writer:
+        first_offset = writer.write([{"n": 1}, {"n": 2, "extra": "x"}])
+        second_offset = writer.write([{"n": 3}])
+    assert artifact_offset(path) == second_offset
+    assert load_records(path) == [{"n": 1}, {"n": 2, "extra": "x"}, {"n": 3}]
+    assert load_records(path, columns=["extra"]) == [{}, {"extra": "x"}, {}]
+
+    truncate_artifact(path, first_offset)
+    assert artifact_offset(path) == first_offset
+    assert load_records(path) == [{"n": 1}, {"n": 2, "extra": "x"}]
+
+    # 切り詰めた後に追記を再開できる / Appending resumes after truncation
+    with ArtifactWriter(path, append=True) as writer:
+        writer.write([{"n": 4}])
+    assert [record["n"] for record in load_records(path)] == [1, 2, 4]
+
+
+def test_a_torn_jsonl_line_is_removed_by_truncation(artifact_format):
+    if artifact_format != 'json':
+        pytest.skip("書き込み途中の行はJSONLにだけ残る / Only JSONL can hold a torn line")
+    path = "output/demo.jsonl"
+    with ArtifactWriter(path) as writer:
+        offset = writer.write([{"n": 1}])
+    with open(artifact_path(path), 'a', encoding='utf-8') as f:
+        f.write('{"n": 2')
+    truncate_artifact(path, offset)
+    assert load_records(path) == [{"n": 1}]
+
+
+def test_an_aborted_writer_leaves_the_artifact_unchanged(artifact_format):
+    path = "output/demo.json"
+    with ArtifactWriter(path) as writer:
+        writer.write([{"n": 1}])
+    with pytest.raises(RuntimeError):
+        with ArtifactWriter(path) as writer:
+            writer.write([{"n": 2}])
+            raise RuntimeError
+    assert load_records(path) == [{"n": 1}]
+    assert artifact_offset("output/missing.json") is None
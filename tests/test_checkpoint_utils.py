@@ -0,0 +1,81 @@
+import pytest
+
+from src import step3b_llm_based_relations
+from src.artifact_store import load_records
+from src.checkpoint_utils import UnitJournal, iter_resumable
+
+
+def units(*keys):
+    return [{"key": key, "fingerprint": f"fp-{key}"} for key in keys]
+
+
+def test_journal_reloads_completed_units_and_drops_a_torn_line(tmp_path):
+    journal = UnitJournal("demo", checkpoint_dir=str(tmp_path))
+    journal.record("a", "fp-a", result=[1], offset=10)
+    journal.record("b", "fp-b", result=[2])
+    journal.close()
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"unit": "c", "finge')
+
+    resumed = UnitJournal("demo", resume=True, checkpoint_dir=str(tmp_path))
+    assert set(resumed.completed) == {"a", "b"}
+    assert resumed.get("a", "fp-a")["offset"] == 10
+    # フィンガープリントが変わった単位は完了扱いにしない / A unit whose fingerprint changed is not treated as done
+    assert not resumed.is_done("b", "fp-changed")
+    resumed.record("c", "fp-c", result=[3])
+    resumed.close()
+    assert set(UnitJournal("demo", resume=True, checkpoint_dir=str(tmp_path)).completed) == {"a", "b", "c"}
+    # 新規実行ではマニフェストをリセットする / A fresh run resets the manifest
+    assert UnitJournal("demo", checkpoint_dir=str(tmp_path)).completed == {}
+
+
+def test_iter_resumable_only_processes_pending_units(tmp_path):
+    journal = UnitJournal("demo", checkpoint_dir=str(tmp_path))
+    journal.record("a", "fp-a", result="stored-a")
+    processed = []
+
+    def process(unit):
+        processed.append(unit["key"])
+        return None if unit["key"] == "c" else f"new-{unit['key']}"
+
+    results = list(iter_resumable(journal, units("a", "b", "c"), process))
+    assert processed == ["b", "c"]
+    assert [(unit["key"], result, from_checkpoint) for unit, result, from_checkpoint in results] == [
+        ("a", "stored-a", True), ("b", "new-b", False), ("c", None, False),
+    ]
+    # 失敗した（Noneの）結果は記録されず、次回も処理される / A failed (None) result is not recorded and is processed again next time
+    assert set(journal.completed) == {"a", "b"}
+
+
+def test_step3b_resumed_after_a_kill_matches_an_uninterrupted_run(extracted_entities):
+    step3b_llm_based_relations.main()
+    uninterrupted = load_records(step3b_llm_based_relations.OUTPUT_FILE)
+    assert uninterrupted
+
+    original_process = step3b_llm_based_relations.process_relation_batch
+    calls = []
+
+    def killed_partway(batch, *args, **kwargs):
+        calls.append(batch["key"])
+        if len(calls) > 3:
+            raise KeyboardInterrupt
+        return original_process(batch, *args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(step3b_llm_based_relations, "process_relation_batch", killed_partway)
+        with pytest.raises(KeyboardInterrupt):
+            step3b_llm_based_relations.main()
+    assert 0 < len(load_records(step3b_llm_based_relations.OUTPUT_FILE)) < len(uninterrupted)
+
+    resumed_calls = []
+
+    def counted(batch, *args, **kwargs):
+        resumed_calls.append(batch["key"])
+        return original_process(batch, *args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(step3b_llm_based_relations, "process_relation_batch", counted)
+        step3b_llm_based_relations.main(resume=True)
+    assert load_records(step3b_llm_based_relations.OUTPUT_FILE) == uninterrupted
+    # 中断前に完了したバッチは再び問い合わせない / Batches completed before the kill are not queried again
+    assert not set(calls[:3]) & set(resumed_calls)
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from src import step3b_llm_based_relations
+from src.artifact_store import load_records
+from src.checkpoint_utils import UnitJournal
+from src.failure_utils import DEAD_LETTER_DIR, DeadLetterQueue, bisect_process, collect_replay_units
+
+
+def test_bisect_process_isolates_the_failing_items():
+    calls = []
+
+    def process_items(items):
+        calls.append(list(items))
+        return None if "bad" in items else [item.upper() for item in items]
+
+    result, failed = bisect_process(["a", "b", "bad", "c", "d"], process_items)
+    assert result == ["A", "B", "C", "D"]
+    assert failed == ["bad"]
+    assert calls[0] == ["a", "b", "bad", "c", "d"]
+    assert bisect_process([], process_items) == (None, [])
+    assert bisect_process(["bad"], process_items) == (None, ["bad"])
+
+
+def test_dead_letters_round_trip_through_replay(tmp_path):
+    dead_letter_dir = str(tmp_path / "dead_letter")
+    dead_letters = DeadLetterQueue("demo", dead_letter_dir=dead_letter_dir)
+    dead_letters.add("unit-1", [{"pair": ["a", "b"]}, {"pair": ["c", "d"]}])
+    dead_letters.close()
+
+    # 再開モードでは既存のデッドレターに追記する / Resume mode appends to the existing dead letters
+    resumed = DeadLetterQueue("demo", resume=True, dead_letter_dir=dead_letter_dir)
+    resumed.add("unit-2", [{"pair": ["e", "f"]}])
+    resumed.close()
+
+    replay = DeadLetterQueue("demo", replay=True, dead_letter_dir=dead_letter_dir)
+    assert replay.replay_items == [{"pair": ["a", "b"]}, {"pair": ["c", "d"]}, {"pair": ["e", "f"]}]
+    replay.close()
+    # 再処理モードでは読み込んだ後にファイルをリセットする / Replay mode resets the file after loading it
+    assert DeadLetterQueue("demo", replay=True, dead_letter_dir=dead_letter_dir).replay_items == []
+
+
+def test_collect_replay_units_keeps_earlier_replays_and_batches_new_items(tmp_path):
+    journal = UnitJournal("demo", checkpoint_dir=str(tmp_path / "checkpoints"))
+    journal.record("replay:0:0", "fp-earlier", result=[])
+    journal.record("0:0", "fp-normal", result=[])
+    dead_letters = DeadLetterQueue("demo", dead_letter_dir=str(tmp_path / "dead_letter"))
+    dead_letters.replay_items = [1, 2, 3]
+
+    replay_units = collect_replay_units(journal, dead_letters, lambda items: [{"items": items[:2]}, {"items": items[2:]}])
+    assert [unit["key"] for unit in replay_units] == ["replay:0:0", "replay:2:0", "replay:2:1"]
+    assert replay_units[0]["fingerprint"] == "fp-earlier"
+    assert [unit["items"] for unit in replay_units[1:]] == [[1, 2], [3]]
+
+
+def test_step3b_replay_recovers_the_relations_of_failed_pairs(extracted_entities):
+    step3b_llm_based_relations.main()
+    expected = load_records(step3b_llm_based_relations.OUTPUT_FILE)
+    failing_term = expected[0]["source"]
+
+    original_extract = step3b_llm_based_relations.extract_relations_for_batch
+
+    def failing_extract(model, batch, *args, **kwargs):
+        if any(failing_term in (e1["term"], e2["term"]) for e1, e2 in batch["pairs"]):
+            return None
+        return original_extract(model, batch, *args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(step3b_llm_based_relations, "extract_relations_for_batch", failing_extract)
+        step3b_llm_based_relations.main()
+    partial = load_records(step3b_llm_based_relations.OUTPUT_FILE)
+    assert not any(failing_term in (rel["source"], rel["target"]) for rel in partial)
+
+    dead_letter_path = os.path.join(DEAD_LETTER_DIR, "step3b.jsonl")
+    with open(dead_letter_path, encoding='utf-8') as f:
+        assert f.read()
+
+    step3b_llm_based_relations.main(replay_failed=True)
+    replayed = load_records(step3b_llm_based_relations.OUTPUT_FILE)
+    # 偽のLLMの答えはバッチの内容で変わるため、通常の実行との一致ではなく再処理の性質を確認する
+    # The fake LLM's answers depend on the batch content, so check the properties of a replay rather than equality with a normal run
+    assert replayed[:len(partial)] == partial
+    assert any(failing_term in (rel["source"], rel["target"]) for rel in replayed[len(partial):])
+    keys = [(rel["source"], rel["relation"], rel["target"]) for rel in replayed]
+    assert len(keys) == len(set(keys))
+    with open(dead_letter_path, encoding='utf-8') as f:
+        assert f.read() == ""
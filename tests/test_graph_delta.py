@@ -0,0 +1,33 @@
+from src.graph_delta import GraphSnapshot, diff_graphs
+
+
+def snapshot(nodes, edges):
+    return GraphSnapshot(nodes={"Entity": nodes}, edges={"Entity": set(edges)})
+
+
+def test_diff_graphs_reports_added_changed_and_removed_items():
+    previous = snapshot(
+        {"n1": {"name": "頭痛"}, "n2": {"name": "片頭痛"}, "n3": {"name": "削除"}},
+        [("n1", "causes", "n2", "p.1"), ("n2", "causes", "n3", "p.2")],
+    )
+    current = snapshot(
+        {"n1": {"name": "頭痛"}, "n2": {"name": "片頭痛（改）"}, "n4": {"name": "追加"}},
+        [("n1", "causes", "n2", "p.1"), ("n1", "causes", "n2", "p.3"), ("n2", "treats", "n4", "p.4")],
+    )
+    delta = diff_graphs(previous, current)
+    assert delta.counts == {"added_nodes": 1, "changed_nodes": 1, "removed_nodes": 1, "added_edges": 2, "removed_edges": 1}
+    assert delta.upserted_nodes == {"Entity": {"n2": {"name": "片頭痛（改）"}, "n4": {"name": "追加"}}}
+    assert delta.removed_nodes == {"Entity": ["n3"]}
+    # プロパティの違うエッジは変更ではなく削除と追加になる / An edge with different properties is a removal plus an addition, not a change
+    assert delta.added_edges == {"Entity": [("n1", "causes", "n2", "p.3"), ("n2", "treats", "n4", "p.4")]}
+    assert delta.removed_edges == {"Entity": [("n2", "causes", "n3", "p.2")]}
+
+
+def test_identical_snapshots_have_an_empty_delta(tmp_path):
+    current = snapshot({"n1": {"name": "頭痛"}}, [("n1", "causes", "n1", "p.1")])
+    path = str(tmp_path / "snapshot.json")
+    current.save(path)
+    reloaded = GraphSnapshot.load(path)
+    assert diff_graphs(reloaded, current).is_empty()
+    assert diff_graphs(GraphSnapshot(), current).counts["added_nodes"] == 1
+    assert GraphSnapshot.load(str(tmp_path / "missing.json")) is None
@@ -0,0 +1,38 @@
+from src import llm_utils, step4_normalize
+from src.normalization_store import NormalizationStore
+
+
+def entities(*terms):
+    return [{"term": term, "category": "Disease", "source_pages": [1]} for term in terms]
+
+
+def test_store_discards_votes_when_the_fingerprint_changes(tmp_path):
+    path = str(tmp_path / "store.json")
+    store = NormalizationStore(path, fingerprint="prompt-a")
+    store.add_votes(["三叉神経痛症"], {"三叉神経痛症": "三叉神経痛"})
+    store.save()
+
+    assert "三叉神経痛症" in NormalizationStore(path, fingerprint="prompt-a")
+    assert len(NormalizationStore(path, fingerprint="prompt-b")) == 0
+
+
+def test_prompt_edit_changes_the_fingerprint(workspace):
+    before = step4_normalize.normalization_fingerprint("model-a")
+    with open(step4_normalize.PROMPT_TEMPLATE_PATH, 'a', encoding='utf-8') as f:
+        f.write("\n")
+    assert step4_normalize.normalization_fingerprint("model-a") != before
+    assert step4_normalize.normalization_fingerprint("model-b") != step4_normalize.normalization_fingerprint("model-a")
+
+
+def test_known_terms_get_further_votes_next_to_new_terms(workspace):
+    model = llm_utils.get_model("fake-model")
+    store = NormalizationStore(path=None)
+    step4_normalize.get_normalization_map_from_llm(entities("三叉神経痛症", "カルバマゼピン"), model, store=store)
+    assert sum(store.votes["三叉神経痛症"].values()) == 1
+
+    # 似た新しい用語と同じクラスタに入った既知の用語は再び投票を受け、似ていない既知の用語は送られない
+    # A known term in the same cluster as a similar new term is voted on again; a dissimilar known term is not sent
+    step4_normalize.get_normalization_map_from_llm(entities("三叉神経痛症", "カルバマゼピン", "三叉神経痛"), model, store=store)
+    assert sum(store.votes["三叉神経痛症"].values()) == 2
+    assert sum(store.votes["カルバマゼピン"].values()) == 1
+    assert store.votes["三叉神経痛症"]["三叉神経痛"] == 1
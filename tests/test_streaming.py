@@ -0,0 +1,53 @@
+import pytest
+
+from src import step2a_clean_text, step2b_extract_entities, step3b_llm_based_relations, streaming
+from src.artifact_store import load_records
+from src.pair_pruning import PairRegistry
+
+
+def capture_pairs(monkeypatch):
+    """
+    最終的なレジストリのペアと、LLMに送られたペアを記録する。
+    Records the pairs of the final registry and the pairs sent to the LLM.
+    """
+    captured = {"registered": [], "queried": set()}
+    original_report = PairRegistry.report
+    original_extract = step3b_llm_based_relations.extract_relations_for_batch
+
+    def report(self):
+        captured["registered"].append(self.keys())
+        original_report(self)
+
+    def extract(model, batch, *args, **kwargs):
+        captured["queried"].update(PairRegistry.pair_key(e1['term'], e2['term']) for e1, e2 in batch["pairs"])
+        return original_extract(model, batch, *args, **kwargs)
+
+    monkeypatch.setattr(PairRegistry, "report", report)
+    monkeypatch.setattr(step3b_llm_based_relations, "extract_relations_for_batch", extract)
+    return captured
+
+
+def entity_keys():
+    return {(entity['term'], entity['category']) for entity in load_records("output/step2b_entities.json")}
+
+
+def test_stream_queries_the_same_pairs_as_a_normal_run(synthetic_pdf):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        normal = capture_pairs(monkeypatch)
+        step2a_clean_text.main()
+        step2b_extract_entities.main()
+        step3b_llm_based_relations.main()
+    normal_entities = entity_keys()
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        streamed = capture_pairs(monkeypatch)
+        streaming.main()
+    assert entity_keys() == normal_entities
+
+    [normal_pairs] = normal["registered"]
+    [streamed_pairs] = streamed["registered"]
+    assert normal_pairs
+    assert streamed_pairs == normal_pairs
+    # 全てのペアが実際にLLMへ送られている / Every pair was actually sent to the LLM
+    assert normal_pairs <= normal["queried"]
+    assert streamed_pairs <= streamed["queried"]